@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import threading
+import time
+from decimal import Decimal
+
+from runtests import configure
+
+BENCHMARKS = {}
+
+
+def benchmark(postgres: bool = False):
+    def register(func):
+        BENCHMARKS[func.__name__] = func, postgres
+        return func
+    return register
+
+
+@benchmark(postgres=True)
+def contention(workers: int = 16, per_worker: int = 25):
+    """
+    Dummy payments from `workers` threads in lock and optimistic mode, all for one invoice and one invoice each.
+    """
+    from django.db import connections
+    from payment_gateway.base import ConcurrencyMode
+    from payment_gateway.dummy.provider import get_dummy_provider
+    from payment_gateway.errors import PaymentError
+    from payment_gateway.models import Invoice, InvoiceStatus, TransactionType
+    from payment_gateway.service import create_invoice
+
+    def run(mode, same):
+        provider = get_dummy_provider()
+        provider.concurrency_mode = mode
+        count = workers * per_worker
+        if same:
+            invoice_ids = [create_invoice(Decimal('10'), 'payment_gateway.tests.noop_callback').pk] * count
+        else:
+            invoice_ids = [create_invoice(Decimal('10'), 'payment_gateway.tests.noop_callback').pk
+                           for _ in range(count)]
+        rejected = []
+
+        def work(chunk):
+            for invoice_id in chunk:
+                data = provider.transaction_handler.TransactionDTO(TransactionType.DUMMY, invoice_id, Decimal('10'))
+                try:
+                    provider.pay(invoice_id, data)
+                except PaymentError:
+                    rejected.append(invoice_id)
+            connections.close_all()
+
+        threads = [threading.Thread(target=work, args=(invoice_ids[index::workers],)) for index in range(workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        paid = Invoice.objects.filter(pk__in=set(invoice_ids), status=InvoiceStatus.PAID).count()
+        print('%-10s %-18s %6.0f/s  paid=%d rejected=%d' % (
+            mode.value, 'same invoice' if same else 'different invoices', count / elapsed, paid, len(rejected)))
+
+    for same in (True, False):
+        for mode in (ConcurrencyMode.LOCK, ConcurrencyMode.OPTIMISTIC):
+            run(mode, same)
+
+
+@benchmark()
+def parse(iterations: int = 2000):
+    """
+    Serializer.is_valid against CompiledSchema.validate for full CloudPayments and WalletOne payloads.
+    """
+    from urllib.parse import urlencode
+
+    from django.http import QueryDict
+    from payment_gateway.cloudpayments.serializers import CloudPaymentsCheckSerializer, CloudPaymentsPaySerializer
+    from payment_gateway.schema import CompiledSchema
+    from payment_gateway.tests import make_cloudpayments_payload, make_invoice, make_walletone_payload
+    from payment_gateway.walletone.serializers import WalletOneConfirmSerializer
+
+    invoice = make_invoice()
+    cloudpayments = make_cloudpayments_payload(invoice.pk, invoice.total, TotalFee='0.00', Email='payer@example.com',
+                                               IpAddress='10.0.0.1', Data='{"order": 1}')
+    payloads = [
+        (CloudPaymentsCheckSerializer, cloudpayments),
+        (CloudPaymentsPaySerializer, cloudpayments),
+        (WalletOneConfirmSerializer, make_walletone_payload(invoice.pk, invoice.total)),
+    ]
+    for serializer_class, payload in payloads:
+        data = QueryDict(urlencode(payload))
+        schema = CompiledSchema(serializer_class)
+        schema.validate(data)
+
+        def serializer():
+            serializer_class(data=data).is_valid(raise_exception=True)
+
+        timings = []
+        for func in (serializer, lambda: schema.validate(data)):
+            started = time.perf_counter()
+            for _ in range(iterations):
+                func()
+            timings.append((time.perf_counter() - started) / iterations * 1e6)
+        print('%-30s %6.0fus -> %4.0fus (%.1fx)' % (serializer_class.__name__, timings[0], timings[1],
+                                                   timings[0] / timings[1]))
+
+
+@benchmark()
+def dto(count: int = 100000):
+    """
+    Creation time, retained memory and model kwargs time of `count` CloudPayments DTOs, slotted against a plain
+    dataclass with the same fields.
+    """
+    import dataclasses
+    import gc
+    import tracemalloc
+
+    from payment_gateway.cloudpayments.provider import CloudPaymentsTransactionHandler
+    from payment_gateway.dto import to_model_kwargs
+    from payment_gateway.models import CloudPaymentsTransaction, TransactionType
+    from payment_gateway.tests import make_cloudpayments_payload
+
+    slotted = CloudPaymentsTransactionHandler.TransactionDTO
+    plain = dataclasses.make_dataclass('PlainTransactionDTO', [
+        (field.name, field.type) if field.default is dataclasses.MISSING else (field.name, field.type, field.default)
+        for field in dataclasses.fields(slotted)])
+    payload = make_cloudpayments_payload(1, Decimal('100.00'), TotalFee=Decimal('0.00'))
+
+    def create(dto_class):
+        return [dto_class(TransactionType.CLOUDPAYMENTS, 1, Decimal('100.00'), **payload) for _ in range(count)]
+
+    for dto_class in (plain, slotted):
+        gc.collect()
+        tracemalloc.start()
+        dtos = create(dto_class)
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del dtos
+        gc.collect()
+        started = time.perf_counter()
+        dtos = create(dto_class)
+        created = time.perf_counter() - started
+        started = time.perf_counter()
+        for item in dtos:
+            to_model_kwargs(item, CloudPaymentsTransaction)
+        print('%-20s %4.0f ms create %6.1f MB retained %4.0f ms kwargs' % (
+            dto_class.__name__, created * 1000, retained / 2 ** 20, (time.perf_counter() - started) * 1000))
+        del dtos
+
+
+@benchmark()
+def velocity(iterations: int = 20000, cards: int = 1000):
+    """
+    Per-check overhead of the CloudPayments velocity checker with a card and an IP rule, in-memory and on the
+    local memory cache, for `iterations` checks spread over `cards` cards.
+    """
+    from django.test import override_settings
+    from payment_gateway.tests import make_cloudpayments_dto
+    from payment_gateway.velocity import get_velocity_checker
+
+    rules = [{'key': 'card', 'limit': 1000, 'window': 60}, {'key': 'ip', 'limit': 1000, 'window': 60}]
+    transactions = [make_cloudpayments_dto(CardLastFour='%04d' % index, IpAddress='10.0.%d.%d' % divmod(index, 256))
+                    for index in range(cards)]
+    caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    for name, cache in (('memory', None), ('locmem cache', 'default')):
+        with override_settings(CACHES=caches, PAYMENT_GATEWAY_CLOUDPAYMENTS_VELOCITY_RULES=rules,
+                               PAYMENT_GATEWAY_CLOUDPAYMENTS_VELOCITY_CACHE=cache):
+            checker = get_velocity_checker()
+            started = time.perf_counter()
+            for index in range(iterations):
+                checker.check(transactions[index % cards], raise_exc=False)
+            print('%-15s %6.1fus/check' % (name, (time.perf_counter() - started) / iterations * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a payment_gateway benchmark on a throwaway test database.')
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--postgres', action='store_true',
+                        help='Run against PostgreSQL (POSTGRES_* environment variables) instead of SQLite.')
+    args = parser.parse_args()
+    func, needs_postgres = BENCHMARKS[args.name]
+    if needs_postgres and not args.postgres:
+        parser.error('%s needs --postgres.' % args.name)
+    configure(args.postgres)
+
+    from django.test.utils import setup_databases, teardown_databases
+
+    logging.disable(logging.CRITICAL)
+    databases = setup_databases(verbosity=0, interactive=False)
+    try:
+        func()
+    finally:
+        teardown_databases(databases, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
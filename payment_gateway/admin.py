@@ -1,6 +1,6 @@
 from django.contrib import admin
 from .models import Invoice, InvoiceStatusChange, Transaction, TransactionStatusChange, WalletOneTransaction, \
-    CloudPaymentsTransaction
+    CloudPaymentsTransaction, PendingCallback, ChangeLogConsumer
 
 
 class InvoiceStatusChangeInline(admin.TabularInline):
@@ -23,10 +23,12 @@ class TransactionInline(admin.TabularInline):
 
 class InvoiceAdmin(admin.ModelAdmin):
     inlines = (InvoiceStatusChangeInline, TransactionInline)
-    list_display = ('id', 'total', 'captured_total', 'status', 'created_at', 'expires_at', 'modified_at')
+    list_display = ('id', 'total', 'captured_total', 'status', 'attempts_count', 'failed_attempts_count',
+                    'last_transaction_at', 'created_at', 'expires_at', 'modified_at')
     list_per_page = 30
+    search_fields = ('=external_reference',)
     raw_id_fields = ('success_transaction',)
-    readonly_fields = ('created_at', 'modified_at')
+    readonly_fields = ('created_at', 'modified_at', 'attempts_count', 'failed_attempts_count', 'last_transaction_at')
 
 
 class TransactionStatusChangeInline(admin.TabularInline):
@@ -74,7 +76,21 @@ class TransactionAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at', 'modified_at')
 
 
+class PendingCallbackAdmin(admin.ModelAdmin):
+    list_display = ('id', 'invoice', 'callback', 'attempts', 'available_at', 'created_at')
+    list_per_page = 30
+    raw_id_fields = ('invoice',)
+    readonly_fields = ('created_at', 'last_error')
+
+
+class ChangeLogConsumerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'offset', 'updated_at')
+    readonly_fields = ('updated_at',)
+
+
 admin.site.register(Invoice, InvoiceAdmin)
 admin.site.register(Transaction, TransactionAdmin)
 admin.site.register(WalletOneTransaction, WalletOneTransactionAdmin)
 admin.site.register(CloudPaymentsTransaction, CloudPaymentsTransactionAdmin)
+admin.site.register(PendingCallback, PendingCallbackAdmin)
+admin.site.register(ChangeLogConsumer, ChangeLogConsumerAdmin)
@@ -1,24 +1,46 @@
 import importlib
 import logging
 from decimal import Decimal
+from enum import Enum
 
 from django.db import transaction as db_transaction
+from django.db.models import F, Q
 from django.utils import timezone
 
+from payment_gateway.changelog import make_invoice_change, make_transaction_change, record_changes
 from payment_gateway.dto import Transaction as TransactionDTO
 from payment_gateway.errors import InvalidMoneyAmount, InvoiceExpired, InvoiceAlreadyPaid, InvoiceInvalidStatus, \
     InsufficientMoneyAmount, PaymentError
+from payment_gateway.identity import get_invoice, get_invoice_for_update, resolve_invoice_id
 from payment_gateway.models import Transaction, InvoiceStatus, TransactionStatus, TransactionStatusChange, \
-    InvoiceStatusChange, Invoice
+    InvoiceStatusChange, Invoice, FAILED_TRANSACTION_STATUSES
+from payment_gateway.settings import api_settings
+from payment_gateway.tracing import span, traced
 
 logger = logging.getLogger(__name__)
 
 
+class ConcurrencyMode(str, Enum):
+    LOCK = 'lock'
+    OPTIMISTIC = 'optimistic'
+
+
+def get_concurrency_mode(provider_name: str) -> ConcurrencyMode:
+    return ConcurrencyMode(api_settings.CONCURRENCY_MODES.get(provider_name, ConcurrencyMode.LOCK))
+
+
+def uses_external_reference(provider_name: str) -> bool:
+    return provider_name in api_settings.EXTERNAL_REFERENCE_PROVIDERS
+
+
 class AbstractPaymentHandler(object):
 
     def try_process_payment(self, invoice: Invoice, transaction: Transaction) -> Invoice:
         raise NotImplementedError
 
+    def try_process_payment_optimistic(self, invoice: Invoice, transaction: Transaction) -> Invoice:
+        raise NotImplementedError
+
     def handle_payment_error(self, error: PaymentError, invoice: Invoice, transaction: Transaction, raise_exc: bool):
         raise NotImplementedError
 
@@ -31,6 +53,9 @@ class AbstractPaymentHandler(object):
     def validate_status_for_pay(self, invoice: Invoice, raise_exc: bool = True) -> bool:
         raise NotImplementedError
 
+    def settle_invoices(self, invoice_ids: list, transaction: Transaction) -> list:
+        raise NotImplementedError
+
     def on_success(self, invoice: Invoice, *args, **kwargs) -> Invoice:
         raise NotImplementedError
 
@@ -71,16 +96,53 @@ class AbstractCallbackProvider(object):
 
 
 class AbstractPaymentProvider(object):
-    def __init__(self, payment_handler: AbstractPaymentHandler, transaction_handler: AbstractTransactionHandler):
+    def __init__(self, payment_handler: AbstractPaymentHandler, transaction_handler: AbstractTransactionHandler,
+                 concurrency_mode: ConcurrencyMode = ConcurrencyMode.LOCK, external_reference: bool = False):
         self.payment_handler = payment_handler
         self.transaction_handler = transaction_handler
+        self.concurrency_mode = concurrency_mode
+        self.external_reference = external_reference
 
     def pay(self, invoice_id: int, transaction_data: object) -> (Invoice, Transaction):
         raise NotImplementedError
 
+    def resolve_invoice_id(self, reference) -> int:
+        return resolve_invoice_id(reference, self.external_reference)
+
+    def get_invoice_reference(self, invoice: Invoice) -> str:
+        return invoice.external_reference if self.external_reference else str(invoice.pk)
+
+    def get_invoice_for_payment(self, invoice_id: int) -> Invoice:
+        if self.concurrency_mode == ConcurrencyMode.OPTIMISTIC:
+            return get_invoice(invoice_id)
+        with span('lock_invoice', invoice_id=invoice_id):
+            return get_invoice_for_update(invoice_id)
+
+    def process_payment(self, invoice: Invoice, transaction: Transaction) -> Invoice:
+        if self.concurrency_mode == ConcurrencyMode.OPTIMISTIC:
+            return self.payment_handler.try_process_payment_optimistic(invoice, transaction)
+        return self.payment_handler.try_process_payment(invoice, transaction)
+
+    @traced
+    def settle(self, invoice_ids: list, transaction: Transaction) -> (list, Transaction):
+        """
+        Pays several invoices with one transaction, the invoices are locked regardless of the concurrency mode.
+        """
+        try:
+            with db_transaction.atomic():
+                invoices = self.payment_handler.settle_invoices(invoice_ids, transaction)
+                logger.info('Settled invoices.', extra={'invoice_ids': [invoice.pk for invoice in invoices],
+                                                        'transaction_id': transaction.id})
+                return invoices, transaction
+        except PaymentError as e:
+            logger.warning('Settlement error.', exc_info=True, extra={'invoice_ids': list(invoice_ids),
+                                                                      'transaction_id': transaction.id})
+            self.payment_handler.handle_settlement_error(e, transaction, raise_exc=True)
+
 
 class BasicCallbackProvider(AbstractCallbackProvider):
 
+    @traced
     def success(self, invoice, *args, **kwargs):
         logger.info('Calling success callback for invoice.', extra={'invoice_id': invoice.pk,
                                                                     'callback': invoice.success_callback})
@@ -92,6 +154,7 @@ class BasicCallbackProvider(AbstractCallbackProvider):
                                                                     'callback': invoice.success_callback})
         return invoice
 
+    @traced
     def fail(self, invoice, *args, **kwargs):
         logger.info('Calling fail callback for invoice.', extra={'invoice_id': invoice.pk,
                                                                  'callback': invoice.fail_callback})
@@ -106,13 +169,24 @@ class BasicCallbackProvider(AbstractCallbackProvider):
 
 
 class BasicTransactionHandler(AbstractTransactionHandler):
+    @traced
+    @db_transaction.atomic()
     def create(self, transaction: TransactionDTO):
-        return Transaction.objects.create(
+        t = Transaction.objects.create(
             invoice_id=transaction.invoice_id,
             money_amount=transaction.money_amount,
             type=transaction.type,
             status=TransactionStatus.PENDING
         )
+        self.track_attempt(t)
+        return t
+
+    def track_attempt(self, transaction: Transaction):
+        Invoice.objects.filter(pk=transaction.invoice_id).update(attempts_count=F('attempts_count') + 1,
+                                                                 last_transaction_at=transaction.created_at)
+
+    def track_failed_attempt(self, transaction: Transaction):
+        Invoice.objects.filter(pk=transaction.invoice_id).update(failed_attempts_count=F('failed_attempts_count') + 1)
 
     def set_expired(self, transaction: Transaction):
         return self.update_transaction_status(transaction, TransactionStatus.INVOICE_EXPIRED)
@@ -129,6 +203,7 @@ class BasicTransactionHandler(AbstractTransactionHandler):
     def set_declined(self, transaction: Transaction):
         return self.update_transaction_status(transaction, TransactionStatus.DECLINED)
 
+    @traced
     @db_transaction.atomic()
     def update_transaction_status(self, transaction: Transaction, status: TransactionStatus) -> Transaction:
         prev_status = transaction.status
@@ -139,6 +214,9 @@ class BasicTransactionHandler(AbstractTransactionHandler):
             from_status=prev_status,
             to_status=transaction.status
         )
+        record_changes([make_transaction_change(transaction, prev_status, transaction.status)])
+        if status in FAILED_TRANSACTION_STATUSES and prev_status not in FAILED_TRANSACTION_STATUSES:
+            self.track_failed_attempt(transaction)
         return transaction
 
 
@@ -148,6 +226,7 @@ class BasicPaymentHandler(AbstractPaymentHandler):
         self.callback_provider = callback_provider
         self.transaction_handler = transaction_handler
 
+    @traced
     def try_process_payment(self, invoice: Invoice, transaction: Transaction) -> Invoice:
         assert db_transaction.get_connection().in_atomic_block
 
@@ -155,6 +234,32 @@ class BasicPaymentHandler(AbstractPaymentHandler):
         invoice = self.make_invoice_success(invoice, transaction)
         return self.on_success(invoice)
 
+    @traced
+    def try_process_payment_optimistic(self, invoice: Invoice, transaction: Transaction) -> Invoice:
+        assert db_transaction.get_connection().in_atomic_block
+
+        with db_transaction.atomic():
+            if not self.claim_invoice(invoice, transaction):
+                invoice.refresh_from_db()
+                if invoice.success_transaction_id == transaction.pk:
+                    # A concurrent delivery of the same notification claimed the invoice with this transaction.
+                    return invoice
+                self.validate_payment(invoice, transaction, raise_exc=True)
+                raise InvoiceInvalidStatus()
+            self.validate_payment(invoice, transaction, raise_exc=True)
+            invoice = self.make_claimed_invoice_success(invoice, transaction)
+        return self.on_success(invoice)
+
+    @traced
+    def claim_invoice(self, invoice: Invoice, transaction: Transaction) -> bool:
+        now = timezone.now()
+        claimed = Invoice.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=now),
+            pk=invoice.pk, status=InvoiceStatus.PENDING, total__lte=transaction.money_amount
+        ).update(status=InvoiceStatus.PAID, success_transaction_id=transaction.pk,
+                 captured_total=transaction.money_amount, modified_at=now)
+        return claimed == 1
+
     def handle_payment_error(self, error: PaymentError, invoice: Invoice, transaction: Transaction,
                              raise_exc: bool = False):
         if isinstance(error, (InvalidMoneyAmount, InsufficientMoneyAmount)):
@@ -169,11 +274,65 @@ class BasicPaymentHandler(AbstractPaymentHandler):
             raise error
         return invoice, transaction
 
+    def handle_settlement_error(self, error: PaymentError, transaction: Transaction, raise_exc: bool = False):
+        if isinstance(error, InvoiceExpired):
+            self.transaction_handler.set_expired(transaction)
+            if raise_exc:
+                raise error
+            return transaction
+        return self.handle_payment_error(error, None, transaction, raise_exc=raise_exc)[1]
+
+    @traced
+    def settle_invoices(self, invoice_ids: list, transaction: Transaction) -> list:
+        """
+        Locks the invoices in primary key order, so that overlapping settlements and single payments queue up
+        instead of deadlocking, checks that the transaction covers their sum and marks all of them paid.
+        """
+        assert db_transaction.get_connection().in_atomic_block
+
+        invoice_ids = {Invoice._meta.pk.to_python(invoice_id) for invoice_id in invoice_ids}
+        with span('lock_invoices', count=len(invoice_ids)):
+            invoices = list(Invoice.objects.select_for_update().filter(pk__in=invoice_ids).order_by('pk'))
+        if len(invoices) != len(invoice_ids):
+            raise Invoice.DoesNotExist('Invoice matching query does not exist.')
+        for invoice in invoices:
+            self.validate_status_for_pay(invoice, raise_exc=True)
+            self.validate_expiration(invoice, raise_exc=True)
+        self.validate_money_amount_sum(invoices, transaction.money_amount, raise_exc=True)
+        invoices = self.make_invoices_success(invoices, transaction)
+        for invoice in invoices:
+            self.on_success(invoice)
+        return invoices
+
+    @traced
+    @db_transaction.atomic()
+    def make_invoices_success(self, invoices: list, transaction: Transaction) -> list:
+        transaction = self.transaction_handler.set_success(transaction)
+        now = timezone.now()
+        pks = [invoice.pk for invoice in invoices]
+        Invoice.objects.filter(pk__in=pks).update(status=InvoiceStatus.PAID, success_transaction=transaction,
+                                                  captured_total=F('total'), modified_at=now)
+        Invoice.objects.filter(pk__in=pks).exclude(pk=transaction.invoice_id).update(
+            attempts_count=F('attempts_count') + 1, last_transaction_at=transaction.created_at)
+        history = []
+        changes = []
+        for invoice in invoices:
+            invoice, old_status = self.set_invoice_status(invoice, InvoiceStatus.PAID)
+            invoice.success_transaction = transaction
+            invoice.captured_total = invoice.total
+            invoice.modified_at = now
+            history.append(InvoiceStatusChange(invoice=invoice, from_status=old_status, to_status=invoice.status))
+            changes.append(make_invoice_change(invoice, old_status, invoice.status))
+        InvoiceStatusChange.objects.bulk_create(history)
+        record_changes(changes)
+        return invoices
+
     def set_invoice_status(self, invoice: Invoice, status: InvoiceStatus) -> (Invoice, InvoiceStatus):
         old_status = invoice.status
         invoice.status = status
         return invoice, old_status
 
+    @traced
     @db_transaction.atomic()
     def make_invoice_success(self, invoice: Invoice, transaction: Transaction) -> Invoice:
         transaction = self.transaction_handler.set_success(transaction)
@@ -184,6 +343,17 @@ class BasicPaymentHandler(AbstractPaymentHandler):
         self.write_invoice_history(invoice, new_status=invoice.status, old_status=old_status)
         return invoice
 
+    @traced
+    @db_transaction.atomic()
+    def make_claimed_invoice_success(self, invoice: Invoice, transaction: Transaction) -> Invoice:
+        transaction = self.transaction_handler.set_success(transaction)
+        invoice.success_transaction = transaction
+        invoice.captured_total = transaction.money_amount
+        invoice, old_status = self.set_invoice_status(invoice, InvoiceStatus.PAID)
+        self.write_invoice_history(invoice, new_status=invoice.status, old_status=old_status)
+        return invoice
+
+    @traced
     @db_transaction.atomic()
     def make_invoice_expired(self, invoice: Invoice, transaction: Transaction) -> Invoice:
         self.transaction_handler.set_expired(transaction)
@@ -194,12 +364,14 @@ class BasicPaymentHandler(AbstractPaymentHandler):
         return invoice
 
     def write_invoice_history(self, invoice: Invoice, new_status: int, old_status: int) -> InvoiceStatusChange:
+        record_changes([make_invoice_change(invoice, old_status, new_status)])
         return InvoiceStatusChange.objects.create(
             invoice=invoice,
             from_status=old_status,
             to_status=new_status
         )
 
+    @traced
     def validate_payment(self, invoice: Invoice, transaction: Transaction, raise_exc: bool = True) -> bool:
         valid = True
         valid = valid and self.validate_status_for_pay(invoice, raise_exc=raise_exc)
@@ -215,6 +387,13 @@ class BasicPaymentHandler(AbstractPaymentHandler):
             raise InvalidMoneyAmount()
         return valid
 
+    def validate_money_amount_sum(self, invoices: list, money_amount: Decimal, raise_exc: bool = True) -> bool:
+        total = sum((invoice.total for invoice in invoices), Decimal('0'))
+        valid = total <= money_amount
+        if not valid and raise_exc:
+            raise InsufficientMoneyAmount()
+        return valid
+
     def validate_expiration(self, invoice: Invoice, raise_exc: bool = True) -> bool:
         if invoice.expires_at is None:
             return True
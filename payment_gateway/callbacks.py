@@ -0,0 +1,145 @@
+import importlib
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import connection, transaction as db_transaction
+from django.utils import timezone
+
+from payment_gateway.base import BasicCallbackProvider
+from payment_gateway.models import PendingCallback
+from payment_gateway.routers import primary_pin_scope
+from payment_gateway.settings import api_settings
+from payment_gateway.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+
+def get_callback_provider():
+    if api_settings.BATCHED_CALLBACKS:
+        return BatchedCallbackProvider()
+    return BasicCallbackProvider()
+
+
+def import_callback(path: str):
+    mod_name, func_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(mod_name), func_name)
+
+
+class CallbackBatcher(object):
+    """
+    Flushes pending callbacks `window` seconds after the first payment of a batch, or right away once
+    `max_batch_size` payments are waiting.
+    """
+
+    def __init__(self, window: float, max_batch_size: int):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._waiting = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def notify(self):
+        with self._lock:
+            self._waiting += 1
+            if self._waiting >= self.max_batch_size:
+                self._schedule(0)
+            elif self._timer is None:
+                self._schedule(self.window)
+
+    def _schedule(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._waiting = 0
+            self._timer = None
+        try:
+            flush_pending_callbacks(self.max_batch_size)
+        except Exception:
+            logger.exception('Flushing pending callbacks failed.')
+        finally:
+            connection.close()
+
+
+class BatchedCallbackProvider(BasicCallbackProvider):
+    """
+    Queues success callbacks as PendingCallback rows in the payment transaction; they are delivered in batches
+    by CallbackBatcher and the flush_callbacks command, which also retries failed ids.
+    """
+
+    def __init__(self, batcher: CallbackBatcher = None):
+        self.batcher = batcher or CallbackBatcher(api_settings.CALLBACK_BATCH_WINDOW, api_settings.CALLBACK_BATCH_SIZE)
+
+    @traced
+    def success(self, invoice, *args, **kwargs):
+        PendingCallback.objects.create(invoice=invoice, callback=invoice.success_callback)
+        logger.info('Queued success callback for invoice.', extra={'invoice_id': invoice.pk,
+                                                                   'callback': invoice.success_callback})
+        db_transaction.on_commit(self.batcher.notify)
+        return invoice
+
+
+def deliver_callbacks(callback: str, invoice_ids: list) -> dict:
+    """
+    Calls `callback` with the list of invoice ids. The callable returns None when every id was handled, or the
+    failed ids, optionally as a mapping to the error. Returns the failures as {invoice_id: error}, every id failed
+    when the callable raises or returns anything else. The callable runs in a savepoint, so a database error
+    in it does not break the caller's transaction.
+    """
+    try:
+        with db_transaction.atomic():
+            result = import_callback(callback)(invoice_ids)
+        failures = dict(result) if isinstance(result, dict) else dict.fromkeys(() if result is None else result, '')
+    except Exception as e:
+        logger.warning('Batched callback failed.', exc_info=True, extra={'callback': callback})
+        return {invoice_id: repr(e) for invoice_id in invoice_ids}
+    if not failures.keys() <= set(invoice_ids):
+        logger.warning('Batched callback returned unknown invoice ids.', extra={'callback': callback})
+        return {invoice_id: 'Invalid result %r' % (result,) for invoice_id in invoice_ids}
+    return {invoice_id: str(error) for invoice_id, error in failures.items()}
+
+
+@primary_pin_scope()
+def flush_pending_callbacks(batch_size: int = None) -> (int, int):
+    """
+    Delivers due pending callbacks grouped by callback path. Rows stay locked until they are deleted or
+    rescheduled, so a crash in between delivers them again: callables must be idempotent.
+    """
+    batch_size = batch_size or api_settings.CALLBACK_BATCH_SIZE
+    delivered = failed = last_pk = 0
+    while True:
+        with db_transaction.atomic():
+            pending = list(PendingCallback.objects.select_for_update(skip_locked=True)
+                           .filter(pk__gt=last_pk, available_at__lte=timezone.now()).order_by('pk')[:batch_size])
+            if pending:
+                last_pk = pending[-1].pk
+            by_callback = defaultdict(list)
+            for entry in pending:
+                by_callback[entry.callback].append(entry)
+            for callback, entries in by_callback.items():
+                invoice_ids = list(dict.fromkeys(entry.invoice_id for entry in entries))
+                failures = deliver_callbacks(callback, invoice_ids)
+                retry = [entry for entry in entries if entry.invoice_id in failures]
+                for entry in retry:
+                    reschedule(entry, failures[entry.invoice_id])
+                PendingCallback.objects.filter(pk__in=[e.pk for e in entries if e.invoice_id not in failures]) \
+                    .delete()
+                delivered += len(entries) - len(retry)
+                failed += len(retry)
+                logger.info('Delivered batched callbacks.', extra={'callback': callback, 'count': len(invoice_ids),
+                                                                   'failed': len(retry)})
+        if len(pending) < batch_size:
+            return delivered, failed
+
+
+def reschedule(entry: PendingCallback, error: str):
+    entry.attempts += 1
+    entry.last_error = error
+    entry.available_at = timezone.now() + timedelta(seconds=api_settings.CALLBACK_RETRY_DELAY * entry.attempts)
+    entry.save(update_fields=['attempts', 'last_error', 'available_at'])
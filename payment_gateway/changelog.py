@@ -0,0 +1,149 @@
+import logging
+from datetime import timedelta
+
+from django.db import connections, router, transaction as db_transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from payment_gateway.models import ChangeLogConsumer, ChangeLogEntity, ChangeLogEntry, Invoice, Transaction
+from payment_gateway.settings import api_settings
+
+logger = logging.getLogger(__name__)
+
+# Key of the PostgreSQL advisory lock held while offsets are assigned.
+SEQUENCER_LOCK_KEY = 0x7061796c6f67
+
+
+def make_invoice_change(invoice: Invoice, from_status: int, to_status: int) -> ChangeLogEntry:
+    return ChangeLogEntry(entity=ChangeLogEntity.INVOICE, object_id=invoice.pk, invoice_id=invoice.pk,
+                          from_status=from_status, to_status=to_status)
+
+
+def make_transaction_change(transaction: Transaction, from_status: int, to_status: int) -> ChangeLogEntry:
+    return ChangeLogEntry(entity=ChangeLogEntity.TRANSACTION, object_id=transaction.pk,
+                          invoice_id=transaction.invoice_id, from_status=from_status, to_status=to_status)
+
+
+def record_changes(entries: list) -> list:
+    """
+    Appends the entries in the caller's transaction with a single insert, they get their offset from
+    sequence_changes once committed. Does nothing unless PAYMENT_GATEWAY_CHANGE_LOG is enabled.
+    """
+    if not api_settings.CHANGE_LOG or not entries:
+        return []
+    return ChangeLogEntry.objects.bulk_create(entries)
+
+
+def sequence_changes(batch_size: int = None) -> int:
+    """
+    Assigns consecutive offsets to committed entries in insertion order. Offsets are handed out after commit
+    rather than on insert, so a consumer that has read up to an offset never misses an entry committed later
+    with a lower primary key. Returns the number of sequenced entries.
+    """
+    batch_size = batch_size or api_settings.CHANGE_LOG_BATCH_SIZE
+    using = router.db_for_write(ChangeLogEntry)
+    sequence = sequence_changes_postgresql if connections[using].vendor == 'postgresql' else sequence_changes_batch
+    sequenced = 0
+    while True:
+        with db_transaction.atomic(using=using):
+            count = sequence(using, batch_size)
+        sequenced += count
+        if count < batch_size:
+            break
+    return sequenced
+
+
+def sequence_changes_batch(using: str, batch_size: int) -> int:
+    # Without a lock concurrent sequencers hit the unique offset and roll back instead of duplicating offsets.
+    entries = list(ChangeLogEntry.objects.using(using).filter(offset__isnull=True).order_by('pk')[:batch_size])
+    if not entries:
+        return 0
+    last = ChangeLogEntry.objects.using(using).aggregate(last=Max('offset'))['last'] or 0
+    for offset, entry in enumerate(entries, last + 1):
+        entry.offset = offset
+    ChangeLogEntry.objects.using(using).bulk_update(entries, ['offset'])
+    return len(entries)
+
+
+def sequence_changes_postgresql(using: str, batch_size: int) -> int:
+    # One statement per batch, Django's bulk_update builds a CASE over every row and is 20 times slower.
+    table = connections[using].ops.quote_name(ChangeLogEntry._meta.db_table)
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [SEQUENCER_LOCK_KEY])
+        cursor.execute(
+            'UPDATE {table} SET "offset" = pending.offset FROM ('
+            ' SELECT id, (SELECT COALESCE(MAX("offset"), 0) FROM {table}) + row_number() OVER (ORDER BY id) AS offset'
+            ' FROM (SELECT id FROM {table} WHERE "offset" IS NULL ORDER BY id LIMIT %s) AS batch'
+            ') AS pending WHERE {table}.id = pending.id'.format(table=table), [batch_size])
+        return cursor.rowcount
+
+
+def read_changes(after: int = 0, batch_size: int = None) -> list:
+    batch_size = batch_size or api_settings.CHANGE_LOG_BATCH_SIZE
+    return list(ChangeLogEntry.objects.filter(offset__gt=after).order_by('offset')[:batch_size])
+
+
+def get_checkpoint(name: str) -> int:
+    return ChangeLogConsumer.objects.filter(name=name).values_list('offset', flat=True).first() or 0
+
+
+def commit_checkpoint(name: str, offset: int):
+    ChangeLogConsumer.objects.update_or_create(name=name, defaults={'offset': offset})
+
+
+def consume_changes(name: str, handler, batch_size: int = None) -> int:
+    """
+    Sequences pending entries and calls `handler` with the batches after the checkpoint of consumer `name`,
+    committing the checkpoint after every batch. A batch whose handler fails is delivered again on the next
+    call, so handlers must be idempotent. Returns the number of consumed entries.
+    """
+    batch_size = batch_size or api_settings.CHANGE_LOG_BATCH_SIZE
+    sequence_changes(batch_size)
+    offset = get_checkpoint(name)
+    consumed = 0
+    while True:
+        entries = read_changes(offset, batch_size)
+        if not entries:
+            break
+        if entries[0].offset != offset + 1:
+            logger.warning('Change log consumer missed pruned entries.',
+                           extra={'consumer': name, 'checkpoint': offset, 'first_offset': entries[0].offset})
+        handler(entries)
+        offset = entries[-1].offset
+        commit_checkpoint(name, offset)
+        consumed += len(entries)
+        if len(entries) < batch_size:
+            break
+    return consumed
+
+
+def get_consumer_lags() -> dict:
+    last = ChangeLogEntry.objects.aggregate(last=Max('offset'))['last'] or 0
+    return {name: max(last - offset, 0) for name, offset in ChangeLogConsumer.objects.values_list('name', 'offset')}
+
+
+def prune_changes(retention: float = None, segment_size: int = None) -> int:
+    """
+    Deletes the log in segments of `segment_size` offsets, oldest first, as long as the last entry of a segment
+    is older than `retention` seconds. Every segment is one indexed range delete. The last sequenced entry is
+    always kept, so offsets never restart. Returns the number of deleted entries.
+    """
+    retention = api_settings.CHANGE_LOG_RETENTION if retention is None else retention
+    segment_size = segment_size or api_settings.CHANGE_LOG_SEGMENT_SIZE
+    cutoff = timezone.now() - timedelta(seconds=retention)
+    bounds = ChangeLogEntry.objects.aggregate(first=Min('offset'), last=Max('offset'))
+    if bounds['first'] is None:
+        return 0
+    deleted = 0
+    first = bounds['first']
+    end = (first // segment_size + 1) * segment_size
+    while end <= bounds['last']:
+        newest = ChangeLogEntry.objects.filter(offset__lt=end).order_by('-offset').values_list('created_at', flat=True)
+        if newest.first() >= cutoff:
+            break
+        deleted += ChangeLogEntry.objects.filter(offset__lt=end).delete()[0]
+        first, end = end, end + segment_size
+    for name in ChangeLogConsumer.objects.filter(offset__lt=first - 1).values_list('name', flat=True):
+        logger.warning('Change log consumer is behind the retained log.',
+                       extra={'consumer': name, 'first_offset': first})
+    return deleted
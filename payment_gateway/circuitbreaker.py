@@ -0,0 +1,164 @@
+import functools
+import logging
+import threading
+import time
+from collections import deque, Counter
+from enum import Enum
+
+from django.core.signals import setting_changed
+from django.db import DatabaseError
+
+from payment_gateway.errors import CircuitOpen
+from payment_gateway.settings import api_settings
+from payment_gateway.signals import circuit_breaker_state_changed
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitState(str, Enum):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Trips when the share of failed or slow calls among the last `window` calls reaches `error_rate` or
+    `slow_rate`. While open, calls fail fast with CircuitOpen; after `cooldown` seconds up to `probes` calls are
+    let through and the circuit closes once all of them succeed.
+    """
+
+    def __init__(self, name: str, window: int = 50, min_calls: int = 20, error_rate: float = 0.5,
+                 slow_call_duration: float = 2.0, slow_rate: float = 0.8, cooldown: float = 10.0, probes: int = 3):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_rate = slow_rate
+        self.cooldown = cooldown
+        self.probes = probes
+        self.state = CircuitState.CLOSED
+        self.transitions = Counter()
+        self.rejected = 0
+        self._calls = deque(maxlen=window)
+        self._opened_at = 0
+        self._probes_started = 0
+        self._probes_succeeded = 0
+        self._lock = threading.RLock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CircuitState.OPEN:
+                if time.monotonic() - self._opened_at < self.cooldown:
+                    self.rejected += 1
+                    return False
+                self._transition(CircuitState.HALF_OPEN)
+            if self.state == CircuitState.HALF_OPEN:
+                if self._probes_started >= self.probes:
+                    self.rejected += 1
+                    return False
+                self._probes_started += 1
+            return True
+
+    def record(self, duration: float, failed: bool):
+        slow = duration >= self.slow_call_duration
+        with self._lock:
+            if self.state == CircuitState.HALF_OPEN:
+                if failed or slow:
+                    self._transition(CircuitState.OPEN)
+                else:
+                    self._probes_succeeded += 1
+                    if self._probes_succeeded >= self.probes:
+                        self._transition(CircuitState.CLOSED)
+                return
+            if self.state == CircuitState.OPEN:
+                return
+            self._calls.append((failed, slow))
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for call in self._calls if call[0])
+            slow_calls = sum(1 for call in self._calls if call[1])
+            if failures >= self.error_rate * len(self._calls) or slow_calls >= self.slow_rate * len(self._calls):
+                self._transition(CircuitState.OPEN)
+
+    def _transition(self, state: CircuitState):
+        old_state = self.state
+        self.state = state
+        self.transitions[state] += 1
+        self._calls.clear()
+        self._probes_started = 0
+        self._probes_succeeded = 0
+        if state == CircuitState.OPEN:
+            self._opened_at = time.monotonic()
+        logger.warning('Circuit breaker changed state.',
+                       extra={'circuit_breaker': self.name, 'from_state': old_state, 'to_state': state})
+        circuit_breaker_state_changed.send(sender=self.__class__, name=self.name, old_state=old_state,
+                                           new_state=state)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state.value,
+                'rejected': self.rejected,
+                'transitions': {state.value: self.transitions[state] for state in CircuitState},
+            }
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpen()
+        started_at = time.monotonic()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except DatabaseError:
+            failed = True
+            raise
+        finally:
+            self.record(time.monotonic() - started_at, failed)
+
+    def guard(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        return wrapper
+
+
+_UNRESOLVED = object()
+_database_circuit_breaker = _UNRESOLVED
+_database_circuit_breaker_lock = threading.Lock()
+
+
+def get_database_circuit_breaker() -> CircuitBreaker:
+    """
+    The breaker is built from PAYMENT_GATEWAY_DATABASE_CIRCUIT_BREAKER, a dict of CircuitBreaker arguments, on
+    first use and rebuilt, closed, after the setting changes. Without the setting there is no breaker.
+    """
+    global _database_circuit_breaker
+    breaker = _database_circuit_breaker
+    if breaker is _UNRESOLVED:
+        with _database_circuit_breaker_lock:
+            breaker = _database_circuit_breaker
+            if breaker is _UNRESOLVED:
+                config = api_settings.DATABASE_CIRCUIT_BREAKER
+                breaker = _database_circuit_breaker = CircuitBreaker('database', **config) \
+                    if config is not None else None
+    return breaker
+
+
+def reset_database_circuit_breaker(*args, **kwargs):
+    global _database_circuit_breaker
+    if kwargs.get('setting', 'PAYMENT_GATEWAY').startswith('PAYMENT_GATEWAY'):
+        _database_circuit_breaker = _UNRESOLVED
+
+
+setting_changed.connect(reset_database_circuit_breaker)
+
+
+def guard_database(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        breaker = get_database_circuit_breaker()
+        if breaker is None:
+            return func(*args, **kwargs)
+        return breaker.call(func, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,118 @@
+import base64
+import http.client
+import json
+import logging
+import queue
+import time
+import uuid
+from decimal import Decimal
+from urllib.parse import urlsplit
+
+from django.core.serializers.json import DjangoJSONEncoder
+from payment_gateway.settings import api_settings
+
+logger = logging.getLogger(__name__)
+
+
+class CloudPaymentsAPIError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ConnectionPool(object):
+    def __init__(self, url: str, size: int, timeout: float):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self._connections = queue.LifoQueue(maxsize=size)
+
+    def acquire(self) -> http.client.HTTPConnection:
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def release(self, connection: http.client.HTTPConnection):
+        try:
+            self._connections.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def discard(self, connection: http.client.HTTPConnection):
+        connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class CloudPaymentsClient(object):
+    def __init__(self, public_id: str = None, api_secret: str = None, api_url: str = None, timeout: float = None,
+                 max_retries: int = None, backoff: float = None, pool_size: int = None):
+        public_id = public_id or api_settings.CLOUDPAYMENTS_PUBLIC_ID
+        api_secret = api_secret or api_settings.CLOUDPAYMENTS_API_SECRET
+        api_url = api_url or api_settings.CLOUDPAYMENTS_API_URL
+        credentials = base64.b64encode(('%s:%s' % (public_id, api_secret)).encode('utf-8')).decode()
+        self.authorization = 'Basic %s' % credentials
+        self.base_path = urlsplit(api_url).path.rstrip('/')
+        self.max_retries = api_settings.CLOUDPAYMENTS_API_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = api_settings.CLOUDPAYMENTS_API_BACKOFF if backoff is None else backoff
+        self.pool = ConnectionPool(api_url, size=pool_size or api_settings.CLOUDPAYMENTS_API_POOL_SIZE,
+                                   timeout=timeout or api_settings.CLOUDPAYMENTS_API_TIMEOUT)
+
+    def request(self, path: str, payload: dict) -> dict:
+        body = json.dumps(payload, cls=DjangoJSONEncoder).encode('utf-8')
+        # The same X-Request-ID is sent on every retry so CloudPayments never executes a request twice.
+        headers = {'Authorization': self.authorization, 'Content-Type': 'application/json',
+                   'X-Request-ID': uuid.uuid4().hex}
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            connection = self.pool.acquire()
+            try:
+                connection.request('POST', self.base_path + path, body=body, headers=headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                self.pool.discard(connection)
+                logger.warning('Cloudpayments API request failed.', exc_info=True,
+                               extra={'path': path, 'attempt': attempt})
+                error = e
+                continue
+            if response.will_close:
+                self.pool.discard(connection)
+            else:
+                self.pool.release(connection)
+            if response.status >= 500:
+                logger.warning('Cloudpayments API server error.',
+                               extra={'path': path, 'attempt': attempt, 'status': response.status})
+                error = CloudPaymentsAPIError('Cloudpayments API server error.', status=response.status)
+                continue
+            if response.status != 200:
+                raise CloudPaymentsAPIError('Cloudpayments API request rejected.', status=response.status)
+            return json.loads(content.decode('utf-8'), parse_float=Decimal)
+        raise CloudPaymentsAPIError('Cloudpayments API request failed after %s attempts.' % (self.max_retries + 1)) \
+            from error
+
+    def charge_token(self, amount: Decimal, currency: str, account_id: str, token: str, invoice_id: str = None,
+                     description: str = None, email: str = None, json_data: dict = None) -> dict:
+        payload = {'Amount': amount, 'Currency': currency, 'AccountId': account_id, 'Token': token}
+        if invoice_id is not None:
+            payload['InvoiceId'] = invoice_id
+        if description is not None:
+            payload['Description'] = description
+        if email is not None:
+            payload['Email'] = email
+        if json_data is not None:
+            payload['JsonData'] = json_data
+        return self.request('/payments/tokens/charge', payload)
+
+    def close(self):
+        self.pool.close()
@@ -2,36 +2,39 @@ import base64
 import hashlib
 import hmac
 import logging
-from dataclasses import dataclass
 from datetime import datetime
 from decimal import Decimal
 from enum import IntEnum
 
 from django.db import transaction as db_transaction
 from django.utils.crypto import constant_time_compare
-from payment_gateway.base import AbstractPaymentProvider, BasicTransactionHandler, BasicCallbackProvider, \
-    BasicPaymentHandler
-from payment_gateway.dto import Transaction as TransactionDTOBase
+from payment_gateway.base import AbstractPaymentProvider, BasicTransactionHandler, \
+    BasicPaymentHandler, get_concurrency_mode, uses_external_reference
+from payment_gateway.callbacks import get_callback_provider
+from payment_gateway.circuitbreaker import guard_database
+from payment_gateway.dto import Transaction as TransactionDTOBase, slotted_dataclass, to_model_kwargs
 from payment_gateway.errors import PaymentError, InvoiceExpired, InvalidMoneyAmount, InsufficientMoneyAmount, \
-    InvoiceAlreadyPaid, InvoiceInvalidStatus, InvalidCurrency
-from payment_gateway.models import Invoice, Transaction, CloudPaymentsTransaction, TransactionStatus, TransactionType
+    InvoiceAlreadyPaid, InvoiceInvalidStatus, InvalidCurrency, VelocityLimitExceeded
+from payment_gateway.identity import invoice_exists, lock_block
+from payment_gateway.models import Invoice, Transaction, CloudPaymentsTransaction, TransactionStatus
 from payment_gateway.settings import api_settings
+from payment_gateway.tracing import traced
+from payment_gateway.velocity import get_velocity_checker
 
 logger = logging.getLogger(__name__)
 
 
 def get_cloudpayments_provider():
     transaction_handler = CloudPaymentsTransactionHandler()
-    callback_provider = BasicCallbackProvider()
+    callback_provider = get_callback_provider()
     payment_handler = CloudPaymentsPaymentHandler(callback_provider, transaction_handler)
-    return CloudPaymentsPaymentProvider(payment_handler, transaction_handler)
+    return CloudPaymentsPaymentProvider(payment_handler, transaction_handler, get_concurrency_mode('cloudpayments'),
+                                        uses_external_reference('cloudpayments'))
 
 
 class CloudPaymentsTransactionHandler(BasicTransactionHandler):
-    @dataclass
+    @slotted_dataclass
     class TransactionDTO(TransactionDTOBase):
-        type = TransactionType.CLOUDPAYMENTS
-
         TransactionId: int
         Amount: Decimal
         Currency: str
@@ -64,32 +67,43 @@ class CloudPaymentsTransactionHandler(BasicTransactionHandler):
         Token: str = None
         TotalFee: Decimal = None
 
+    @traced
     def create(self, t: TransactionDTO):
         with db_transaction.atomic():
-            wt = CloudPaymentsTransaction.objects.create(
-                invoice_id=t.invoice_id, money_amount=t.money_amount, type=t.type, status=TransactionStatus.PENDING,
-                TransactionId=t.TransactionId, Amount=t.Amount, Currency=t.Currency, DateTime=t.DateTime,
-                CardFirstSix=t.CardFirstSix, CardLastFour=t.CardLastFour, CardType=t.CardType,
-                CardExpDate=t.CardExpDate, TestMode=t.TestMode, Status=t.Status, OperationType=t.OperationType,
-                AccountId=t.AccountId, SubscriptionId=t.SubscriptionId, TokenRecipient=t.TokenRecipient, Name=t.Name,
-                Email=t.Email, IpAddress=t.IpAddress, IpCountry=t.IpCountry, IpCity=t.IpCity, IpRegion=t.IpRegion,
-                IpDistrict=t.IpDistrict, Issuer=t.Issuer, IssuerBankCountry=t.IssuerBankCountry,
-                Description=t.Description, Data=t.Data
-            )
+            wt = CloudPaymentsTransaction.objects.create(status=TransactionStatus.PENDING,
+                                                         **to_model_kwargs(t, CloudPaymentsTransaction))
+            self.track_attempt(wt)
         return wt
 
 
 class CloudPaymentsPaymentHandler(BasicPaymentHandler):
     valid_currencies = api_settings.CLOUDPAYMENTS_VALID_CURRENCIES
 
-    def validate_payment(self, invoice: Invoice, transaction: CloudPaymentsTransaction, raise_exc: bool = True) -> bool:
+    @traced
+    def validate_payment(self, invoice: Invoice, transaction: CloudPaymentsTransaction, raise_exc: bool = True,
+                         check: bool = False) -> bool:
         valid = True
         valid = valid and self.validate_status_for_pay(invoice, raise_exc=raise_exc)
         valid = valid and self.validate_expiration(invoice, raise_exc=raise_exc)
         valid = valid and self.validate_money_amount(invoice, transaction.money_amount, raise_exc=raise_exc)
         valid = valid and self.validate_currency(transaction.Currency, raise_exc=raise_exc)
+        if check:
+            valid = valid and self.validate_velocity(transaction, raise_exc=raise_exc)
         return valid
 
+    def validate_velocity(self, transaction: CloudPaymentsTransaction, raise_exc: bool = True) -> bool:
+        checker = get_velocity_checker()
+        return checker is None or checker.check(transaction, raise_exc=raise_exc)
+
+    def handle_payment_error(self, error: PaymentError, invoice: Invoice, transaction: Transaction,
+                             raise_exc: bool = False):
+        if not isinstance(error, VelocityLimitExceeded):
+            return super().handle_payment_error(error, invoice, transaction, raise_exc=raise_exc)
+        self.transaction_handler.set_declined(transaction)
+        if raise_exc:
+            raise error
+        return invoice, transaction
+
     def validate_currency(self, currency: str, raise_exc: bool = True) -> bool:
         valid = currency in self.valid_currencies
         if not valid and raise_exc:
@@ -108,8 +122,10 @@ class CloudPaymentsResultCode(IntEnum):
 
 class CloudPaymentsPaymentProvider(AbstractPaymentProvider):
 
+    @traced
+    @guard_database
     def check(self, transaction_data: CloudPaymentsTransactionHandler.TransactionDTO) -> CloudPaymentsResultCode:
-        if not Invoice.objects.filter(id=transaction_data.invoice_id).exists():
+        if not invoice_exists(transaction_data.invoice_id):
             logger.info('Invoice from Cloudpayments transaction does not exist.',
                         extra={'TransactionId': transaction_data.TransactionId,
                                'InvoiceId': transaction_data.invoice_id})
@@ -118,10 +134,10 @@ class CloudPaymentsPaymentProvider(AbstractPaymentProvider):
                                                                   'invoice_id': transaction_data.invoice_id})
         transaction = self.transaction_handler.create(transaction_data)
         validation_error = None
-        with db_transaction.atomic():
-            invoice = Invoice.objects.select_for_update().get(pk=transaction.invoice_id)
+        with lock_block():
+            invoice = self.get_invoice_for_payment(transaction.invoice_id)
             try:
-                self.payment_handler.validate_payment(invoice, transaction, raise_exc=True)
+                self.payment_handler.validate_payment(invoice, transaction, raise_exc=True, check=True)
             except PaymentError as e:
                 validation_error = e
                 self.payment_handler.handle_payment_error(e, invoice, transaction, raise_exc=False)
@@ -134,19 +150,21 @@ class CloudPaymentsPaymentProvider(AbstractPaymentProvider):
                         extra={'TransactionId': transaction_data.TransactionId, 'invoice_id': invoice.id})
             return CloudPaymentsResultCode.OK
 
+    @traced
+    @guard_database
     def pay(self, invoice_id: int, transaction_data: CloudPaymentsTransactionHandler.TransactionDTO) -> \
             (Invoice, Transaction):
         try:
             logger.info('Paying Cloudpayments transaction.', extra={'TransactionId': transaction_data.TransactionId,
                                                                     'invoice_id': transaction_data.invoice_id})
-            with db_transaction.atomic():
+            with lock_block():
                 transaction = CloudPaymentsTransaction.objects.get(TransactionId=transaction_data.TransactionId)
                 transaction.GatewayName = transaction_data.GatewayName
                 transaction.Token = transaction_data.Token
                 transaction.TotalFee = transaction_data.TotalFee
                 transaction.save(update_fields=['GatewayName', 'Token', 'TotalFee'])
-                invoice = Invoice.objects.select_for_update().get(pk=invoice_id)
-                invoice = self.payment_handler.try_process_payment(invoice, transaction)
+                invoice = self.get_invoice_for_payment(invoice_id)
+                invoice = self.process_payment(invoice, transaction)
                 logger.info('Invoice paid using Cloudpayments.',
                             extra={'invoice_id': invoice_id, 'transaction_id': transaction.id})
                 return invoice, transaction
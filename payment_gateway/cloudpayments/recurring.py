@@ -0,0 +1,140 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Iterable, List
+
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from payment_gateway.errors import PaymentError, CircuitOpen
+from payment_gateway.identity import get_invoice_for_update, lock_block
+from payment_gateway.models import Invoice, CloudPaymentsTransaction, TransactionStatus, TransactionType
+from payment_gateway.routers import primary_pin_scope
+from payment_gateway.settings import api_settings
+
+from .client import CloudPaymentsClient, CloudPaymentsAPIError
+from .provider import get_cloudpayments_provider, CloudPaymentsPaymentProvider
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RecurringCharge:
+    invoice_id: int
+    token: str
+    account_id: str
+    currency: str
+    description: str = None
+    email: str = None
+
+
+@dataclass
+class RecurringChargeResult:
+    invoice_id: int
+    success: bool
+    transaction_id: int = None
+    reason: str = None
+
+
+class RecurringChargeRunner(object):
+    def __init__(self, provider: CloudPaymentsPaymentProvider = None, client: CloudPaymentsClient = None,
+                 concurrency: int = None):
+        self.provider = provider or get_cloudpayments_provider()
+        self.client = client or CloudPaymentsClient()
+        self.concurrency = concurrency or api_settings.CLOUDPAYMENTS_RECURRING_CONCURRENCY
+
+    def run(self, charges: Iterable[RecurringCharge]) -> List[RecurringChargeResult]:
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(self.charge, charges))
+
+    @primary_pin_scope()
+    def charge(self, charge: RecurringCharge) -> RecurringChargeResult:
+        try:
+            return self.try_charge(charge)
+        except (CloudPaymentsAPIError, CircuitOpen, Invoice.DoesNotExist) as e:
+            logger.warning('Cloudpayments recurring charge failed.', exc_info=True,
+                           extra={'invoice_id': charge.invoice_id})
+            return RecurringChargeResult(charge.invoice_id, success=False, reason=str(e))
+        except Exception as e:
+            # A failing charge must not discard the results of the other charges of the batch.
+            logger.exception('Cloudpayments recurring charge failed unexpectedly.',
+                             extra={'invoice_id': charge.invoice_id})
+            return RecurringChargeResult(charge.invoice_id, success=False, reason=repr(e))
+        finally:
+            connection.close()
+
+    def try_charge(self, charge: RecurringCharge) -> RecurringChargeResult:
+        invoice = Invoice.objects.get(pk=charge.invoice_id)
+        payment_handler = self.provider.payment_handler
+        if not (payment_handler.validate_status_for_pay(invoice, raise_exc=False) and
+                payment_handler.validate_expiration(invoice, raise_exc=False)):
+            return RecurringChargeResult(invoice.id, success=False, reason='Invoice can not be paid.')
+
+        logger.info('Charging Cloudpayments token.', extra={'invoice_id': invoice.id})
+        response = self.client.charge_token(invoice.total, charge.currency, charge.account_id, charge.token,
+                                            invoice_id=self.provider.get_invoice_reference(invoice),
+                                            description=charge.description, email=charge.email)
+        model = response.get('Model') or {}
+        if 'TransactionId' not in model:
+            return RecurringChargeResult(invoice.id, success=False, reason=response.get('Message'))
+        try:
+            return self.record_charge(invoice, response)
+        except Exception as e:
+            logger.exception('Recording Cloudpayments recurring charge failed, the card may have been charged.',
+                             extra={'invoice_id': invoice.id, 'TransactionId': model['TransactionId']})
+            return RecurringChargeResult(invoice.id, success=False, reason=repr(e))
+
+    def record_charge(self, invoice: Invoice, response: dict) -> RecurringChargeResult:
+        model = response['Model']
+        transaction_data = self.make_transaction_data(invoice, model)
+        invoice, transaction = self.record_transaction(transaction_data)
+        if transaction.status == TransactionStatus.SUCCESS or invoice.success_transaction_id == transaction.pk:
+            logger.info('Cloudpayments recurring charge was already paid by its notification.',
+                        extra={'invoice_id': invoice.id, 'TransactionId': transaction_data.TransactionId})
+            return RecurringChargeResult(invoice.id, success=True, transaction_id=transaction.id)
+        if not response.get('Success'):
+            self.provider.transaction_handler.set_declined(transaction)
+            logger.info('Cloudpayments recurring charge declined.',
+                        extra={'invoice_id': invoice.id, 'TransactionId': transaction_data.TransactionId})
+            return RecurringChargeResult(invoice.id, success=False, transaction_id=transaction.id,
+                                         reason=model.get('CardHolderMessage') or model.get('Reason'))
+        try:
+            self.provider.pay(invoice.id, transaction_data)
+        except PaymentError as e:
+            return RecurringChargeResult(invoice.id, success=False, transaction_id=transaction.id,
+                                         reason=str(e.detail))
+        return RecurringChargeResult(invoice.id, success=True, transaction_id=transaction.id)
+
+    def record_transaction(self, transaction_data) -> (Invoice, CloudPaymentsTransaction):
+        # The Check and Pay notifications for the same charge may have been processed already or run concurrently,
+        # the invoice lock keeps them from recording the TransactionId twice.
+        with lock_block():
+            invoice = get_invoice_for_update(transaction_data.invoice_id)
+            transaction = CloudPaymentsTransaction.objects.filter(TransactionId=transaction_data.TransactionId).first()
+            if transaction is None:
+                transaction = self.provider.transaction_handler.create(transaction_data)
+        return invoice, transaction
+
+    def make_transaction_data(self, invoice: Invoice, model: dict):
+        created_at = parse_datetime(model.get('CreatedDateIso') or '')
+        if created_at is None:
+            created_at = timezone.now()
+        elif timezone.is_naive(created_at):
+            created_at = timezone.make_aware(created_at, timezone.utc)
+        amount = Decimal(str(model['Amount']))
+        total_fee = model.get('TotalFee')
+        return self.provider.transaction_handler.TransactionDTO(
+            type=TransactionType.CLOUDPAYMENTS, invoice_id=invoice.id, money_amount=amount,
+            TransactionId=model['TransactionId'], Amount=amount, Currency=model['Currency'], DateTime=created_at,
+            CardFirstSix=model.get('CardFirstSix', ''), CardLastFour=model.get('CardLastFour', ''),
+            CardType=model.get('CardType', ''), CardExpDate=model.get('CardExpDate', ''),
+            TestMode=bool(model.get('TestMode')), Status=model.get('Status', ''), OperationType='Payment',
+            InvoiceId=self.provider.get_invoice_reference(invoice),
+            AccountId=model.get('AccountId'), SubscriptionId=model.get('SubscriptionId'), Name=model.get('Name'),
+            Email=model.get('Email'), IpAddress=model.get('IpAddress'), IpCountry=model.get('IpCountry'),
+            IpCity=model.get('IpCity'), IpRegion=model.get('IpRegion'), IpDistrict=model.get('IpDistrict'),
+            Issuer=model.get('Issuer'), IssuerBankCountry=model.get('IssuerBankCountry'),
+            Description=model.get('Description'), Data=model.get('JsonData'), GatewayName=model.get('GatewayName'),
+            Token=model.get('Token'), TotalFee=Decimal(str(total_fee)) if total_fee is not None else None
+        )
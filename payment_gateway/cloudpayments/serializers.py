@@ -36,8 +36,9 @@ class CloudPaymentsSerializerBase(serializers.Serializer):
 
 class CloudPaymentsCheckSerializer(CloudPaymentsSerializerBase):
     def create(self, validated_data):
+        invoice_id = self.provider.resolve_invoice_id(validated_data['InvoiceId'])
         data = self.provider.transaction_handler.TransactionDTO(type=TransactionType.CLOUDPAYMENTS,
-                                                                invoice_id=int(validated_data['InvoiceId']),
+                                                                invoice_id=invoice_id,
                                                                 money_amount=validated_data['Amount'], **validated_data)
         return {'code': self.provider.check(data)}
 
@@ -49,8 +50,9 @@ class CloudPaymentsPaySerializer(CloudPaymentsSerializerBase):
     TotalFee = serializers.DecimalField(max_digits=11, decimal_places=2)
 
     def create(self, validated_data):
+        invoice_id = self.provider.resolve_invoice_id(validated_data['InvoiceId'])
         data = self.provider.transaction_handler.TransactionDTO(type=TransactionType.CLOUDPAYMENTS,
-                                                                invoice_id=validated_data['InvoiceId'],
+                                                                invoice_id=invoice_id,
                                                                 money_amount=validated_data['Amount'], **validated_data)
         self.provider.pay(data.invoice_id, data)
         return {'code': CloudPaymentsResultCode.OK}
@@ -1,6 +1,10 @@
 import logging
 
 from payment_gateway.cloudpayments.provider import NotificationValidator
+from payment_gateway.profiling import profile_slow_requests
+from payment_gateway.schema import CompiledSchema, CompiledSchemaMixin
+from payment_gateway.throttling import WebhookRateThrottle
+from payment_gateway.tracing import traced
 from rest_framework import status
 from rest_framework.generics import GenericAPIView
 from rest_framework.permissions import BasePermission
@@ -14,29 +18,34 @@ logger = logging.getLogger(__name__)
 class NotificationPermission(BasePermission):
     validator = NotificationValidator()
 
+    @traced
     def has_permission(self, request, view):
         content_hmac = request.headers.get('Content-HMAC', None)
         content = request.body
         return content_hmac is not None and self.validator.validate(content, content_hmac)
 
 
-class CloudPaymentsCheckAPIView(GenericAPIView):
+class CloudPaymentsCheckAPIView(CompiledSchemaMixin, GenericAPIView):
     serializer_class = CloudPaymentsCheckSerializer
+    payload_schema = CompiledSchema(CloudPaymentsCheckSerializer)
     permission_classes = (NotificationPermission,)
+    throttle_classes = (WebhookRateThrottle,)
+    throttle_scope = 'cloudpayments'
 
+    @profile_slow_requests
     def post(self, request, *args, **kwargs):
-        serializer = self.get_serializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        data = serializer.save()
+        data = self.validate_and_save(request)
         return Response(data=data, status=status.HTTP_200_OK)
 
 
-class CloudPaymentsPayAPIView(GenericAPIView):
+class CloudPaymentsPayAPIView(CompiledSchemaMixin, GenericAPIView):
     serializer_class = CloudPaymentsPaySerializer
+    payload_schema = CompiledSchema(CloudPaymentsPaySerializer)
     permission_classes = (NotificationPermission,)
+    throttle_classes = (WebhookRateThrottle,)
+    throttle_scope = 'cloudpayments'
 
+    @profile_slow_requests
     def post(self, request, *args, **kwargs):
-        serializer = self.get_serializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        data = serializer.save()
+        data = self.validate_and_save(request)
         return Response(data, status=status.HTTP_200_OK)
@@ -1,10 +1,47 @@
-from dataclasses import dataclass
+import dataclasses
 from decimal import Decimal
+from functools import lru_cache
+from operator import attrgetter
 
 from payment_gateway.models import TransactionType
 
 
-@dataclass
+def slotted_dataclass(cls):
+    """
+    Builds `cls` as a dataclass with __slots__. A subclass can not give an inherited field a class level value,
+    e.g. `type = TransactionType.DUMMY`, the value would shadow the slot of the field, so that raises TypeError.
+    """
+    cls = dataclasses.dataclass(cls)
+    field_names = [field.name for field in dataclasses.fields(cls)]
+    annotations = cls.__dict__.get('__annotations__', {})
+    shadowed = [key for key in cls.__dict__ if key in field_names and key not in annotations]
+    if shadowed:
+        raise TypeError('%s can not set the inherited fields %s at class level.' % (cls.__qualname__,
+                                                                                   ', '.join(shadowed)))
+    inherited_slots = set()
+    for base in cls.__mro__[1:]:
+        inherited_slots.update(getattr(base, '__slots__', ()))
+    # Class level defaults would shadow the slot descriptors, the generated __init__ keeps its own copy of them.
+    namespace = {key: value for key, value in cls.__dict__.items()
+                 if key not in field_names and key not in ('__dict__', '__weakref__')}
+    namespace['__slots__'] = tuple(name for name in field_names if name not in inherited_slots)
+    namespace['__qualname__'] = cls.__qualname__
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+@lru_cache(maxsize=None)
+def get_model_mapping(dto_class, model_class) -> (tuple, attrgetter):
+    model_attnames = {field.attname for field in model_class._meta.concrete_fields}
+    names = tuple(field.name for field in dataclasses.fields(dto_class) if field.name in model_attnames)
+    return names, attrgetter(*names)
+
+
+def to_model_kwargs(dto, model_class) -> dict:
+    names, getter = get_model_mapping(type(dto), model_class)
+    return dict(zip(names, getter(dto)))
+
+
+@slotted_dataclass
 class Transaction:
     type: TransactionType
     invoice_id: int
@@ -1,31 +1,46 @@
+import functools
 import logging
-from dataclasses import dataclass
+import random
+import threading
+import time
 
-from django.db import transaction as db_transaction
-from payment_gateway.base import AbstractPaymentProvider, BasicTransactionHandler, BasicCallbackProvider, \
-    BasicPaymentHandler
-from payment_gateway.dto import Transaction as TransactionDTOBase
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction as db_transaction
+from payment_gateway import errors
+from payment_gateway.base import AbstractPaymentProvider, BasicTransactionHandler, \
+    BasicPaymentHandler, ConcurrencyMode, get_concurrency_mode
+from payment_gateway.callbacks import get_callback_provider
+from payment_gateway.circuitbreaker import guard_database
+from payment_gateway.dto import Transaction as TransactionDTOBase, slotted_dataclass
 from payment_gateway.errors import PaymentError
-from payment_gateway.models import Invoice, Transaction, TransactionType
+from payment_gateway.identity import lock_block
+from payment_gateway.models import Invoice, Transaction
+from payment_gateway.settings import api_settings
+from payment_gateway.tracing import traced
 
 logger = logging.getLogger(__name__)
 
 
 class DummyTransactionHandler(BasicTransactionHandler):
-    @dataclass
+    @slotted_dataclass
     class TransactionDTO(TransactionDTOBase):
-        type = TransactionType.DUMMY
+        pass
 
 
 class DummyPaymentProvider(AbstractPaymentProvider):
+    @traced
+    @guard_database
     def pay(self, invoice_id: int, transaction_data: DummyTransactionHandler.TransactionDTO) -> (Invoice, Transaction):
         transaction = self.transaction_handler.create(transaction_data)
         logger.info('Processing dummy payment.',
                     extra={'invoice_id': invoice_id, 'transaction_id': transaction.id})
+        return self.deliver(invoice_id, transaction)
+
+    def deliver(self, invoice_id: int, transaction: Transaction) -> (Invoice, Transaction):
         try:
-            with db_transaction.atomic():
-                invoice = Invoice.objects.select_for_update().get(pk=invoice_id)
-                invoice = self.payment_handler.try_process_payment(invoice, transaction)
+            with lock_block():
+                invoice = self.get_invoice_for_payment(invoice_id)
+                invoice = self.process_payment(invoice, transaction)
                 logger.info('Successfully processed dummy payment.',
                             extra={'invoice_id': invoice_id, 'transaction_id': transaction.id})
                 return invoice, transaction
@@ -35,8 +50,100 @@ class DummyPaymentProvider(AbstractPaymentProvider):
             self.payment_handler.handle_payment_error(e, invoice, transaction, raise_exc=True)
 
 
+LATENCY_DISTRIBUTIONS = {
+    'constant': lambda rnd, value=0.0: value,
+    'uniform': lambda rnd, low=0.0, high=0.0: rnd.uniform(low, high),
+    'normal': lambda rnd, mu=0.0, sigma=0.0: max(rnd.gauss(mu, sigma), 0.0),
+    'lognormal': lambda rnd, mu=0.0, sigma=0.0: rnd.lognormvariate(mu, sigma),
+    'exponential': lambda rnd, mean=0.0: rnd.expovariate(1 / mean) if mean else 0.0,
+}
+
+
+class FaultInjectingDummyPaymentProvider(DummyPaymentProvider):
+    """
+    Dummy provider behaving like a real gateway for load tests. Recognized `faults` keys:
+
+    latency: delay before every payment, e.g. {'distribution': 'lognormal', 'mu': -3.0, 'sigma': 0.5}
+    errors: ratio of payments failing with the named PaymentError, e.g. {'InsufficientMoneyAmount': 0.05}
+    duplicate_ratio: ratio of payments whose notification is delivered once more
+    reorder_ratio: ratio of payments acknowledged as pending and delivered later
+    redelivery_delay: delay distribution of duplicated and reordered deliveries
+    seed: seed of the random generator
+    """
+
+    def __init__(self, payment_handler, transaction_handler, concurrency_mode=ConcurrencyMode.LOCK,
+                 faults: dict = None):
+        super().__init__(payment_handler, transaction_handler, concurrency_mode)
+        faults = faults or {}
+        self.random = random.Random(faults.get('seed'))
+        self.latency = self.make_sampler(faults.get('latency', {}))
+        self.redelivery_delay = self.make_sampler(faults.get('redelivery_delay', {'distribution': 'uniform',
+                                                                                  'high': 1.0}))
+        self.error_ratios = [(self.get_error_class(name), ratio) for name, ratio in faults.get('errors', {}).items()]
+        self.duplicate_ratio = faults.get('duplicate_ratio', 0.0)
+        self.reorder_ratio = faults.get('reorder_ratio', 0.0)
+
+    def make_sampler(self, config: dict):
+        config = dict(config)
+        name = config.pop('distribution', 'constant')
+        if name not in LATENCY_DISTRIBUTIONS:
+            raise ImproperlyConfigured('Unknown latency distribution %r.' % name)
+        return functools.partial(LATENCY_DISTRIBUTIONS[name], self.random, **config)
+
+    def get_error_class(self, name: str):
+        error_class = getattr(errors, name, None)
+        if not isinstance(error_class, type) or not issubclass(error_class, PaymentError):
+            raise ImproperlyConfigured('%r is not a payment error.' % name)
+        return error_class
+
+    def pick_error(self):
+        roll = self.random.random()
+        for error_class, ratio in self.error_ratios:
+            if roll < ratio:
+                return error_class
+            roll -= ratio
+        return None
+
+    def pay(self, invoice_id: int, transaction_data: DummyTransactionHandler.TransactionDTO) -> (Invoice, Transaction):
+        time.sleep(self.latency())
+        if self.random.random() < self.reorder_ratio:
+            transaction = self.transaction_handler.create(transaction_data)
+            logger.info('Deferring dummy payment delivery.',
+                        extra={'invoice_id': invoice_id, 'transaction_id': transaction.id})
+            self.redeliver(self.deliver, invoice_id, transaction)
+            return Invoice.objects.get(pk=invoice_id), transaction
+        duplicate = self.random.random() < self.duplicate_ratio
+        try:
+            return super().pay(invoice_id, transaction_data)
+        finally:
+            if duplicate:
+                self.redeliver(super().pay, invoice_id, transaction_data)
+
+    def process_payment(self, invoice: Invoice, transaction: Transaction) -> Invoice:
+        error_class = self.pick_error()
+        if error_class is not None:
+            raise error_class()
+        return super().process_payment(invoice, transaction)
+
+    def redeliver(self, func, *args):
+        timer = threading.Timer(self.redelivery_delay(), self.run_delivery, args=(func,) + args)
+        timer.daemon = True
+        db_transaction.on_commit(timer.start)
+
+    def run_delivery(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            logger.info('Redelivered dummy payment failed.', exc_info=True)
+        finally:
+            connection.close()
+
+
 def get_dummy_provider():
     transaction_handler = DummyTransactionHandler()
-    callback_provider = BasicCallbackProvider()
+    callback_provider = get_callback_provider()
     payment_handler = BasicPaymentHandler(callback_provider, transaction_handler)
-    return DummyPaymentProvider(payment_handler, transaction_handler)
+    if api_settings.DUMMY_FAULTS:
+        return FaultInjectingDummyPaymentProvider(payment_handler, transaction_handler, get_concurrency_mode('dummy'),
+                                                  faults=api_settings.DUMMY_FAULTS)
+    return DummyPaymentProvider(payment_handler, transaction_handler, get_concurrency_mode('dummy'))
@@ -2,6 +2,7 @@ from django.utils.translation import ugettext_lazy as _
 from rest_framework import serializers
 
 from payment_gateway.dummy.provider import get_dummy_provider
+from payment_gateway.identity import invoice_exists
 from payment_gateway.models import Invoice, TransactionType
 
 
@@ -12,7 +13,7 @@ class DummyTransactionSerializer(serializers.ModelSerializer):
     money_amount = serializers.DecimalField(max_digits=11, decimal_places=2, write_only=True)
 
     def validate_invoice_id(self, invoice_id):
-        if not Invoice.objects.filter(pk=invoice_id).exists():
+        if not invoice_exists(invoice_id):
             raise serializers.ValidationError(_('Invalid invoice identifier.'))
         return invoice_id
 
@@ -1,3 +1,4 @@
+from payment_gateway.profiling import profile_slow_requests
 from rest_framework import status
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
@@ -8,6 +9,7 @@ from .serializers import DummyTransactionSerializer
 class DummyProviderAPIView(GenericAPIView):
     serializer_class = DummyTransactionSerializer
 
+    @profile_slow_requests
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -41,3 +41,15 @@ class InsufficientMoneyAmount(InvalidMoneyAmount):
     status_code = status.HTTP_400_BAD_REQUEST
     default_detail = _('Insufficient money amount.')
     default_code = 'insufficient_money_amount'
+
+
+class VelocityLimitExceeded(PaymentError):
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = _('Too many payment attempts, try again later.')
+    default_code = 'velocity_limit_exceeded'
+
+
+class CircuitOpen(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('Service is temporarily unavailable, try again later.')
+    default_code = 'circuit_open'
@@ -0,0 +1,50 @@
+import json
+
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class TextJSONField(models.Field):
+    """
+    JSONField for Django < 3.1, stored as jsonb on PostgreSQL where psycopg2 decodes values, and as JSON encoded
+    text on other databases. It has no key lookups.
+    """
+    empty_strings_allowed = False
+    description = _('A JSON object')
+
+    def db_type(self, connection):
+        return 'jsonb' if connection.vendor == 'postgresql' else 'text'
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        if connection.vendor == 'postgresql':
+            from psycopg2.extras import Json
+            return Json(value)
+        return json.dumps(value)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None or connection.vendor == 'postgresql':
+            return value
+        return json.loads(value)
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj))
+
+    def formfield(self, **kwargs):
+        try:
+            from django.contrib.postgres.forms import JSONField as JSONFormField
+        except ImportError:
+            return super().formfield(**kwargs)
+        return super().formfield(**{'form_class': JSONFormField, **kwargs})
+
+
+if hasattr(models, 'JSONField'):
+    class JSONField(models.JSONField):
+        """
+        Django's portable JSONField, jsonb on PostgreSQL and text elsewhere.
+        """
+
+else:
+    class JSONField(TextJSONField):
+        pass
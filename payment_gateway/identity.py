@@ -0,0 +1,122 @@
+import threading
+from contextlib import contextmanager
+
+from django.core.signals import request_finished, request_started
+from django.db import transaction
+
+from payment_gateway.models import Invoice
+
+_state = threading.local()
+
+
+def begin_invoice_scope(*args, **kwargs):
+    _state.invoices = {}
+    _state.references = {}
+
+
+def end_invoice_scope(*args, **kwargs):
+    _state.invoices = None
+    _state.references = None
+
+
+@contextmanager
+def invoice_scope():
+    previous = getattr(_state, 'invoices', None), getattr(_state, 'references', None)
+    begin_invoice_scope()
+    try:
+        yield
+    finally:
+        _state.invoices, _state.references = previous
+
+
+def get_invoice(invoice_id) -> Invoice:
+    """
+    Loads an invoice once per request scope, outside of a scope every call hits the database. Missing invoices
+    are remembered as well and raise Invoice.DoesNotExist.
+    """
+    invoices = getattr(_state, 'invoices', None)
+    if invoices is None:
+        return Invoice.objects.get(pk=invoice_id)
+    key = Invoice._meta.pk.to_python(invoice_id)
+    if key not in invoices:
+        try:
+            invoices[key] = Invoice.objects.get(pk=key)
+        except Invoice.DoesNotExist:
+            invoices[key] = None
+    invoice = invoices[key]
+    if invoice is None:
+        raise Invoice.DoesNotExist('Invoice matching query does not exist.')
+    return invoice
+
+
+def invoice_exists(invoice_id) -> bool:
+    try:
+        get_invoice(invoice_id)
+    except Invoice.DoesNotExist:
+        return False
+    return True
+
+
+def resolve_invoice_id(reference, external_reference: bool = False):
+    """
+    Maps the invoice reference a provider sends back to an invoice id, either the id itself or the invoice's
+    external_reference. The invoice loaded by the indexed reference lookup is kept in the request scope, unknown
+    references resolve to None.
+    """
+    if not external_reference:
+        return Invoice._meta.pk.to_python(reference)
+    references = getattr(_state, 'references', None)
+    if references is not None and reference in references:
+        return references[reference]
+    try:
+        invoice = Invoice.objects.get(external_reference=reference)
+    except Invoice.DoesNotExist:
+        invoice = None
+    invoice_id = invoice.pk if invoice is not None else None
+    if references is not None:
+        references[reference] = invoice_id
+        if invoice is not None:
+            _state.invoices.setdefault(invoice_id, invoice)
+    return invoice_id
+
+
+@contextmanager
+def lock_block(using=None):
+    """
+    transaction.atomic() block that remembers the invoices get_invoice_for_update locks directly in it. Nested
+    blocks see the locks of the enclosing ones. The locks of a block are forgotten when it exits, so a lock the
+    database released on rollback is never reused.
+    """
+    frames = getattr(_state, 'lock_frames', None)
+    if frames is None:
+        frames = _state.lock_frames = []
+    with transaction.atomic(using=using):
+        frames.append({})
+        try:
+            yield
+        finally:
+            frames.pop()
+
+
+def get_invoice_for_update(invoice_id) -> Invoice:
+    """
+    Locks an invoice once per lock_block, outside of one every call locks the row again. Locked invoices replace
+    the ones in the request scope.
+    """
+    frames = getattr(_state, 'lock_frames', None)
+    if not frames:
+        invoice = Invoice.objects.select_for_update().get(pk=invoice_id)
+    else:
+        key = Invoice._meta.pk.to_python(invoice_id)
+        invoice = next((frame[key] for frame in reversed(frames) if key in frame), None)
+        if invoice is not None:
+            return invoice
+        invoice = frames[-1][key] = Invoice.objects.select_for_update().get(pk=key)
+    invoices = getattr(_state, 'invoices', None)
+    if invoices is not None:
+        invoices[invoice.pk] = invoice
+    return invoice
+
+
+request_started.connect(begin_invoice_scope)
+request_finished.connect(end_invoice_scope)
@@ -0,0 +1,257 @@
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from django.db.models import Max
+from django.utils import timezone
+
+from payment_gateway.cloudpayments.client import ConnectionPool
+from payment_gateway.cloudpayments.provider import CloudPaymentsResultCode, NotificationValidator, \
+    get_cloudpayments_provider
+from payment_gateway.dto import slotted_dataclass
+from payment_gateway.models import CloudPaymentsTransaction
+from payment_gateway.service import create_invoice
+from payment_gateway.settings import api_settings
+from payment_gateway.walletone.provider import get_merchants, get_walletone_provider
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATHS = {
+    'cloudpayments.check': '/cloudpayments/check/',
+    'cloudpayments.pay': '/cloudpayments/pay/',
+    'walletone.confirm': '/walletone/confirm/',
+}
+FAILURES = ('insufficient_money_amount', 'expired', 'bad_signature', 'unknown_invoice')
+
+
+@slotted_dataclass
+class Request:
+    endpoint: str
+    body: bytes
+    headers: dict
+
+
+@slotted_dataclass
+class Sample:
+    endpoint: str
+    scenario: str
+    result: str
+    latency: float
+
+
+class Pacer(object):
+    """
+    Spaces requests of all threads `1 / rate` seconds apart, no limit without a rate.
+    """
+
+    def __init__(self, rate: float = None):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class LoadGenerator(object):
+    """
+    Creates invoices with service.create_invoice and drives signed CloudPayments check-then-pay and WalletOne
+    confirm sequences against a running deployment, spreading WalletOne invoices over all merchant accounts. A
+    sequence is a successful payment, a payment whose last notification is delivered twice, or one of FAILURES.
+    """
+
+    def __init__(self, base_url: str, success_callback: str, providers=('cloudpayments', 'walletone'),
+                 paths: dict = None, rate: float = None, concurrency: int = 8, duplicate_ratio: float = 0.1,
+                 failure_ratio: float = 0.1, seed: int = None, timeout: float = 30):
+        self.base_path = urlsplit(base_url).path.rstrip('/')
+        self.success_callback = success_callback
+        self.providers = providers
+        self.paths = dict(DEFAULT_PATHS, **(paths or {}))
+        self.concurrency = concurrency
+        self.duplicate_ratio = duplicate_ratio
+        self.failure_ratio = failure_ratio
+        self.random = random.Random(seed)
+        self.pacer = Pacer(rate)
+        self.pool = ConnectionPool(base_url, size=concurrency, timeout=timeout)
+        self.validator = NotificationValidator()
+        self.cloudpayments = get_cloudpayments_provider()
+        self.walletone = get_walletone_provider()
+        self._transaction_ids = None
+
+    def pick_scenario(self) -> str:
+        roll = self.random.random()
+        if roll < self.failure_ratio:
+            return self.random.choice(FAILURES)
+        if roll < self.failure_ratio + self.duplicate_ratio:
+            return 'duplicate'
+        return 'success'
+
+    def pick_total(self) -> Decimal:
+        return Decimal(self.random.randint(100, 100000)).scaleb(-2)
+
+    def next_transaction_id(self) -> int:
+        if self._transaction_ids is None:
+            last = CloudPaymentsTransaction.objects.aggregate(last=Max('TransactionId'))['last'] or 0
+            self._transaction_ids = iter(range(last + 1, 2 ** 31))
+        return next(self._transaction_ids)
+
+    def build_sequences(self, count: int) -> list:
+        sequences = []
+        for _ in range(count):
+            provider = self.random.choice(self.providers)
+            scenario = self.pick_scenario()
+            sequences.append((scenario, getattr(self, 'build_%s_sequence' % provider)(scenario)))
+        return sequences
+
+    def create_invoice(self, scenario: str, total: Decimal, details: dict = None):
+        if scenario == 'unknown_invoice':
+            return None
+        if scenario == 'expired':
+            expires_at = timezone.now() - timedelta(minutes=1)
+        else:
+            expires_at = timezone.now() + timedelta(days=1)
+        return create_invoice(total, self.success_callback, expires_at=expires_at, details=details or {})
+
+    def build_cloudpayments_sequence(self, scenario: str) -> list:
+        total = self.pick_total()
+        invoice = self.create_invoice(scenario, total)
+        amount = total - Decimal('0.01') if scenario == 'insufficient_money_amount' else total
+        payload = {
+            'TransactionId': self.next_transaction_id(),
+            'Amount': str(amount),
+            'Currency': api_settings.CLOUDPAYMENTS_VALID_CURRENCIES[0],
+            'DateTime': timezone.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'CardFirstSix': '411111',
+            'CardLastFour': '%04d' % self.random.randint(0, 9999),
+            'CardType': 'Visa',
+            'CardExpDate': '1230',
+            'TestMode': '1',
+            'Status': 'Completed',
+            'OperationType': 'Payment',
+            'InvoiceId': self.cloudpayments.get_invoice_reference(invoice) if invoice is not None else '0',
+        }
+        check = self.make_cloudpayments_request('cloudpayments.check', payload, scenario == 'bad_signature')
+        if scenario != 'success' and scenario != 'duplicate':
+            return [check]
+        pay = self.make_cloudpayments_request('cloudpayments.pay', dict(payload, TotalFee='0.00'))
+        return [check, pay, pay] if scenario == 'duplicate' else [check, pay]
+
+    def make_cloudpayments_request(self, endpoint: str, payload: dict, forge: bool = False) -> Request:
+        body = urlencode(payload).encode()
+        signature = self.validator.calculate_hmac(body if not forge else body + b'forged').decode()
+        return Request(endpoint, body, {'Content-Type': 'application/x-www-form-urlencoded',
+                                        'Content-HMAC': signature})
+
+    def build_walletone_sequence(self, scenario: str) -> list:
+        total = self.pick_total()
+        merchant = self.random.choice(sorted(get_merchants().values(), key=lambda merchant: merchant.merchant_id))
+        details = {'WALLET_ONE_OVERRIDE': {'WMI_MERCHANT_ID': merchant.merchant_id}}
+        invoice = self.create_invoice(scenario, total, details)
+        amount = total - Decimal('0.01') if scenario == 'insufficient_money_amount' else total
+        now = timezone.now().replace(tzinfo=None, microsecond=0)
+        payload = {
+            'WMI_ORDER_ID': uuid.uuid4().hex,
+            'WMI_MERCHANT_ID': merchant.merchant_id,
+            'WMI_PAYMENT_AMOUNT': str(amount),
+            'WMI_COMMISSION_AMOUNT': '0.00',
+            'WMI_CURRENCY_ID': str(merchant.currency_id),
+            'WMI_PAYMENT_NO': self.walletone.get_invoice_reference(invoice) if invoice is not None else '0',
+            'WMI_SUCCESS_URL': merchant.success_url,
+            'WMI_FAIL_URL': merchant.fail_url,
+            'WMI_EXPIRED_DATE': str(now + timedelta(days=1)),
+            'WMI_CREATE_DATE': str(now),
+            'WMI_UPDATE_DATE': str(now),
+            'WMI_ORDER_STATE': 'Accepted',
+            'WMI_AUTO_ACCEPT': '1',
+            'WMI_PAYMENT_TYPE': 'CreditCardRUB',
+        }
+        signature = merchant.signer._get_signature(payload).decode()
+        payload['WMI_SIGNATURE'] = signature if scenario != 'bad_signature' else signature[::-1]
+        confirm = Request('walletone.confirm', urlencode(payload).encode(),
+                          {'Content-Type': 'application/x-www-form-urlencoded'})
+        return [confirm, confirm] if scenario == 'duplicate' else [confirm]
+
+    def run(self, sequences: list) -> (list, float):
+        """
+        Runs the sequences on `concurrency` threads, the requests of one sequence in order. Returns the samples and
+        the wall time.
+        """
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(lambda sequence: self.run_sequence(*sequence), sequences))
+        elapsed = time.perf_counter() - started
+        self.pool.close()
+        return [sample for samples in results for sample in samples], elapsed
+
+    def run_sequence(self, scenario: str, requests: list) -> list:
+        return [self.send(scenario, request) for request in requests]
+
+    def send(self, scenario: str, request: Request) -> Sample:
+        self.pacer.wait()
+        connection = self.pool.acquire()
+        started = time.perf_counter()
+        try:
+            connection.request('POST', self.base_path + self.paths[request.endpoint], body=request.body,
+                               headers=request.headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            self.pool.discard(connection)
+            logger.warning('Load test request failed.', exc_info=True, extra={'endpoint': request.endpoint})
+            return Sample(request.endpoint, scenario, 'connection_error', time.perf_counter() - started)
+        latency = time.perf_counter() - started
+        self.pool.release(connection)
+        return Sample(request.endpoint, scenario, self.get_result(request.endpoint, response.status, body), latency)
+
+    def get_result(self, endpoint: str, status: int, body: bytes) -> str:
+        try:
+            data = json.loads(body.decode())
+        except ValueError:
+            return str(status)
+        if endpoint.startswith('cloudpayments') and isinstance(data, dict) and 'code' in data:
+            return '%s %s' % (status, CloudPaymentsResultCode(data['code']).name.lower())
+        if endpoint.startswith('walletone') and isinstance(data, str):
+            return '%s %s' % (status, parse_qs(data).get('WMI_RESULT', [''])[0].lower())
+        return str(status)
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def summarize(samples: list) -> dict:
+    """
+    Returns {endpoint: {'count', 'p50', 'p90', 'p99', 'max', 'results': Counter}} with latencies in seconds.
+    """
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint[sample.endpoint].append(sample)
+    summary = {}
+    for endpoint, endpoint_samples in sorted(by_endpoint.items()):
+        latencies = [sample.latency for sample in endpoint_samples]
+        summary[endpoint] = {
+            'count': len(endpoint_samples),
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies),
+            'results': Counter(sample.result for sample in endpoint_samples),
+        }
+    return summary
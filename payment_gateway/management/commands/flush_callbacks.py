@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from payment_gateway.callbacks import flush_pending_callbacks
+from payment_gateway.settings import api_settings
+
+
+class Command(BaseCommand):
+    help = 'Delivers queued batched success callbacks and retries failed ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=api_settings.CALLBACK_BATCH_SIZE,
+                            help='Maximum number of callbacks delivered in one transaction.')
+        parser.add_argument('--loop', action='store_true', help='Keep flushing until interrupted.')
+        parser.add_argument('--interval', type=float, default=api_settings.CALLBACK_BATCH_WINDOW,
+                            help='Seconds to sleep between flushes with --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            delivered, failed = flush_pending_callbacks(options['batch_size'])
+            if delivered or failed or not options['loop']:
+                self.stdout.write('Delivered %s callbacks, %s failed.' % (delivered, failed))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from payment_gateway.loadgen import DEFAULT_PATHS, LoadGenerator, summarize
+
+
+class Command(BaseCommand):
+    help = 'Creates invoices and sends signed CloudPayments and WalletOne notifications to a running deployment, ' \
+           'then reports latency percentiles and result codes per endpoint.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_url', help='URL the webhook paths are relative to, e.g. http://localhost:8000.')
+        parser.add_argument('--success-callback', required=True,
+                            help='Success callback of the created invoices, importable by the deployment.')
+        parser.add_argument('--sequences', type=int, default=1000, help='Number of payment sequences to send.')
+        parser.add_argument('--rate', type=float, help='Target requests per second, unlimited by default.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent connections.')
+        parser.add_argument('--provider', action='append', dest='providers', choices=('cloudpayments', 'walletone'),
+                            help='Provider to send notifications for, may be repeated. Both by default.')
+        parser.add_argument('--duplicate-ratio', type=float, default=0.1,
+                            help='Share of sequences whose last notification is delivered twice.')
+        parser.add_argument('--failure-ratio', type=float, default=0.1,
+                            help='Share of sequences with an insufficient amount, an expired invoice, a bad '
+                                 'signature or an unknown invoice.')
+        parser.add_argument('--seed', type=int, help='Seed of the random generator.')
+        for endpoint, path in DEFAULT_PATHS.items():
+            parser.add_argument('--%s-path' % endpoint.replace('.', '-'), default=path,
+                                help='Path of the %s webhook.' % endpoint)
+
+    def handle(self, *args, **options):
+        paths = {endpoint: options['%s_path' % endpoint.replace('.', '_')] for endpoint in DEFAULT_PATHS}
+        generator = LoadGenerator(options['base_url'], options['success_callback'],
+                                  providers=options['providers'] or ('cloudpayments', 'walletone'), paths=paths,
+                                  rate=options['rate'], concurrency=options['concurrency'],
+                                  duplicate_ratio=options['duplicate_ratio'], failure_ratio=options['failure_ratio'],
+                                  seed=options['seed'])
+        sequences = generator.build_sequences(options['sequences'])
+        self.stdout.write('Created invoices for %s sequences.' % len(sequences))
+        samples, elapsed = generator.run(sequences)
+        for endpoint, stats in summarize(samples).items():
+            self.stdout.write('%s: %s requests, p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+                endpoint, stats['count'], stats['p50'] * 1000, stats['p90'] * 1000, stats['p99'] * 1000,
+                stats['max'] * 1000))
+            for result, count in stats['results'].most_common():
+                self.stdout.write('  %s: %s (%.1f%%)' % (result, count, 100.0 * count / stats['count']))
+        self.stdout.write(self.style.SUCCESS('Sent %s requests in %.1fs, %.1f/s.' % (
+            len(samples), elapsed, len(samples) / elapsed if elapsed else 0)))
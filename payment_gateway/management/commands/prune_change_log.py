@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from payment_gateway.changelog import get_consumer_lags, prune_changes, sequence_changes
+from payment_gateway.settings import api_settings
+
+
+class Command(BaseCommand):
+    help = 'Assigns offsets to new change log entries, deletes segments past the retention period and reports ' \
+           'the lag of every consumer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention', type=float, default=api_settings.CHANGE_LOG_RETENTION,
+                            help='Seconds change log entries are kept for.')
+        parser.add_argument('--segment-size', type=int, default=api_settings.CHANGE_LOG_SEGMENT_SIZE,
+                            help='Number of offsets deleted together.')
+
+    def handle(self, *args, **options):
+        sequenced = sequence_changes()
+        deleted = prune_changes(options['retention'], options['segment_size'])
+        self.stdout.write('Sequenced %s change log entries, deleted %s.' % (sequenced, deleted))
+        for name, lag in sorted(get_consumer_lags().items()):
+            self.stdout.write('%s: %s entries behind' % (name, lag))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max, OuterRef, Subquery, Value, IntegerField
+from django.db.models.functions import Coalesce
+
+from payment_gateway.models import Invoice, Transaction, FAILED_TRANSACTION_STATUSES
+
+
+class Command(BaseCommand):
+    help = 'Recomputes denormalized attempt counters of invoices from their transactions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of invoice ids updated in one statement.')
+        parser.add_argument('--invoice', type=int, action='append', dest='invoice_ids',
+                            help='Only repair the given invoice, may be repeated.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        queryset = Invoice.objects.order_by('pk')
+        if options['invoice_ids']:
+            queryset = queryset.filter(pk__in=options['invoice_ids'])
+
+        repaired = 0
+        last_pk = 0
+        while True:
+            pks = list(queryset.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            with transaction.atomic():
+                repaired += self.repair(pks[0], pks[-1], queryset)
+            last_pk = pks[-1]
+            self.stdout.write('Repaired invoices up to id %s.' % last_pk)
+        self.stdout.write(self.style.SUCCESS('Repaired %s invoices.' % repaired))
+
+    def repair(self, first_pk: int, last_pk: int, queryset) -> int:
+        transactions = Transaction.objects.filter(invoice=OuterRef('pk')).order_by().values('invoice')
+        attempts = transactions.annotate(count=Count('pk')).values('count')
+        failed_attempts = transactions.filter(status__in=FAILED_TRANSACTION_STATUSES) \
+            .annotate(count=Count('pk')).values('count')
+        last_transaction_at = transactions.annotate(last=Max('created_at')).values('last')
+        return queryset.filter(pk__gte=first_pk, pk__lte=last_pk).update(
+            attempts_count=Coalesce(Subquery(attempts, output_field=IntegerField()), Value(0)),
+            failed_attempts_count=Coalesce(Subquery(failed_attempts, output_field=IntegerField()), Value(0)),
+            last_transaction_at=Subquery(last_transaction_at)
+        )
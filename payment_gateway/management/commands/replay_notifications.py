@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from payment_gateway.replay import read_notifications, replay, skip_recorded
+
+
+class Command(BaseCommand):
+    help = 'Replays CloudPayments and WalletOne notifications from a JSON lines file, one record per line: ' \
+           '{"provider": "cloudpayments" | "walletone", "operation": "check" | "pay" | "confirm", ' \
+           '"body": raw urlencoded body or "payload": fields, "signature": Content-HMAC of CloudPayments}.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSON lines file, - reads standard input.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes, notifications of one invoice always share a worker. '
+                                 '1 replays in this process.')
+        parser.add_argument('--progress-every', type=int, default=1000,
+                            help='Print progress every this many notifications.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Verify, dedupe and validate the notifications without processing them.')
+        parser.add_argument('--no-verify', action='store_false', dest='verify',
+                            help='Skip the CloudPayments HMAC check, WalletOne signatures are always validated.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['path'] == '-':
+            notifications, outcomes = read_notifications(sys.stdin, options['verify'])
+        else:
+            with open(options['path'], encoding='utf-8') as lines:
+                notifications, outcomes = read_notifications(lines, options['verify'])
+        notifications, recorded = skip_recorded(notifications)
+        outcomes.update(recorded)
+        self.stdout.write('Replaying %s notifications, skipped %s.' % (len(notifications), sum(outcomes.values())))
+
+        total = len(notifications)
+        done = 0
+
+        def progress(count):
+            nonlocal done
+            reported = done // options['progress_every']
+            done += count
+            if done // options['progress_every'] > reported or done == total:
+                elapsed = time.perf_counter() - started
+                self.stdout.write('Replayed %s/%s notifications, %.1f/s.' % (done, total, done / elapsed))
+
+        outcomes.update(replay(notifications, options['workers'], options['dry_run'], progress))
+        for outcome, count in sorted(outcomes.items()):
+            self.stdout.write('%s: %s' % (outcome, count))
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS('Replayed %s notifications in %.1fs, %.1f/s%s.' % (
+            total, elapsed, total / elapsed if elapsed else 0, ' (dry run)' if options['dry_run'] else '')))
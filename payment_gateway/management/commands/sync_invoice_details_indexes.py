@@ -0,0 +1,60 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+from django.db.backends.utils import truncate_name
+
+from payment_gateway.models import Invoice
+from payment_gateway.settings import api_settings
+
+INDEX_PREFIX = 'payment_gateway_invoice_details_'
+INDEX_TYPES = {
+    'btree': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS %(name)s ON %(table)s ((details ->> %(key)s))',
+    'gin': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS %(name)s ON %(table)s USING gin ((details -> %(key)s) '
+           'jsonb_path_ops)',
+}
+KEY_RE = re.compile(r'^\w+$')
+
+
+class Command(BaseCommand):
+    help = 'Creates the Invoice.details indexes declared in PAYMENT_GATEWAY_INVOICE_DETAILS_INDEXES, as ' \
+           '{key: "btree" | "gin"}, and drops the ones no longer declared. PostgreSQL only.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=router.db_for_write(Invoice),
+                            help='Database to create the indexes in.')
+        parser.add_argument('--dry-run', action='store_true', help='Only print the statements.')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor != 'postgresql':
+            raise CommandError('Invoice details indexes require PostgreSQL.')
+        statements = self.get_statements(connection)
+        if not statements:
+            self.stdout.write('Invoice details indexes are up to date.')
+        for statement in statements:
+            self.stdout.write(statement)
+            if not options['dry_run']:
+                with connection.cursor() as cursor:
+                    cursor.execute(statement)
+        self.stdout.write(self.style.SUCCESS('Synchronized %s index statements.' % len(statements)))
+
+    def get_statements(self, connection) -> list:
+        table = Invoice._meta.db_table
+        declared = {}
+        for key, index_type in api_settings.INVOICE_DETAILS_INDEXES.items():
+            if not KEY_RE.match(key):
+                raise CommandError('Invalid invoice details key %r.' % key)
+            if index_type not in INDEX_TYPES:
+                raise CommandError('Unknown index type %r for invoice details key %r.' % (index_type, key))
+            name = truncate_name('%s%s_%s' % (INDEX_PREFIX, key, index_type), connection.ops.max_name_length())
+            declared[name] = INDEX_TYPES[index_type] % {'name': connection.ops.quote_name(name),
+                                                        'table': connection.ops.quote_name(table),
+                                                        'key': "'%s'" % key}
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+            existing = {name for name, in cursor.fetchall() if name.startswith(INDEX_PREFIX)}
+        statements = ['DROP INDEX CONCURRENTLY IF EXISTS %s' % connection.ops.quote_name(name)
+                      for name in sorted(existing - set(declared))]
+        statements.extend(declared[name] for name in sorted(set(declared) - existing))
+        return statements
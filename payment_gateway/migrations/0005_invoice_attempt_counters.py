@@ -0,0 +1,28 @@
+# Generated by Django 2.2.4 on 2026-10-19 04:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment_gateway', '0004_auto_20200402_1536'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='attempts_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='attempts count'),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='failed_attempts_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='failed attempts count'),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='last_transaction_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='last transaction at'),
+        ),
+    ]
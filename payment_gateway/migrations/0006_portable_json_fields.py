@@ -0,0 +1,34 @@
+# Generated by Django 2.2.4 on 2026-10-19 04:52
+
+from django.db import migrations
+import payment_gateway.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment_gateway', '0005_invoice_attempt_counters'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cloudpaymentstransaction',
+            name='Data',
+            field=payment_gateway.fields.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='invoice',
+            name='details',
+            field=payment_gateway.fields.JSONField(blank=True, default=dict, null=True, verbose_name='details'),
+        ),
+        migrations.AlterField(
+            model_name='invoicestatuschange',
+            name='details',
+            field=payment_gateway.fields.JSONField(blank=True, default=dict, null=True, verbose_name='details'),
+        ),
+        migrations.AlterField(
+            model_name='transactionstatuschange',
+            name='details',
+            field=payment_gateway.fields.JSONField(blank=True, default=dict, null=True, verbose_name='details'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-19 05:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment_gateway', '0006_portable_json_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='external_reference',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True, verbose_name='external reference'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.4 on 2026-10-19 05:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment_gateway', '0007_invoice_external_reference'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingCallback',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('callback', models.CharField(max_length=128, verbose_name='callback')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('available_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='available at')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='payment_gateway.Invoice', verbose_name='invoice')),
+            ],
+            options={
+                'verbose_name': 'pending callback',
+                'verbose_name_plural': 'pending callbacks',
+            },
+        ),
+    ]
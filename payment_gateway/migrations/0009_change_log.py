@@ -0,0 +1,43 @@
+# Generated by Django 2.2.4 on 2026-10-19 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment_gateway', '0008_pending_callback'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogConsumer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True, verbose_name='name')),
+                ('offset', models.BigIntegerField(default=0, verbose_name='offset')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+            ],
+            options={
+                'verbose_name': 'change log consumer',
+                'verbose_name_plural': 'change log consumers',
+            },
+        ),
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('offset', models.BigIntegerField(blank=True, null=True, unique=True, verbose_name='offset')),
+                ('entity', models.PositiveSmallIntegerField(choices=[(0, 'INVOICE'), (1, 'TRANSACTION')], verbose_name='entity')),
+                ('object_id', models.PositiveIntegerField(verbose_name='object id')),
+                ('invoice_id', models.PositiveIntegerField(verbose_name='invoice id')),
+                ('from_status', models.PositiveSmallIntegerField(verbose_name='from status')),
+                ('to_status', models.PositiveSmallIntegerField(verbose_name='to status')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+            ],
+            options={
+                'verbose_name': 'change log entry',
+                'verbose_name_plural': 'change log entries',
+            },
+        ),
+    ]
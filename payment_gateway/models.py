@@ -1,9 +1,12 @@
+from collections import defaultdict
 from enum import Enum
 
-from django.contrib.postgres.fields import JSONField
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+from payment_gateway.fields import JSONField
+
 
 class ModelChoice(Enum):
     @classmethod
@@ -34,6 +37,10 @@ class TransactionType(int, ModelChoice):
     CLOUDPAYMENTS = 2
 
 
+FAILED_TRANSACTION_STATUSES = (TransactionStatus.DECLINED, TransactionStatus.INVALID_MONEY_AMOUNT,
+                               TransactionStatus.INVOICE_EXPIRED, TransactionStatus.ERROR)
+
+
 class Invoice(models.Model):
     total = models.DecimalField(_('total'), max_digits=11, decimal_places=2)
     captured_total = models.DecimalField(_('captured total'), max_digits=11, decimal_places=2, null=True, blank=True)
@@ -46,12 +53,32 @@ class Invoice(models.Model):
     created_at = models.DateTimeField(_('created at'), auto_now_add=True)
     modified_at = models.DateTimeField(_('modified at'), auto_now=True)
     details = JSONField(_('details'), null=True, blank=True, default=dict)
+    attempts_count = models.PositiveIntegerField(_('attempts count'), default=0)
+    failed_attempts_count = models.PositiveIntegerField(_('failed attempts count'), default=0)
+    last_transaction_at = models.DateTimeField(_('last transaction at'), null=True, blank=True)
+    external_reference = models.CharField(_('external reference'), max_length=255, unique=True, null=True,
+                                          blank=True)
 
     class Meta:
         verbose_name = _('invoice')
         verbose_name_plural = _('invoices')
 
 
+class TransactionQuerySet(models.QuerySet):
+    def as_subtypes(self) -> list:
+        transactions = list(self)
+        pks_by_type = defaultdict(list)
+        for transaction in transactions:
+            pks_by_type[transaction.type].append(transaction.pk)
+        subtypes = {}
+        for transaction_type, pks in pks_by_type.items():
+            model = TRANSACTION_SUBTYPES.get(transaction_type)
+            if model is None or model is self.model:
+                continue
+            subtypes.update(model.objects.in_bulk(pks))
+        return [subtypes.get(transaction.pk, transaction) for transaction in transactions]
+
+
 class Transaction(models.Model):
     invoice = models.ForeignKey(to='payment_gateway.Invoice', on_delete=models.CASCADE, related_name='transactions',
                                 verbose_name=_('invoice'))
@@ -61,6 +88,8 @@ class Transaction(models.Model):
     created_at = models.DateTimeField(_('created at'), auto_now_add=True)
     modified_at = models.DateTimeField(_('modified at'), auto_now=True)
 
+    objects = TransactionQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('transaction')
         verbose_name_plural = _('transactions')
@@ -155,3 +184,51 @@ class CloudPaymentsTransaction(Transaction):
     class Meta:
         verbose_name = _('cloudpayments transaction')
         verbose_name_plural = _('cloudpayments transactions')
+
+
+class PendingCallback(models.Model):
+    invoice = models.ForeignKey('payment_gateway.Invoice', on_delete=models.CASCADE, verbose_name=_('invoice'))
+    callback = models.CharField(_('callback'), max_length=128)
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+    available_at = models.DateTimeField(_('available at'), default=timezone.now, db_index=True)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    class Meta:
+        verbose_name = _('pending callback')
+        verbose_name_plural = _('pending callbacks')
+
+
+class ChangeLogEntity(int, ModelChoice):
+    INVOICE = 0
+    TRANSACTION = 1
+
+
+class ChangeLogEntry(models.Model):
+    offset = models.BigIntegerField(_('offset'), unique=True, null=True, blank=True)
+    entity = models.PositiveSmallIntegerField(_('entity'), choices=ChangeLogEntity.choices())
+    object_id = models.PositiveIntegerField(_('object id'))
+    invoice_id = models.PositiveIntegerField(_('invoice id'))
+    from_status = models.PositiveSmallIntegerField(_('from status'))
+    to_status = models.PositiveSmallIntegerField(_('to status'))
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('change log entry')
+        verbose_name_plural = _('change log entries')
+
+
+class ChangeLogConsumer(models.Model):
+    name = models.CharField(_('name'), max_length=64, unique=True)
+    offset = models.BigIntegerField(_('offset'), default=0)
+    updated_at = models.DateTimeField(_('updated at'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('change log consumer')
+        verbose_name_plural = _('change log consumers')
+
+
+TRANSACTION_SUBTYPES = {
+    TransactionType.WALLETONE: WalletOneTransaction,
+    TransactionType.CLOUDPAYMENTS: CloudPaymentsTransaction,
+}
@@ -0,0 +1,171 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from datetime import datetime
+
+from django.core.signals import setting_changed
+from django.db import connections
+
+from payment_gateway.settings import api_settings
+
+logger = logging.getLogger(__name__)
+
+INVOICE_ID_KEYS = ('invoice_id', 'InvoiceId', 'WMI_PAYMENT_NO')
+TRANSACTION_ID_KEYS = ('transaction_id', 'TransactionId', 'WMI_ORDER_ID')
+REPORT_EXTENSIONS = ('.prof', '.json')
+
+
+def get_request_ids(request, response) -> dict:
+    sources = [getattr(response, 'data', None), getattr(request, 'data', None)]
+    try:
+        sources.append(request.POST)
+    except Exception:
+        pass
+    ids = {}
+    for source in sources:
+        if not hasattr(source, 'get'):
+            continue
+        for name, keys in (('invoice_id', INVOICE_ID_KEYS), ('transaction_id', TRANSACTION_ID_KEYS)):
+            for key in keys:
+                if ids.get(name) is None and source.get(key) is not None:
+                    ids[name] = str(source.get(key))
+    return ids
+
+
+class SlowRequestProfiler(object):
+    """
+    Profiles a `sample_rate` share of requests and keeps the cProfile stats and the SQL of those slower than
+    `threshold` seconds in `directory`. The oldest reports are deleted beyond `max_files` reports or `max_bytes`.
+    Query parameters are never written since they carry payment details.
+    """
+
+    def __init__(self, directory: str, threshold: float = 1.0, sample_rate: float = 1.0, max_files: int = 100,
+                 max_bytes: int = 50 * 1024 * 1024):
+        self.directory = directory
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def profile(self, func, *args, **kwargs):
+        if getattr(self._local, 'active', False) or random.random() >= self.sample_rate:
+            return func(*args, **kwargs)
+        queries = []
+        profiler = cProfile.Profile()
+        self._local.active = True
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    wrapper = functools.partial(self.record_query, queries, alias)
+                    stack.enter_context(connections[alias].execute_wrapper(wrapper))
+                profiler.enable()
+                response = func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            self._local.active = False
+        duration = time.perf_counter() - start
+        if duration >= self.threshold:
+            request = next((arg for arg in args if hasattr(arg, 'META')), None)
+            try:
+                self.write_report(request, response, profiler, queries, duration)
+            except OSError:
+                logger.warning('Could not write slow request profile.', exc_info=True)
+        return response
+
+    def record_query(self, queries, alias, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries.append({'alias': alias, 'sql': sql, 'many': many, 'duration': time.perf_counter() - start})
+
+    def write_report(self, request, response, profiler: cProfile.Profile, queries: list, duration: float):
+        name = '%s-%d-%d' % (datetime.now().strftime('%Y%m%dT%H%M%S%f'), os.getpid(), threading.get_ident())
+        path = os.path.join(self.directory, name)
+        report = {
+            'method': getattr(request, 'method', None),
+            'path': getattr(request, 'path', None),
+            'status': getattr(response, 'status_code', None),
+            'duration': duration,
+            'queries': queries,
+        }
+        report.update(get_request_ids(request, response))
+        profiler.dump_stats(path + '.prof')
+        with open(path + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info('Slow request profiled.', extra={'path': report['path'], 'duration': duration,
+                                                     'invoice_id': report.get('invoice_id'), 'report': path})
+        with self._lock:
+            self.rotate()
+
+    def rotate(self):
+        reports = defaultdict(list)
+        for entry in os.scandir(self.directory):
+            stem, extension = os.path.splitext(entry.name)
+            if extension in REPORT_EXTENSIONS and entry.is_file():
+                reports[stem].append(entry)
+        total_bytes = 0
+        newest_first = sorted(reports.values(), key=lambda entries: max(e.stat().st_mtime for e in entries),
+                              reverse=True)
+        for kept, entries in enumerate(newest_first):
+            total_bytes += sum(e.stat().st_size for e in entries)
+            if kept >= self.max_files or total_bytes > self.max_bytes:
+                for entry in entries:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+
+_UNRESOLVED = object()
+_profiler = _UNRESOLVED
+
+
+def get_profiler():
+    """
+    PAYMENT_GATEWAY_SLOW_REQUEST_PROFILER holds the SlowRequestProfiler arguments, profiling is off until it sets
+    a `directory`.
+    """
+    global _profiler
+    if _profiler is _UNRESOLVED:
+        config = api_settings.SLOW_REQUEST_PROFILER
+        _profiler = SlowRequestProfiler(**config) if config.get('directory') else None
+    return _profiler
+
+
+def reset_profiler(*args, **kwargs):
+    global _profiler
+    if kwargs.get('setting', 'PAYMENT_GATEWAY').startswith('PAYMENT_GATEWAY'):
+        _profiler = _UNRESOLVED
+
+
+setting_changed.connect(reset_profiler)
+
+
+def profile_slow_requests(view_func):
+    @functools.wraps(view_func)
+    def wrapper(*args, **kwargs):
+        profiler = _profiler if _profiler is not _UNRESOLVED else get_profiler()
+        if profiler is None:
+            return view_func(*args, **kwargs)
+        return profiler.profile(view_func, *args, **kwargs)
+    return wrapper
+
+
+class SlowRequestProfilerMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = profile_slow_requests(get_response)
+
+    def __call__(self, request):
+        return self.get_response(request)
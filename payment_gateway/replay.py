@@ -0,0 +1,193 @@
+import json
+import logging
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import as_completed
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import QueryDict
+from rest_framework.exceptions import ValidationError
+
+from payment_gateway.cloudpayments.provider import NotificationValidator
+from payment_gateway.cloudpayments.serializers import CloudPaymentsCheckSerializer, CloudPaymentsPaySerializer
+from payment_gateway.dto import slotted_dataclass
+from payment_gateway.errors import PaymentError
+from payment_gateway.identity import invoice_scope
+from payment_gateway.models import CloudPaymentsTransaction, TransactionStatus
+from payment_gateway.routers import primary_pin_scope
+from payment_gateway.schema import CompiledSchema
+from payment_gateway.sharding import ShardedExecutor
+from payment_gateway.walletone.provider import WalletOneException
+from payment_gateway.walletone.serializers import WalletOneConfirmSerializer
+
+logger = logging.getLogger(__name__)
+
+REPLAY_SCHEMAS = {
+    ('cloudpayments', 'check'): CompiledSchema(CloudPaymentsCheckSerializer),
+    ('cloudpayments', 'pay'): CompiledSchema(CloudPaymentsPaySerializer),
+    ('walletone', 'confirm'): CompiledSchema(WalletOneConfirmSerializer),
+}
+DEFAULT_OPERATIONS = {
+    'walletone': 'confirm',
+}
+# Field identifying a notification of a provider and the field with the invoice reference.
+NOTIFICATION_KEYS = {
+    'cloudpayments': ('TransactionId', 'InvoiceId'),
+    'walletone': ('WMI_ORDER_ID', 'WMI_PAYMENT_NO'),
+}
+
+
+@slotted_dataclass
+class Notification:
+    line: int
+    provider: str
+    operation: str
+    data: dict
+    key: tuple
+    invoice_reference: str
+
+    @property
+    def outcome_prefix(self) -> str:
+        return '%s.%s' % (self.provider, self.operation)
+
+
+def parse_notification(line: int, record: dict, validator: NotificationValidator = None) -> Notification:
+    """
+    Records are {"provider", "operation", "body"} with the raw urlencoded body, or "payload" with the decoded
+    fields. CloudPayments records also carry the Content-HMAC header as "signature", which is computed over the
+    raw body, so only records with a body can be verified. Returns None when the signature does not match.
+    """
+    provider = record['provider']
+    operation = record.get('operation', DEFAULT_OPERATIONS.get(provider))
+    if (provider, operation) not in REPLAY_SCHEMAS:
+        raise ValueError('Unknown notification %s.%s.' % (provider, operation))
+    body = record.get('body')
+    data = QueryDict(body) if body is not None else record['payload']
+    if provider == 'cloudpayments' and validator is not None:
+        signature = record.get('signature')
+        if body is None or signature is None or not validator.validate(body.encode(), signature):
+            return None
+    key_field, reference_field = NOTIFICATION_KEYS[provider]
+    return Notification(line, provider, operation, data, (provider, operation, str(data.get(key_field))),
+                        str(data.get(reference_field)))
+
+
+def read_notifications(lines, verify: bool = True) -> (list, Counter):
+    """
+    Parses JSON lines into notifications, dropping malformed records, records with a bad signature and repeated
+    deliveries of the same notification, which are counted in the returned outcomes.
+    """
+    validator = NotificationValidator() if verify else None
+    outcomes = Counter()
+    seen = set()
+    notifications = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            notification = parse_notification(number, json.loads(line), validator)
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Skipping malformed notification.', extra={'line': number})
+            outcomes['malformed'] += 1
+            continue
+        if notification is None:
+            outcomes['bad_signature'] += 1
+        elif notification.key in seen:
+            outcomes['%s.duplicate' % notification.outcome_prefix] += 1
+        else:
+            seen.add(notification.key)
+            notifications.append(notification)
+    return notifications, outcomes
+
+
+def skip_recorded(notifications: list, batch_size: int = 1000) -> (list, Counter):
+    """
+    Drops CloudPayments checks whose transaction is already stored and payments whose transaction already
+    succeeded: a second check would store the TransactionId twice and a second payment would decline it.
+    WalletOne payments are idempotent by WMI_ORDER_ID and always replayed.
+    """
+    transaction_ids = set()
+    for notification in notifications:
+        if notification.provider == 'cloudpayments' and notification.key[2].isdigit():
+            transaction_ids.add(int(notification.key[2]))
+    statuses = defaultdict(set)
+    transaction_ids = sorted(transaction_ids)
+    for start in range(0, len(transaction_ids), batch_size):
+        rows = CloudPaymentsTransaction.objects.filter(TransactionId__in=transaction_ids[start:start + batch_size]) \
+            .values_list('TransactionId', 'status')
+        for transaction_id, status in rows:
+            statuses[str(transaction_id)].add(status)
+    outcomes = Counter()
+    remaining = []
+    for notification in notifications:
+        recorded = statuses.get(notification.key[2]) if notification.provider == 'cloudpayments' else None
+        if recorded is not None and (notification.operation == 'check' or TransactionStatus.SUCCESS in recorded):
+            outcomes['%s.recorded' % notification.outcome_prefix] += 1
+        else:
+            remaining.append(notification)
+    return remaining, outcomes
+
+
+def group_by_invoice(notifications: list) -> OrderedDict:
+    """
+    Groups notifications by invoice reference in file order, a check is always replayed before its payment.
+    """
+    by_invoice = OrderedDict()
+    for notification in notifications:
+        by_invoice.setdefault(notification.invoice_reference, []).append(notification)
+    return by_invoice
+
+
+@primary_pin_scope()
+def replay_notification(notification: Notification, dry_run: bool = False) -> str:
+    schema = REPLAY_SCHEMAS[notification.provider, notification.operation]
+    prefix = notification.outcome_prefix
+    with invoice_scope():
+        try:
+            validated_data = schema.validate(notification.data)
+        except ValidationError:
+            return '%s.invalid' % prefix
+        except WalletOneException as e:
+            return '%s.%s' % (prefix, e.code)
+        if dry_run:
+            return '%s.valid' % prefix
+        try:
+            result = schema.serializer_class().create(validated_data)
+        except PaymentError as e:
+            return '%s.%s' % (prefix, e.get_codes())
+        except WalletOneException as e:
+            return '%s.%s' % (prefix, e.code)
+        except ObjectDoesNotExist:
+            return '%s.not_found' % prefix
+        except Exception:
+            logger.exception('Replaying notification failed.', extra={'line': notification.line})
+            return '%s.error' % prefix
+    if isinstance(result, dict):
+        return '%s.%s' % (prefix, result['code'].name.lower())
+    return '%s.ok' % prefix
+
+
+def replay_group(notifications: list, dry_run: bool = False) -> Counter:
+    return Counter(replay_notification(notification, dry_run) for notification in notifications)
+
+
+def replay(notifications: list, workers: int = 1, dry_run: bool = False, progress=None) -> Counter:
+    """
+    Replays the notifications of every invoice on the worker process its reference hashes to, or in this process
+    with a single worker. `progress` is called with the number of notifications of every finished invoice.
+    """
+    groups = group_by_invoice(notifications)
+    outcomes = Counter()
+    if workers <= 1:
+        for group in groups.values():
+            outcomes.update(replay_group(group, dry_run))
+            if progress is not None:
+                progress(len(group))
+        return outcomes
+    with ShardedExecutor(workers) as executor:
+        futures = {executor.submit(reference, replay_group, group, dry_run): len(group)
+                   for reference, group in groups.items()}
+        for future in as_completed(futures):
+            outcomes.update(future.result())
+            if progress is not None:
+                progress(futures[future])
+    return outcomes
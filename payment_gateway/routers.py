@@ -0,0 +1,78 @@
+import random
+import threading
+from contextlib import contextmanager
+
+from django.core.signals import request_finished, request_started
+from django.db import connections
+
+from payment_gateway.settings import api_settings
+
+_state = threading.local()
+
+
+def pin_to_primary():
+    _state.pinned = True
+
+
+def unpin_from_primary(*args, **kwargs):
+    _state.pinned = False
+
+
+def is_pinned_to_primary() -> bool:
+    return getattr(_state, 'pinned', False)
+
+
+@contextmanager
+def primary_pin_scope():
+    """
+    Starts unpinned and restores the previous pin on exit. Units of work outside the request cycle, such as a
+    recurring charge, a replayed notification or a callback flush, run in it so that their first write does not
+    pin the thread or process to the primary for good. Usable as a decorator.
+    """
+    previous = is_pinned_to_primary()
+    _state.pinned = False
+    try:
+        yield
+    finally:
+        _state.pinned = previous
+
+
+class ReplicaRouter(object):
+    """
+    Sends reads of payment gateway models to PAYMENT_GATEWAY_DATABASE_REPLICAS and writes, row locks and reads
+    inside atomic blocks to PAYMENT_GATEWAY_DATABASE_PRIMARY. Once a request or a primary_pin_scope writes, its
+    remaining reads stick to the primary.
+    Enable it with DATABASE_ROUTERS = ['payment_gateway.routers.ReplicaRouter'].
+    """
+
+    def is_routed(self, app_label: str) -> bool:
+        return app_label in api_settings.DATABASE_ROUTED_APP_LABELS
+
+    def db_for_read(self, model, **hints):
+        if not self.is_routed(model._meta.app_label):
+            return None
+        primary = api_settings.DATABASE_PRIMARY
+        replicas = api_settings.DATABASE_REPLICAS
+        if not replicas or is_pinned_to_primary() or connections[primary].in_atomic_block:
+            return primary
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if not self.is_routed(model._meta.app_label):
+            return None
+        pin_to_primary()
+        return api_settings.DATABASE_PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self.is_routed(obj1._meta.app_label) and self.is_routed(obj2._meta.app_label):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not self.is_routed(app_label):
+            return None
+        return db == api_settings.DATABASE_PRIMARY
+
+
+request_started.connect(unpin_from_primary)
+request_finished.connect(unpin_from_primary)
@@ -0,0 +1,121 @@
+import re
+from collections import OrderedDict
+from collections.abc import Mapping
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from rest_framework import fields as drf_fields
+from rest_framework.exceptions import ValidationError
+from rest_framework.serializers import as_serializer_error
+from rest_framework.settings import api_settings as drf_settings
+
+from payment_gateway.settings import api_settings
+from payment_gateway.tracing import span
+
+_integer_re = re.compile(r'-?[0-9]+\Z')
+
+
+class CompiledSchema(object):
+    """
+    Validates payloads with the writable fields of a serializer class without instantiating the serializer per
+    request. Plain char and integer fields get inlined converters, the other fields, validate_<field> methods and
+    the serializer validate() run exactly as in Serializer.is_valid(), so results and error codes are identical.
+    """
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self._serializer = None
+        self._fields = None
+
+    def compile(self):
+        serializer = self.serializer_class()
+        compiled = []
+        for field in serializer._writable_fields:
+            validate_method = getattr(serializer, 'validate_' + field.field_name, None)
+            compiled.append((field, self.compile_field(field), validate_method))
+        self._serializer = serializer
+        self._fields = compiled
+
+    def compile_field(self, field: drf_fields.Field):
+        if type(field) is drf_fields.CharField:
+            return self.compile_char_field(field)
+        if type(field) is drf_fields.IntegerField:
+            return self.compile_integer_field(field)
+        return field.run_validation
+
+    def compile_char_field(self, field: drf_fields.CharField):
+        run_validation = field.run_validation
+        run_validators = field.run_validators if field.validators else None
+        trim_whitespace = field.trim_whitespace
+
+        def to_internal_value(data):
+            if data.__class__ is not str:
+                return run_validation(data)
+            value = data.strip() if trim_whitespace else data
+            if not value:
+                return run_validation(data)
+            if run_validators is not None:
+                run_validators(value)
+            return value
+        return to_internal_value
+
+    def compile_integer_field(self, field: drf_fields.IntegerField):
+        run_validation = field.run_validation
+        run_validators = field.run_validators if field.validators else None
+        match = _integer_re.match
+
+        def to_internal_value(data):
+            if data.__class__ is not str or len(data) > field.MAX_STRING_LENGTH or match(data) is None:
+                return run_validation(data)
+            value = int(data)
+            if run_validators is not None:
+                run_validators(value)
+            return value
+        return to_internal_value
+
+    def validate(self, data) -> OrderedDict:
+        if self._fields is None:
+            self.compile()
+        serializer = self._serializer
+        if not isinstance(data, Mapping):
+            message = serializer.error_messages['invalid'].format(datatype=type(data).__name__)
+            raise ValidationError({drf_settings.NON_FIELD_ERRORS_KEY: [message]}, code='invalid')
+
+        ret = OrderedDict()
+        errors = OrderedDict()
+        for field, to_internal_value, validate_method in self._fields:
+            try:
+                value = to_internal_value(field.get_value(data))
+                if validate_method is not None:
+                    value = validate_method(value)
+            except ValidationError as exc:
+                errors[field.field_name] = exc.detail
+            except DjangoValidationError as exc:
+                errors[field.field_name] = drf_fields.get_error_detail(exc)
+            except drf_fields.SkipField:
+                pass
+            else:
+                drf_fields.set_value(ret, field.source_attrs, value)
+        if errors:
+            raise ValidationError(errors)
+
+        try:
+            if serializer.validators:
+                serializer.run_validators(ret)
+            ret = serializer.validate(ret)
+        except (ValidationError, DjangoValidationError) as exc:
+            raise ValidationError(detail=as_serializer_error(exc))
+        return ret
+
+
+class CompiledSchemaMixin(object):
+    payload_schema = None
+
+    def validate_and_save(self, request):
+        if self.payload_schema is not None and api_settings.FAST_PAYLOAD_PARSER:
+            with span('parse', serializer=self.serializer_class.__name__):
+                validated_data = self.payload_schema.validate(request.data)
+            return self.get_serializer().create(validated_data)
+        serializer = self.get_serializer(data=request.data)
+        with span('parse', serializer=self.serializer_class.__name__):
+            serializer.is_valid(raise_exception=True)
+        return serializer.save()
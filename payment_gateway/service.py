@@ -1,15 +1,48 @@
+import json
 from datetime import datetime
 from decimal import Decimal
 
-from django.db import transaction
+from django.db import connections, transaction
+from django.db.models import QuerySet, TextField
 
+from .changelog import make_invoice_change, record_changes
 from .models import Invoice, InvoiceStatus, InvoiceStatusChange
+from .settings import api_settings
 
 
 def create_invoice(total: Decimal, success_callback: str, fail_callback: str = None,
-                   expires_at: datetime = None, details: dict = None) -> Invoice:
+                   expires_at: datetime = None, details: dict = None, external_reference: str = None) -> Invoice:
     return Invoice.objects.create(total=total, expires_at=expires_at, success_callback=success_callback,
-                                  fail_callback=fail_callback, status=InvoiceStatus.PENDING, details=details)
+                                  fail_callback=fail_callback, status=InvoiceStatus.PENDING, details=details,
+                                  external_reference=external_reference)
+
+
+def get_invoice_by_external_reference(external_reference: str) -> Invoice:
+    return Invoice.objects.get(external_reference=external_reference)
+
+
+def filter_invoices_by_detail(key: str, value, queryset: QuerySet = None) -> QuerySet:
+    """
+    On PostgreSQL the condition matches the index declared for `key` in PAYMENT_GATEWAY_INVOICE_DETAILS_INDEXES,
+    see the sync_invoice_details_indexes command: containment for 'gin', text equality otherwise. Other databases
+    use the key lookups of the JSONField, and without them (Django < 3.1) the details are compared in Python.
+    """
+    queryset = Invoice.objects.all() if queryset is None else queryset
+    if connections[queryset.db].vendor != 'postgresql':
+        if Invoice._meta.get_field('details').get_transform(key) is not None:
+            return queryset.filter(**{'details__%s' % key: value})
+        matching = [pk for pk, details in queryset.values_list('pk', 'details').iterator()
+                    if isinstance(details, dict) and key in details and details[key] == value]
+        return queryset.filter(pk__in=matching)
+    try:
+        from django.db.models.fields.json import KeyTextTransform, KeyTransform
+    except ImportError:  # Django < 3.1
+        from django.contrib.postgres.fields.jsonb import KeyTextTransform, KeyTransform
+    alias = getattr(queryset, 'alias', queryset.annotate)
+    if api_settings.INVOICE_DETAILS_INDEXES.get(key) == 'gin':
+        return alias(details_value=KeyTransform(key, 'details')).filter(details_value__contains=value)
+    value = value if isinstance(value, str) else json.dumps(value)
+    return alias(details_text=KeyTextTransform(key, 'details', output_field=TextField())).filter(details_text=value)
 
 
 def cancel_invoice_by_id(invoice_id: int) -> Invoice:
@@ -39,12 +72,13 @@ def expire_invoice(invoice: Invoice) -> Invoice:
 def _set_invoice_status(invoice: Invoice, status: InvoiceStatus) -> Invoice:
     old_status = invoice.status
     invoice.status = status
-    invoice.save()
+    invoice.save(update_fields=['status', 'modified_at'])
     _write_invoice_history(invoice, old_status)
     return invoice
 
 
 def _write_invoice_history(invoice: Invoice, old_status) -> InvoiceStatusChange:
+    record_changes([make_invoice_change(invoice, old_status, invoice.status)])
     return InvoiceStatusChange.objects.create(
         invoice=invoice,
         from_status=old_status,
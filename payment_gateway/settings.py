@@ -1,12 +1,50 @@
 from django.conf import settings
 from django.core.signals import setting_changed
 
+DEFAULTS = {
+    'CLOUDPAYMENTS_PUBLIC_ID': None,
+    'CLOUDPAYMENTS_API_URL': 'https://api.cloudpayments.ru',
+    'CLOUDPAYMENTS_API_TIMEOUT': 10,
+    'CLOUDPAYMENTS_API_MAX_RETRIES': 3,
+    'CLOUDPAYMENTS_API_BACKOFF': 0.5,
+    'CLOUDPAYMENTS_API_POOL_SIZE': 10,
+    'CLOUDPAYMENTS_RECURRING_CONCURRENCY': 8,
+    'CLOUDPAYMENTS_VELOCITY_RULES': [],
+    'CLOUDPAYMENTS_VELOCITY_CACHE': None,
+    'CLOUDPAYMENTS_VELOCITY_MAX_KEYS': 10000,
+    'BATCHED_CALLBACKS': False,
+    'CALLBACK_BATCH_WINDOW': 1.0,
+    'CALLBACK_BATCH_SIZE': 100,
+    'CALLBACK_RETRY_DELAY': 60,
+    'CHANGE_LOG': False,
+    'CHANGE_LOG_BATCH_SIZE': 1000,
+    'CHANGE_LOG_RETENTION': 7 * 24 * 3600,
+    'CHANGE_LOG_SEGMENT_SIZE': 10000,
+    'CONCURRENCY_MODES': {},
+    'DATABASE_CIRCUIT_BREAKER': None,
+    'DUMMY_FAULTS': {},
+    'EXTERNAL_REFERENCE_PROVIDERS': (),
+    'FAST_PAYLOAD_PARSER': False,
+    'INVOICE_DETAILS_INDEXES': {},
+    'SLOW_REQUEST_PROFILER': {},
+    'TRACER': None,
+    'WALLETONE_BATCH_SIGN_MAX_INVOICES': 100,
+    'WALLETONE_MERCHANTS': {},
+    'WEBHOOK_THROTTLE_RATES': {},
+    'WEBHOOK_THROTTLE_CACHE': None,
+    'WEBHOOK_THROTTLE_MAX_KEYS': 10000,
+    'DATABASE_PRIMARY': 'default',
+    'DATABASE_REPLICAS': (),
+    'DATABASE_ROUTED_APP_LABELS': ('payment_gateway',),
+}
+
 
 class APISettings:
     prefix = None
 
-    def __init__(self, prefix: str = None):
+    def __init__(self, prefix: str = None, defaults: dict = None):
         self.prefix = prefix
+        self.defaults = defaults or {}
         self._cached_attrs = set()
 
     def prefixed_attr(self, attr):
@@ -15,8 +53,10 @@ class APISettings:
         return "%s_%s" % (self.prefix.upper(), attr.upper())
 
     def __getattr__(self, attr):
-
-        val = getattr(settings, self.prefixed_attr(attr))
+        if attr in self.defaults:
+            val = getattr(settings, self.prefixed_attr(attr), self.defaults[attr])
+        else:
+            val = getattr(settings, self.prefixed_attr(attr))
 
         # Cache the result
         self._cached_attrs.add(attr)
@@ -29,12 +69,12 @@ class APISettings:
         self._cached_attrs.clear()
 
 
-api_settings = APISettings('PAYMENT_GATEWAY')
+api_settings = APISettings('PAYMENT_GATEWAY', DEFAULTS)
 
 
 def reload_api_settings(*args, **kwargs):
     setting = kwargs['setting']
-    if setting == 'PAYMENT_GATEWAY':
+    if setting.startswith('PAYMENT_GATEWAY'):
         api_settings.reload()
 
 
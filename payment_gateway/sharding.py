@@ -0,0 +1,231 @@
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.db import connections
+
+from payment_gateway.routers import primary_pin_scope
+
+logger = logging.getLogger(__name__)
+
+
+class ConsistentHashRing(object):
+    """
+    Maps keys to shards through `replicas` virtual nodes per shard, adding or removing a shard only moves the
+    keys of that shard.
+    """
+
+    def __init__(self, shards=(), replicas: int = 64):
+        self.replicas = replicas
+        self.shards = set()
+        self._hashes = []
+        self._nodes = {}
+        for shard in shards:
+            self.add(shard)
+
+    @staticmethod
+    def hash(value) -> int:
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+    def add(self, shard):
+        self.shards.add(shard)
+        for replica in range(self.replicas):
+            node = self.hash('%s:%s' % (shard, replica))
+            self._nodes[node] = shard
+            bisect.insort(self._hashes, node)
+
+    def remove(self, shard):
+        self.shards.discard(shard)
+        for replica in range(self.replicas):
+            node = self.hash('%s:%s' % (shard, replica))
+            del self._nodes[node]
+            self._hashes.remove(node)
+
+    def get(self, key):
+        if not self._hashes:
+            raise LookupError('The ring has no shards.')
+        index = bisect.bisect(self._hashes, self.hash(key)) % len(self._hashes)
+        return self._nodes[self._hashes[index]]
+
+
+def run_shard(tasks, results):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, func, args = task
+        try:
+            with primary_pin_scope():
+                result = func(*args)
+            results.put((task_id, True, result))
+        except Exception as e:
+            logger.warning('Sharded task failed.', exc_info=True)
+            results.put((task_id, False, RuntimeError(repr(e))))
+    connections.close_all()
+
+
+class ShardedExecutor(object):
+    """
+    Runs work in forked worker processes, one local queue each, choosing the worker by consistent hash of a key
+    such as the invoice id. Work for one key runs in submission order on one worker, different keys run in
+    parallel. A key keeps its worker while it has work in flight there, so `resize` never lets two workers
+    process the same key; workers removed by a resize stop once their last key is drained. When a worker dies,
+    its pending futures fail and the next work for its shard starts a new one.
+    """
+
+    def __init__(self, shards: int, replicas: int = 64, poll_interval: float = 0.5):
+        self._context = multiprocessing.get_context('fork')
+        self._ring = ConsistentHashRing(replicas=replicas)
+        self._workers = {}
+        self._stopped = []
+        self._futures = {}
+        self._in_flight = {}
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._results = self._context.Queue()
+        self.poll_interval = poll_interval
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        self.resize(shards)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    @property
+    def shards(self) -> int:
+        return len(self._ring.shards)
+
+    def route(self, key):
+        in_flight = self._in_flight.get(key)
+        return in_flight[0] if in_flight is not None else self._ring.get(key)
+
+    def submit(self, key, func, *args) -> Future:
+        future = Future()
+        while True:
+            with self._lock:
+                shard = self.route(key)
+                worker = self._workers.get(shard)
+                if worker is not None:
+                    task_id = next(self._task_ids)
+                    self._futures[task_id] = future, key
+                    self._in_flight[key] = shard, self._in_flight.get(key, (shard, 0))[1] + 1
+                    worker[1].put((task_id, func, args))
+                    return future
+            self._start_workers([shard])
+
+    def resize(self, shards: int):
+        self._start_workers(range(shards))
+        with self._lock:
+            for shard in range(shards):
+                if shard not in self._ring.shards:
+                    self._ring.add(shard)
+            for shard in self._ring.shards - set(range(shards)):
+                self._ring.remove(shard)
+            self._stop_drained()
+        logger.info('Resized sharded executor.', extra={'shards': shards})
+
+    def _start_workers(self, shards):
+        # Workers are forked outside of the lock, without the parent's database sockets.
+        with self._lock:
+            missing = [shard for shard in shards if shard not in self._workers]
+        if not missing:
+            return
+        connections.close_all()
+        started = {shard: self._start() for shard in missing}
+        with self._lock:
+            for shard, worker in started.items():
+                if shard in self._workers:
+                    self._stop(worker)
+                else:
+                    self._workers[shard] = worker
+
+    def _start(self) -> tuple:
+        tasks = self._context.Queue()
+        process = self._context.Process(target=run_shard, args=(tasks, self._results), daemon=True)
+        process.start()
+        return process, tasks
+
+    def _stop(self, worker: tuple):
+        process, tasks = worker
+        tasks.put(None)
+        self._stopped.append(process)
+
+    def _stop_drained(self):
+        if set(self._workers) <= self._ring.shards:
+            return
+        busy = {shard for shard, count in self._in_flight.values()}
+        for shard in list(self._workers):
+            if shard not in self._ring.shards and shard not in busy:
+                self._stop(self._workers.pop(shard))
+
+    def _release(self, key):
+        shard, count = self._in_flight[key]
+        if count == 1:
+            del self._in_flight[key]
+        else:
+            self._in_flight[key] = shard, count - 1
+
+    def _collect(self):
+        checked_at = time.monotonic()
+        while True:
+            try:
+                message = self._results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                message = False
+            if message is None:
+                break
+            if time.monotonic() - checked_at >= self.poll_interval:
+                self._fail_dead_workers()
+                checked_at = time.monotonic()
+            if not message:
+                continue
+            task_id, succeeded, value = message
+            with self._lock:
+                entry = self._futures.pop(task_id, None)
+                if entry is not None:
+                    self._release(entry[1])
+                    self._stop_drained()
+            if entry is None:
+                # The task was failed when its worker died.
+                continue
+            if succeeded:
+                entry[0].set_result(value)
+            else:
+                entry[0].set_exception(value)
+
+    def _fail_dead_workers(self):
+        failed = []
+        with self._lock:
+            for shard, (process, tasks) in list(self._workers.items()):
+                if process.is_alive():
+                    continue
+                del self._workers[shard]
+                logger.error('Sharded worker died.', extra={'shard': shard, 'exitcode': process.exitcode})
+                error = RuntimeError('Worker of shard %s exited with code %s.' % (shard, process.exitcode))
+                for task_id, (future, key) in list(self._futures.items()):
+                    if self._in_flight[key][0] == shard:
+                        del self._futures[task_id]
+                        self._release(key)
+                        failed.append((future, error))
+            self._stop_drained()
+        for future, error in failed:
+            future.set_exception(error)
+
+    def shutdown(self):
+        with self._lock:
+            for worker in self._workers.values():
+                self._stop(worker)
+            self._workers = {}
+        for process in self._stopped:
+            process.join()
+        self._results.put(None)
+        self._collector.join()
@@ -0,0 +1,3 @@
+from django.dispatch import Signal
+
+circuit_breaker_state_changed = Signal()
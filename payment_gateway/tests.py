@@ -1,3 +1,1727 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from itertools import count
+from urllib.parse import urlencode
 
-# Create your tests here.
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.core.signals import request_finished, request_started
+from django.db import DatabaseError, close_old_connections, connection, transaction as db_transaction
+from django.http import QueryDict
+from django.test import LiveServerTestCase, SimpleTestCase, TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+
+from payment_gateway.cloudpayments.provider import CloudPaymentsPaymentHandler, CloudPaymentsResultCode, \
+    CloudPaymentsTransactionHandler, NotificationValidator, get_cloudpayments_provider
+from payment_gateway.base import BasicCallbackProvider, BasicPaymentHandler, ConcurrencyMode
+from payment_gateway.callbacks import BatchedCallbackProvider, CallbackBatcher, flush_pending_callbacks
+from payment_gateway.circuitbreaker import CircuitBreaker, CircuitState, get_database_circuit_breaker, \
+    reset_database_circuit_breaker
+from payment_gateway.changelog import commit_checkpoint, consume_changes, get_consumer_lags, prune_changes
+from payment_gateway.cloudpayments.client import CloudPaymentsClient
+from payment_gateway.cloudpayments.recurring import RecurringCharge, RecurringChargeRunner
+from payment_gateway.cloudpayments.serializers import CloudPaymentsCheckSerializer, CloudPaymentsPaySerializer, \
+    CloudPaymentsSerializerBase
+from payment_gateway.cloudpayments.views import CloudPaymentsCheckAPIView, CloudPaymentsPayAPIView
+from payment_gateway.dto import Transaction as TransactionDTOBase, slotted_dataclass, to_model_kwargs
+from payment_gateway.dummy.provider import DummyPaymentProvider, DummyTransactionHandler, \
+    FaultInjectingDummyPaymentProvider, get_dummy_provider
+from payment_gateway.dummy.views import DummyProviderAPIView
+from payment_gateway.errors import CircuitOpen, InsufficientMoneyAmount, InvoiceAlreadyPaid, PaymentError, \
+    VelocityLimitExceeded
+from payment_gateway.fields import TextJSONField
+from payment_gateway.identity import get_invoice, get_invoice_for_update, invoice_exists, invoice_scope, lock_block, \
+    resolve_invoice_id
+from payment_gateway.loadgen import LoadGenerator, summarize
+from payment_gateway.models import ChangeLogEntity, ChangeLogEntry, CloudPaymentsTransaction, Invoice, InvoiceStatus, \
+    InvoiceStatusChange, PendingCallback, Transaction, TransactionStatus, TransactionType, WalletOneTransaction
+from payment_gateway.routers import ReplicaRouter, pin_to_primary, primary_pin_scope, unpin_from_primary
+from payment_gateway.schema import CompiledSchema
+from payment_gateway.service import cancel_invoice_by_id, create_invoice, filter_invoices_by_detail, \
+    get_invoice_by_external_reference
+from payment_gateway.sharding import ConsistentHashRing, ShardedExecutor
+from payment_gateway.signals import circuit_breaker_state_changed
+from payment_gateway.throttling import TokenBucketLimiter, reset_limiters
+from payment_gateway.tracing import NOOP_SPAN, get_tracer, span
+from payment_gateway.velocity import CacheSlidingWindowCounter, SlidingWindowCounter, get_velocity_checker
+from payment_gateway.walletone.provider import WalletOneException, WalletOneSignEncoder, WalletOneSigner
+from payment_gateway.walletone.serializers import WalletOneBatchSignSerializer, WalletOneConfirmSerializer
+from payment_gateway.walletone.views import WalletOneBatchSignAPIView, WalletOneConfirmAPIView, WalletOneSignAPIView
+
+urlpatterns = [
+    path('dummy/', DummyProviderAPIView.as_view()),
+    path('cloudpayments/check/', CloudPaymentsCheckAPIView.as_view()),
+    path('cloudpayments/pay/', CloudPaymentsPayAPIView.as_view()),
+    path('walletone/confirm/', WalletOneConfirmAPIView.as_view()),
+    path('walletone/sign/', WalletOneSignAPIView.as_view()),
+    path('walletone/batch-sign/', WalletOneBatchSignAPIView.as_view()),
+]
+
+# Query budget of every provider outcome as (queries, savepoints), measured with the default lock concurrency mode.
+# Any change to the number of round trips of a payment path has to update this table in the same commit.
+# CloudPaymentsResultCode.INVALID_ACCOUNT_ID is never returned by the provider and therefore has no budget.
+QUERY_BUDGETS = {
+    'dummy.success': (16, 4),
+    'dummy.insufficient_money_amount': (14, 3),
+    'dummy.expired': (18, 4),
+    'dummy.already_paid': (14, 3),
+    'dummy.settle': (16, 4),
+    'dummy.settle.insufficient_money_amount': (13, 3),
+    'cloudpayments.check.ok': (9, 2),
+    'cloudpayments.check.invalid_invoice_id': (1, 0),
+    'cloudpayments.check.invalid_money_amount': (14, 3),
+    'cloudpayments.check.unprocessable': (14, 3),
+    'cloudpayments.check.payment_expired': (18, 4),
+    'cloudpayments.check.velocity_limit_exceeded': (14, 3),
+    'cloudpayments.pay.ok': (13, 3),
+    'cloudpayments.pay.insufficient_money_amount': (10, 2),
+    'cloudpayments.pay.expired': (15, 3),
+    'cloudpayments.pay.already_paid': (11, 2),
+    'walletone.confirm.success': (18, 4),
+    'walletone.confirm.duplicate': (8, 1),
+    'walletone.confirm.bad_signature': (1, 0),
+    'walletone.confirm.unknown_invoice': (1, 0),
+    'walletone.batch_sign': (1, 0),
+}
+
+SUCCESS_CALLBACK = 'payment_gateway.tests.noop_callback'
+
+
+def noop_callback(invoice_id):
+    pass
+
+
+def sleep_and_get_pid(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def exit_worker(seconds):
+    time.sleep(seconds)
+    os._exit(1)
+
+
+sequence = count(1)
+cloudpayments_validator = NotificationValidator()
+walletone_encoder = WalletOneSignEncoder()
+
+
+def make_invoice(total=Decimal('100.00'), expires_at=None, status=None, details=None):
+    invoice = create_invoice(total, SUCCESS_CALLBACK, expires_at=expires_at, details=details)
+    if status is not None:
+        invoice.status = status
+        invoice.save(update_fields=['status'])
+    return invoice
+
+
+def make_expired_invoice():
+    return make_invoice(expires_at=timezone.now() - timedelta(minutes=1))
+
+
+def make_cloudpayments_payload(invoice_id, amount, **extra):
+    payload = {
+        'TransactionId': next(sequence),
+        'Amount': str(amount),
+        'Currency': CloudPaymentsPaymentHandler.valid_currencies[0],
+        'DateTime': '2020-01-01 00:00:00',
+        'CardFirstSix': '411111',
+        'CardLastFour': '1111',
+        'CardType': 'Visa',
+        'CardExpDate': '1225',
+        'TestMode': '1',
+        'Status': 'Completed',
+        'OperationType': 'Payment',
+        'InvoiceId': str(invoice_id),
+    }
+    payload.update(extra)
+    return payload
+
+
+def make_walletone_payload(invoice_id, amount, merchant_id='1', encoder=walletone_encoder, order_id=None):
+    payload = {
+        'WMI_ORDER_ID': order_id or str(next(sequence)),
+        'WMI_MERCHANT_ID': merchant_id,
+        'WMI_PAYMENT_AMOUNT': str(amount),
+        'WMI_COMMISSION_AMOUNT': '0.00',
+        'WMI_CURRENCY_ID': '643',
+        'WMI_PAYMENT_NO': str(invoice_id),
+        'WMI_SUCCESS_URL': 'https://example.com/success',
+        'WMI_FAIL_URL': 'https://example.com/fail',
+        'WMI_EXPIRED_DATE': '2030-01-01 00:00:00',
+        'WMI_CREATE_DATE': '2020-01-01 00:00:00',
+        'WMI_UPDATE_DATE': '2020-01-01 00:00:00',
+        'WMI_ORDER_STATE': 'Accepted',
+        'WMI_AUTO_ACCEPT': '1',
+        'WMI_PAYMENT_TYPE': 'CreditCardRUB',
+    }
+    payload['WMI_SIGNATURE'] = encoder._get_signature(payload).decode()
+    return payload
+
+
+def settle_dummy(invoices, money_amount):
+    provider = get_dummy_provider()
+    data = provider.transaction_handler.TransactionDTO(TransactionType.DUMMY, invoices[0].pk, money_amount)
+    transaction = provider.transaction_handler.create(data)
+    return provider.settle([invoice.pk for invoice in invoices], transaction)
+
+
+class WebhookClientMixin(object):
+    """
+    Posts provider notifications to the views of this module's URLconf, test cases set ROOT_URLCONF=__name__.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def pay_dummy(self, invoice, money_amount):
+        return self.client.post('/dummy/', {'invoice_id': invoice.pk, 'money_amount': str(money_amount)})
+
+    def notify_cloudpayments(self, url, payload):
+        body = urlencode(payload)
+        return self.client.generic('POST', url, body, content_type='application/x-www-form-urlencoded',
+                                   HTTP_CONTENT_HMAC=cloudpayments_validator.calculate_hmac(body.encode()).decode())
+
+    def check_cloudpayments(self, payload):
+        return self.notify_cloudpayments('/cloudpayments/check/', payload)
+
+    def pay_cloudpayments(self, payload):
+        return self.notify_cloudpayments('/cloudpayments/pay/', dict(payload, TotalFee='0.00'))
+
+    def confirm_walletone(self, payload):
+        return self.client.post('/walletone/confirm/', payload)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class QueryBudgetTestCase(WebhookClientMixin, TestCase):
+    def assertQueryBudget(self, outcome, request):
+        with CaptureQueriesContext(connection) as context:
+            response = request()
+        queries = [query['sql'] for query in context.captured_queries]
+        savepoints = sum(1 for sql in queries if sql.startswith('SAVEPOINT'))
+        self.assertEqual((len(queries), savepoints), QUERY_BUDGETS[outcome],
+                         'Query budget of %s changed:\n%s' % (outcome, '\n'.join(queries)))
+        return response
+
+
+class DummyQueryBudgetTestCase(QueryBudgetTestCase):
+    def test_success(self):
+        invoice = make_invoice()
+        response = self.assertQueryBudget('dummy.success', lambda: self.pay_dummy(invoice, invoice.total))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], InvoiceStatus.PAID)
+
+    def test_insufficient_money_amount(self):
+        invoice = make_invoice()
+        response = self.assertQueryBudget('dummy.insufficient_money_amount',
+                                          lambda: self.pay_dummy(invoice, Decimal('1')))
+        self.assertEqual(response.status_code, 400)
+
+    def test_expired(self):
+        invoice = make_expired_invoice()
+        response = self.assertQueryBudget('dummy.expired', lambda: self.pay_dummy(invoice, invoice.total))
+        self.assertEqual(response.status_code, 400)
+
+    def test_already_paid(self):
+        invoice = make_invoice()
+        self.pay_dummy(invoice, invoice.total)
+        response = self.assertQueryBudget('dummy.already_paid', lambda: self.pay_dummy(invoice, invoice.total))
+        self.assertEqual(response.status_code, 400)
+
+    def test_settle(self):
+        invoices = [make_invoice() for _ in range(3)]
+        settled, transaction = self.assertQueryBudget('dummy.settle', lambda: settle_dummy(invoices, Decimal('300')))
+        self.assertEqual([invoice.status for invoice in settled], [InvoiceStatus.PAID] * 3)
+        self.assertEqual(Invoice.objects.filter(status=InvoiceStatus.PAID, success_transaction=transaction,
+                                                captured_total=Decimal('100.00'), attempts_count=1).count(), 3)
+        self.assertEqual(InvoiceStatusChange.objects.filter(to_status=InvoiceStatus.PAID).count(), 3)
+
+    def test_settle_insufficient_money_amount(self):
+        invoices = [make_invoice() for _ in range(3)]
+
+        def settle():
+            with self.assertRaises(InsufficientMoneyAmount):
+                settle_dummy(invoices, Decimal('299.99'))
+
+        self.assertQueryBudget('dummy.settle.insufficient_money_amount', settle)
+        self.assertFalse(Invoice.objects.filter(status=InvoiceStatus.PAID).exists())
+
+
+class CloudPaymentsQueryBudgetTestCase(QueryBudgetTestCase):
+    def assertCheckCode(self, outcome, payload, code):
+        response = self.assertQueryBudget(outcome, lambda: self.check_cloudpayments(payload))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['code'], code)
+
+    def test_check_ok(self):
+        invoice = make_invoice()
+        self.assertCheckCode('cloudpayments.check.ok', make_cloudpayments_payload(invoice.pk, invoice.total),
+                             CloudPaymentsResultCode.OK)
+
+    def test_check_invalid_invoice_id(self):
+        self.assertCheckCode('cloudpayments.check.invalid_invoice_id', make_cloudpayments_payload(0, Decimal('1.00')),
+                             CloudPaymentsResultCode.INVALID_INVOICE_ID)
+
+    def test_check_invalid_money_amount(self):
+        invoice = make_invoice()
+        self.assertCheckCode('cloudpayments.check.invalid_money_amount',
+                             make_cloudpayments_payload(invoice.pk, Decimal('1')),
+                             CloudPaymentsResultCode.INVALID_MONEY_AMOUNT)
+
+    def test_check_unprocessable(self):
+        invoice = make_invoice(status=InvoiceStatus.CANCELLED)
+        self.assertCheckCode('cloudpayments.check.unprocessable', make_cloudpayments_payload(invoice.pk, invoice.total),
+                             CloudPaymentsResultCode.UNPROCESSABLE)
+
+    def test_check_payment_expired(self):
+        invoice = make_expired_invoice()
+        self.assertCheckCode('cloudpayments.check.payment_expired',
+                             make_cloudpayments_payload(invoice.pk, invoice.total),
+                             CloudPaymentsResultCode.PAYMENT_EXPIRED)
+
+    @override_settings(PAYMENT_GATEWAY_CLOUDPAYMENTS_VELOCITY_RULES=[{'key': 'card', 'limit': 1, 'window': 60}])
+    def test_check_velocity_limit_exceeded(self):
+        invoice = make_invoice()
+        self.check_cloudpayments(make_cloudpayments_payload(invoice.pk, invoice.total))
+        self.assertCheckCode('cloudpayments.check.velocity_limit_exceeded',
+                             make_cloudpayments_payload(invoice.pk, invoice.total),
+                             CloudPaymentsResultCode.UNPROCESSABLE)
+
+    def test_pay_ok(self):
+        invoice = make_invoice()
+        payload = make_cloudpayments_payload(invoice.pk, invoice.total)
+        self.check_cloudpayments(payload)
+        response = self.assertQueryBudget('cloudpayments.pay.ok', lambda: self.pay_cloudpayments(payload))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['code'], CloudPaymentsResultCode.OK)
+
+    def test_pay_insufficient_money_amount(self):
+        invoice = make_invoice()
+        payload = make_cloudpayments_payload(invoice.pk, Decimal('1.00'))
+        self.check_cloudpayments(payload)
+        response = self.assertQueryBudget('cloudpayments.pay.insufficient_money_amount',
+                                          lambda: self.pay_cloudpayments(payload))
+        self.assertEqual(response.status_code, 400)
+
+    def test_pay_expired(self):
+        invoice = make_invoice()
+        payload = make_cloudpayments_payload(invoice.pk, invoice.total)
+        self.check_cloudpayments(payload)
+        invoice.expires_at = timezone.now() - timedelta(minutes=1)
+        invoice.save(update_fields=['expires_at'])
+        response = self.assertQueryBudget('cloudpayments.pay.expired', lambda: self.pay_cloudpayments(payload))
+        self.assertEqual(response.status_code, 400)
+
+    def test_pay_already_paid(self):
+        invoice = make_invoice()
+        first_payload, second_payload = (make_cloudpayments_payload(invoice.pk, invoice.total) for _ in range(2))
+        self.check_cloudpayments(first_payload)
+        self.check_cloudpayments(second_payload)
+        self.pay_cloudpayments(first_payload)
+        response = self.assertQueryBudget('cloudpayments.pay.already_paid',
+                                          lambda: self.pay_cloudpayments(second_payload))
+        self.assertEqual(response.status_code, 400)
+
+
+class WalletOneQueryBudgetTestCase(QueryBudgetTestCase):
+    def test_success(self):
+        invoice = make_invoice()
+        payload = make_walletone_payload(invoice.pk, invoice.total)
+        response = self.assertQueryBudget('walletone.confirm.success', lambda: self.confirm_walletone(payload))
+        self.assertEqual(response.status_code, 200)
+
+    def test_duplicate(self):
+        invoice = make_invoice()
+        payload = make_walletone_payload(invoice.pk, invoice.total)
+        self.confirm_walletone(payload)
+        response = self.assertQueryBudget('walletone.confirm.duplicate', lambda: self.confirm_walletone(payload))
+        self.assertEqual(response.status_code, 200)
+
+    def test_bad_signature(self):
+        invoice = make_invoice()
+        payload = dict(make_walletone_payload(invoice.pk, invoice.total), WMI_SIGNATURE='invalid')
+        response = self.assertQueryBudget('walletone.confirm.bad_signature', lambda: self.confirm_walletone(payload))
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_invoice(self):
+        payload = make_walletone_payload(0, Decimal('1.00'))
+        response = self.assertQueryBudget('walletone.confirm.unknown_invoice', lambda: self.confirm_walletone(payload))
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(PAYMENT_GATEWAY_WALLETONE_MERCHANTS={'2': {'SECRET_KEY': 'other'}})
+    def test_merchant(self):
+        invoice = make_invoice(details={'WALLET_ONE_OVERRIDE': {'WMI_MERCHANT_ID': '2'}})
+        signer = WalletOneSigner('other')
+        response = self.confirm_walletone(make_walletone_payload(invoice.pk, invoice.total))
+        self.assertEqual(response.status_code, 400)
+        response = self.confirm_walletone(make_walletone_payload(invoice.pk, invoice.total, '2', walletone_encoder))
+        self.assertEqual(response.status_code, 400)
+        payload = make_walletone_payload(invoice.pk, invoice.total, '2', signer)
+        response = self.assertQueryBudget('walletone.confirm.success', lambda: self.confirm_walletone(payload))
+        self.assertEqual(response.status_code, 200)
+
+    def test_batch_sign(self):
+        pending = create_invoice(Decimal('100.00'), SUCCESS_CALLBACK, expires_at=timezone.now() + timedelta(days=1),
+                                 details={})
+        paid = make_invoice(status=InvoiceStatus.PAID)
+        invoice_ids = [pending.pk, paid.pk, 0]
+        response = self.assertQueryBudget(
+            'walletone.batch_sign',
+            lambda: self.client.post('/walletone/batch-sign/', {'invoices': invoice_ids}, format='json'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['invoice'] for result in response.data], invoice_ids)
+        self.assertIn('data', response.data[0])
+        self.assertEqual(response.data[1]['error']['code'], 'invoice_already_paid')
+        self.assertEqual(response.data[2]['error']['code'], 'does_not_exist')
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class WalletOneBatchSignTestCase(WebhookClientMixin, TestCase):
+    def make_signable_invoice(self, **kwargs):
+        kwargs.setdefault('expires_at', timezone.now() + timedelta(days=1))
+        kwargs.setdefault('details', {})
+        return make_invoice(**kwargs)
+
+    def test_mixed_batch(self):
+        invoices = [
+            self.make_signable_invoice(),
+            self.make_signable_invoice(details=None),
+            self.make_signable_invoice(expires_at=None),
+            self.make_signable_invoice(details={'WALLET_ONE_OVERRIDE': {'WMI_MERCHANT_ID': '999'}}),
+            self.make_signable_invoice(status=InvoiceStatus.PAID),
+            self.make_signable_invoice(details={'description': 'Order'}),
+        ]
+        invoice_ids = [invoice.pk for invoice in invoices] + [0]
+        response = self.client.post('/walletone/batch-sign/', {'invoices': invoice_ids}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['invoice'] for result in response.data], invoice_ids)
+        self.assertEqual([result.get('error', {}).get('code') for result in response.data], [
+            None, 'invalid_details', 'no_expiration', 'unknown_merchant', 'invoice_already_paid', None,
+            'does_not_exist'])
+        signed = dict(response.data[5]['data'])
+        self.assertEqual(signed['WMI_PAYMENT_NO'], str(invoices[5].pk))
+        self.assertEqual(signed['WMI_SIGNATURE'], walletone_encoder._get_signature(
+            [item for item in response.data[5]['data'] if item[0] != 'WMI_SIGNATURE']).decode())
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class WalletOneUnknownMerchantTestCase(WebhookClientMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.invoice = make_invoice(expires_at=timezone.now() + timedelta(days=1),
+                                    details={'WALLET_ONE_OVERRIDE': {'WMI_MERCHANT_ID': '2'}})
+
+    def test_confirm(self):
+        response = self.confirm_walletone(make_walletone_payload(self.invoice.pk, self.invoice.total))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, 'WMI_RESULT=RETRY&WMI_DESCRIPTION=WMI_MERCHANT_ID error')
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.status, InvoiceStatus.PENDING)
+
+    def test_sign(self):
+        response = self.client.post('/walletone/sign/', {'invoice': self.invoice.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['invoice'][0].code, 'unknown_merchant')
+        invoice = make_invoice(expires_at=timezone.now() + timedelta(days=1), details=None)
+        response = self.client.post('/walletone/sign/', {'invoice': invoice.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['invoice'][0].code, 'invalid_details')
+        with override_settings(PAYMENT_GATEWAY_WALLETONE_MERCHANTS={'2': {'SECRET_KEY': 'other'}}):
+            response = self.client.post('/walletone/sign/', {'invoice': self.invoice.pk}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(response.data)['WMI_MERCHANT_ID'], '2')
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class TransactionSubtypesTestCase(WebhookClientMixin, TestCase):
+    def test_as_subtypes(self):
+        for _ in range(2):
+            invoice = make_invoice()
+            self.pay_dummy(invoice, Decimal('1.00'))
+            self.check_cloudpayments(make_cloudpayments_payload(invoice.pk, invoice.total))
+            self.confirm_walletone(make_walletone_payload(invoice.pk, invoice.total))
+        # One query for the transactions and one per subtype table, however many transactions there are.
+        with self.assertNumQueries(3):
+            transactions = Transaction.objects.order_by('pk').as_subtypes()
+        self.assertEqual([type(transaction) for transaction in transactions],
+                         [Transaction, CloudPaymentsTransaction, WalletOneTransaction] * 2)
+        self.assertEqual(transactions[1].CardFirstSix, '411111')
+        self.assertEqual(transactions[2].WMI_MERCHANT_ID, '1')
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class RepairInvoiceCountersTestCase(WebhookClientMixin, TestCase):
+    def test_repair(self):
+        paid, unpaid, untouched = make_invoice(), make_invoice(), make_invoice()
+        self.pay_dummy(paid, Decimal('1.00'))
+        self.pay_dummy(paid, paid.total)
+        self.pay_dummy(unpaid, Decimal('1.00'))
+        expected = list(Invoice.objects.order_by('pk').values_list(
+            'attempts_count', 'failed_attempts_count', 'last_transaction_at'))
+        self.assertEqual([counters[:2] for counters in expected], [(2, 1), (1, 1), (0, 0)])
+
+        Invoice.objects.update(attempts_count=7, failed_attempts_count=5, last_transaction_at=timezone.now())
+        call_command('repair_invoice_counters', '--invoice', str(paid.pk), stdout=StringIO())
+        self.assertEqual(Invoice.objects.get(pk=paid.pk).attempts_count, 2)
+        self.assertEqual(Invoice.objects.get(pk=untouched.pk).attempts_count, 7)
+
+        output = StringIO()
+        call_command('repair_invoice_counters', '--batch-size', '2', stdout=output)
+        self.assertIn('Repaired 3 invoices.', output.getvalue())
+        self.assertEqual(list(Invoice.objects.order_by('pk').values_list(
+            'attempts_count', 'failed_attempts_count', 'last_transaction_at')), expected)
+
+
+@override_settings(PAYMENT_GATEWAY_DATABASE_PRIMARY='default', PAYMENT_GATEWAY_DATABASE_REPLICAS=('replica',))
+class ReplicaRouterTestCase(TransactionTestCase):
+    router = ReplicaRouter()
+
+    def setUp(self):
+        unpin_from_primary()
+
+    def test_reads_go_to_replica_until_write(self):
+        self.assertEqual(self.router.db_for_read(Invoice), 'replica')
+        self.assertEqual(self.router.db_for_write(Invoice), 'default')
+        self.assertEqual(self.router.db_for_read(Invoice), 'default')
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(self.router.db_for_read(Invoice), 'replica')
+
+    @override_settings(DATABASE_ROUTERS=['payment_gateway.routers.ReplicaRouter'])
+    def test_querysets(self):
+        self.assertEqual(Invoice.objects.filter(pk=1).db, 'replica')
+        with primary_pin_scope():
+            self.assertEqual(Invoice.objects.select_for_update().filter(pk=1).db, 'default')
+            self.assertEqual(Invoice.objects.filter(pk=1).db, 'default')
+        with primary_pin_scope():
+            make_invoice()
+            self.assertEqual(Invoice.objects.filter(pk=1).db, 'default')
+        self.assertEqual(Invoice.objects.filter(pk=1).db, 'replica')
+
+    def test_atomic_reads_go_to_primary(self):
+        with db_transaction.atomic():
+            self.assertEqual(self.router.db_for_read(Invoice), 'default')
+        self.assertEqual(self.router.db_for_read(Invoice), 'replica')
+
+    def test_unrouted_models(self):
+        self.assertIsNone(self.router.db_for_read(ContentType))
+        self.assertIsNone(self.router.db_for_write(ContentType))
+        self.assertEqual(self.router.db_for_read(Invoice), 'replica')
+        self.assertTrue(self.router.allow_migrate('default', 'payment_gateway'))
+        self.assertFalse(self.router.allow_migrate('replica', 'payment_gateway'))
+
+    def test_primary_pin_scope(self):
+        @primary_pin_scope()
+        def unit_of_work():
+            before = self.router.db_for_read(Invoice)
+            self.router.db_for_write(Invoice)
+            return before, self.router.db_for_read(Invoice)
+
+        self.assertEqual(unit_of_work(), ('replica', 'default'))
+        self.assertEqual(unit_of_work(), ('replica', 'default'))
+        self.assertEqual(self.router.db_for_read(Invoice), 'replica')
+        pin_to_primary()
+        self.assertEqual(unit_of_work(), ('replica', 'default'))
+        self.assertEqual(self.router.db_for_read(Invoice), 'default')
+
+
+class StubCloudPaymentsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.received.append((self.path, payload['Token'], self.headers['X-Request-ID'],
+                                     self.client_address, time.monotonic()))
+        status, body = self.server.responses[payload['Token']].pop(0)
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class RecurringChargeTestCase(TransactionTestCase):
+    backoff = 0.05
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubCloudPaymentsHandler)
+        self.server.received = []
+        self.server.responses = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = CloudPaymentsClient('public-id', 'secret', 'http://127.0.0.1:%s' % self.server.server_port,
+                                          timeout=5, max_retries=2, backoff=self.backoff, pool_size=2)
+        self.addCleanup(self.client.close)
+
+    def make_charge(self, token, responses):
+        self.server.responses[token] = responses
+        return RecurringCharge(make_invoice().pk, token, 'account', 'RUB')
+
+    def make_model(self, transaction_id, **extra):
+        return dict({'TransactionId': transaction_id, 'Amount': 100.0, 'Currency': 'RUB', 'Status': 'Completed',
+                     'CreatedDateIso': '2020-01-01T00:00:00', 'CardFirstSix': '411111', 'CardLastFour': '1111'},
+                    **extra)
+
+    def test_run(self):
+        charges = [
+            self.make_charge('flaky', [(503, {}), (200, {'Success': True, 'Model': self.make_model(101)})]),
+            self.make_charge('declined', [(200, {'Success': False, 'Model': self.make_model(102, Reason='Limit')})]),
+            self.make_charge('unreadable', [(200, {'Success': True, 'Model': {'TransactionId': 103}})]),
+            self.make_charge('rejected', [(400, {})]),
+            self.make_charge('down', [(500, {})] * 3),
+        ]
+        results = RecurringChargeRunner(get_cloudpayments_provider(), self.client, concurrency=1).run(charges)
+
+        self.assertEqual([(result.invoice_id, result.success) for result in results],
+                         [(charges[0].invoice_id, True)] + [(charge.invoice_id, False) for charge in charges[1:]])
+        self.assertEqual(results[1].reason, 'Limit')
+        self.assertIn('KeyError', results[2].reason)
+        self.assertEqual(Invoice.objects.get(pk=charges[0].invoice_id).status, InvoiceStatus.PAID)
+        self.assertEqual(dict(CloudPaymentsTransaction.objects.values_list('TransactionId', 'status')),
+                         {101: TransactionStatus.SUCCESS, 102: TransactionStatus.DECLINED})
+
+        received = self.server.received
+        self.assertEqual([token for path, token, request_id, address, at in received],
+                         ['flaky', 'flaky', 'declined', 'unreadable', 'rejected', 'down', 'down', 'down'])
+        self.assertEqual({path for path, token, request_id, address, at in received}, {'/payments/tokens/charge'})
+        # Retries reuse the request id, wait for the exponential backoff and go over pooled connections.
+        self.assertEqual(len({request_id for path, token, request_id, address, at in received[-3:]}), 1)
+        self.assertGreaterEqual(received[-2][4] - received[-3][4], self.backoff)
+        self.assertGreaterEqual(received[-1][4] - received[-2][4], self.backoff * 2)
+        self.assertEqual(len({address for path, token, request_id, address, at in received}), 1)
+
+    def test_notification_processed_first(self):
+        # The Pay notification of a charge can arrive before the charge response.
+        model = self.make_model(201)
+        runner = RecurringChargeRunner(get_cloudpayments_provider(), self.client, concurrency=1)
+        invoice = make_invoice()
+        data = runner.make_transaction_data(invoice, model)
+        self.assertEqual(runner.provider.check(data), CloudPaymentsResultCode.OK)
+        runner.provider.pay(invoice.pk, data)
+
+        result = runner.record_charge(invoice, {'Success': True, 'Model': model})
+        self.assertTrue(result.success)
+        transaction = CloudPaymentsTransaction.objects.get()
+        self.assertEqual((result.transaction_id, transaction.status), (transaction.pk, TransactionStatus.SUCCESS))
+        invoice.refresh_from_db()
+        self.assertEqual((invoice.status, invoice.success_transaction_id, invoice.failed_attempts_count),
+                         (InvoiceStatus.PAID, transaction.pk, 0))
+
+
+class ReplayTestCase(TestCase):
+    def make_record(self, operation, payload):
+        body = urlencode(payload)
+        return {'provider': 'cloudpayments', 'operation': operation, 'body': body,
+                'signature': cloudpayments_validator.calculate_hmac(body.encode()).decode()}
+
+    def replay(self, records, *args):
+        output = StringIO()
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as lines:
+            lines.write('\n'.join(json.dumps(record) for record in records))
+            lines.flush()
+            call_command('replay_notifications', lines.name, '--workers', '1', *args, stdout=output)
+        return output.getvalue()
+
+    def test_replay(self):
+        invoice = make_invoice()
+        payload = make_cloudpayments_payload(invoice.pk, invoice.total)
+        forged = dict(self.make_record('check', make_cloudpayments_payload(invoice.pk, invoice.total)),
+                      signature='invalid')
+        records = [self.make_record('check', payload), forged, self.make_record('pay', dict(payload, TotalFee='0')),
+                   self.make_record('pay', dict(payload, TotalFee='0'))]
+
+        output = self.replay(records, '--dry-run')
+        self.assertIn('cloudpayments.check.valid: 1', output)
+        self.assertIn('bad_signature: 1', output)
+        self.assertIn('cloudpayments.pay.duplicate: 1', output)
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).status, InvoiceStatus.PENDING)
+
+        output = self.replay(records)
+        self.assertIn('cloudpayments.check.ok: 1', output)
+        self.assertIn('cloudpayments.pay.ok: 1', output)
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).status, InvoiceStatus.PAID)
+
+        output = self.replay(records)
+        self.assertIn('cloudpayments.check.recorded: 1', output)
+        self.assertIn('cloudpayments.pay.recorded: 1', output)
+
+    @override_settings(PAYMENT_GATEWAY_WALLETONE_MERCHANTS={'2': {'SECRET_KEY': 'other'}})
+    def test_replay_walletone(self):
+        invoice = make_invoice(details={'WALLET_ONE_OVERRIDE': {'WMI_MERCHANT_ID': '2'}})
+        records = [
+            {'provider': 'walletone', 'payload': make_walletone_payload(invoice.pk, invoice.total)},
+            {'provider': 'walletone', 'payload': dict(make_walletone_payload(invoice.pk, invoice.total),
+                                                      WMI_SIGNATURE='invalid')},
+            {'provider': 'walletone', 'payload': make_walletone_payload(invoice.pk, invoice.total, '3')},
+            {'provider': 'walletone', 'payload': make_walletone_payload(invoice.pk, invoice.total, '2',
+                                                                        WalletOneSigner('other'))},
+        ]
+        output = self.replay(records)
+        self.assertIn('walletone.confirm.merchant_mismatch: 1', output)
+        self.assertIn('walletone.confirm.bad_signature: 1', output)
+        self.assertIn('walletone.confirm.unknown_merchant: 1', output)
+        self.assertIn('walletone.confirm.ok: 1', output)
+
+
+@override_settings(ROOT_URLCONF=__name__, PAYMENT_GATEWAY_CHANGE_LOG=True)
+class ChangeLogTestCase(WebhookClientMixin, TestCase):
+
+    def test_consume(self):
+        paid, settled, cancelled = make_invoice(), [make_invoice() for _ in range(2)], make_invoice()
+        self.pay_dummy(paid, paid.total)
+        settle_dummy(settled, Decimal('200'))
+        cancel_invoice_by_id(cancelled.pk)
+        batches = []
+        self.assertEqual(consume_changes('ledger', batches.append, batch_size=3), 6)
+        entries = [entry for batch in batches for entry in batch]
+        self.assertEqual([len(batch) for batch in batches], [3, 3])
+        self.assertEqual([entry.offset for entry in entries], list(range(1, 7)))
+        self.assertEqual([(entry.entity, entry.invoice_id, entry.to_status) for entry in entries], [
+            (ChangeLogEntity.TRANSACTION, paid.pk, TransactionStatus.SUCCESS),
+            (ChangeLogEntity.INVOICE, paid.pk, InvoiceStatus.PAID),
+            (ChangeLogEntity.TRANSACTION, settled[0].pk, TransactionStatus.SUCCESS),
+            (ChangeLogEntity.INVOICE, settled[0].pk, InvoiceStatus.PAID),
+            (ChangeLogEntity.INVOICE, settled[1].pk, InvoiceStatus.PAID),
+            (ChangeLogEntity.INVOICE, cancelled.pk, InvoiceStatus.CANCELLED),
+        ])
+        self.assertEqual(consume_changes('ledger', batches.append), 0)
+        self.assertEqual(get_consumer_lags(), {'ledger': 0})
+
+    def test_prune(self):
+        for _ in range(5):
+            invoice = make_invoice()
+            self.pay_dummy(invoice, invoice.total)
+        commit_checkpoint('search', 2)
+        output = StringIO()
+        call_command('prune_change_log', '--retention', '0', '--segment-size', '4', stdout=output)
+        self.assertIn('Sequenced 10 change log entries, deleted 7.', output.getvalue())
+        self.assertIn('search: 8 entries behind', output.getvalue())
+        self.assertEqual(list(ChangeLogEntry.objects.values_list('offset', flat=True).order_by('offset')), [8, 9, 10])
+        self.assertEqual(prune_changes(0, 4), 0)
+
+
+@override_settings(ROOT_URLCONF=__name__, STATIC_URL='/static/')
+class LoadGeneratorTestCase(LiveServerTestCase):
+    def test_sequences(self):
+        generator = LoadGenerator(self.live_server_url, SUCCESS_CALLBACK, concurrency=1, duplicate_ratio=0.3,
+                                  failure_ratio=0.3, seed=1)
+        samples, elapsed = generator.run(generator.build_sequences(40))
+        results = {(sample.endpoint, sample.scenario, sample.result) for sample in samples}
+        self.assertEqual({result for endpoint, scenario, result in results if scenario == 'success'}, {'200 ok'})
+        self.assertLessEqual(results - {result for result in results if result[1] == 'success'}, {
+            ('cloudpayments.check', 'duplicate', '200 ok'),
+            ('cloudpayments.pay', 'duplicate', '200 ok'),
+            ('cloudpayments.pay', 'duplicate', '400'),
+            ('cloudpayments.check', 'insufficient_money_amount', '200 invalid_money_amount'),
+            ('cloudpayments.check', 'expired', '200 payment_expired'),
+            ('cloudpayments.check', 'bad_signature', '403'),
+            ('cloudpayments.check', 'unknown_invoice', '200 invalid_invoice_id'),
+            ('walletone.confirm', 'duplicate', '200 ok'),
+            ('walletone.confirm', 'insufficient_money_amount', '400 retry'),
+            ('walletone.confirm', 'expired', '400 retry'),
+            ('walletone.confirm', 'bad_signature', '400 retry'),
+            ('walletone.confirm', 'unknown_invoice', '400 retry'),
+        })
+        summary = summarize(samples)
+        self.assertEqual(sum(stats['count'] for stats in summary.values()), len(samples))
+        paid = Invoice.objects.filter(status=InvoiceStatus.PAID, transactions__type=TransactionType.CLOUDPAYMENTS)
+        self.assertEqual(summary['cloudpayments.pay']['results']['200 ok'], paid.distinct().count())
+
+
+class ShardingTestCase(SimpleTestCase):
+    def test_ring_rebalancing(self):
+        ring = ConsistentHashRing(range(4))
+        before = {key: ring.get(key) for key in range(10000)}
+        ring.add(4)
+        moved = [key for key in before if ring.get(key) != before[key]]
+        self.assertTrue(all(ring.get(key) == 4 for key in moved))
+        self.assertLess(len(moved), 3000)
+        ring.remove(4)
+        self.assertEqual({key: ring.get(key) for key in before}, before)
+
+    def test_resize_keeps_busy_keys(self):
+        with ShardedExecutor(2) as executor:
+            ring = ConsistentHashRing(range(3))
+            key = next(key for key in range(1000) if ring.get(key) == 2)
+            busy = executor.submit(key, sleep_and_get_pid, 0.5)
+            executor.resize(3)
+            queued = executor.submit(key, sleep_and_get_pid, 0)
+            self.assertEqual(queued.result(), busy.result())
+            self.assertNotEqual(executor.submit(key, sleep_and_get_pid, 0).result(), busy.result())
+            executor.resize(1)
+            pids = {executor.submit(key, sleep_and_get_pid, 0).result() for key in range(20)}
+            self.assertEqual(len(pids), 1)
+            self.assertEqual(executor.shards, 1)
+
+    def test_dead_worker(self):
+        with ShardedExecutor(2, poll_interval=0.05) as executor:
+            key = 1
+            pid = executor.submit(key, sleep_and_get_pid, 0).result()
+            dying = executor.submit(key, exit_worker, 0.2)
+            queued = executor.submit(key, sleep_and_get_pid, 0)
+            with self.assertRaisesMessage(RuntimeError, 'exited with code 1'):
+                dying.result(timeout=5)
+            with self.assertRaises(RuntimeError):
+                queued.result(timeout=5)
+            self.assertEqual(executor._in_flight, {})
+            self.assertNotIn(executor.submit(key, sleep_and_get_pid, 0).result(timeout=5), (pid, None))
+            self.assertEqual(executor.shards, 2)
+
+
+class TokenBucketLimiterTestCase(SimpleTestCase):
+    def rewind(self, limiter, key, seconds):
+        tokens, updated_at = limiter._buckets[key]
+        limiter._buckets[key] = (tokens, updated_at - seconds)
+
+    def test_refill(self):
+        limiter = TokenBucketLimiter(rate=2, burst=2, max_keys=10)
+        self.assertEqual([limiter.consume('a'), limiter.consume('a')], [0, 0])
+        self.assertAlmostEqual(limiter.consume('a'), 0.5, places=2)
+        self.rewind(limiter, 'a', 0.25)
+        self.assertAlmostEqual(limiter.consume('a'), 0.25, places=2)
+        self.rewind(limiter, 'a', 0.5)
+        self.assertEqual(limiter.consume('a'), 0)
+        self.assertGreater(limiter.consume('a'), 0)
+        self.rewind(limiter, 'a', 60)
+        self.assertEqual([limiter.consume('a'), limiter.consume('a')], [0, 0])
+        self.assertGreater(limiter.consume('a'), 0)
+
+    def test_lru_bound(self):
+        limiter = TokenBucketLimiter(rate=0.001, burst=1, max_keys=2)
+        self.assertEqual([limiter.consume('a'), limiter.consume('b')], [0, 0])
+        self.assertGreater(limiter.consume('a'), 0)
+        self.assertEqual(limiter.consume('c'), 0)
+        self.assertEqual(list(limiter._buckets), ['a', 'c'])
+        self.assertGreater(limiter.consume('a'), 0)
+        self.assertEqual(limiter.consume('b'), 0)
+        self.assertEqual(list(limiter._buckets), ['a', 'b'])
+
+
+@override_settings(ROOT_URLCONF=__name__, PAYMENT_GATEWAY_WEBHOOK_THROTTLE_RATES={
+    'cloudpayments': {'rate': 0.001, 'burst': 1}, 'walletone': {'rate': 0.001, 'burst': 1}})
+class WebhookThrottleTestCase(WebhookClientMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        reset_limiters()
+
+    def test_cloudpayments(self):
+        invoice = make_invoice()
+        response = self.check_cloudpayments(make_cloudpayments_payload(invoice.pk, invoice.total))
+        self.assertEqual(response.data['code'], CloudPaymentsResultCode.OK)
+        response = self.pay_cloudpayments(make_cloudpayments_payload(invoice.pk, invoice.total))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(int(response['Retry-After']), 1000)
+        self.assertIn('detail', response.data)
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).status, InvoiceStatus.PENDING)
+
+    def test_walletone(self):
+        invoice = make_invoice()
+        self.assertEqual(self.confirm_walletone(make_walletone_payload(invoice.pk, invoice.total)).data,
+                         'WMI_RESULT=OK')
+        response = self.confirm_walletone(make_walletone_payload(invoice.pk, invoice.total))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(int(response['Retry-After']), 1000)
+        self.assertEqual(response.data, 'WMI_RESULT=RETRY&WMI_DESCRIPTION=Too many requests')
+
+    def test_scopes_are_separate(self):
+        invoice = make_invoice()
+        self.assertEqual(self.confirm_walletone(make_walletone_payload(invoice.pk, invoice.total)).status_code, 200)
+        response = self.check_cloudpayments(make_cloudpayments_payload(invoice.pk, invoice.total))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.pay_dummy(make_invoice(), Decimal('100.00')).status_code, 200)
+
+
+class RecordingTracer(object):
+    """
+    Records (name, parent name, attributes) of every span instead of exporting it.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.stack = []
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        self.spans.append((name, self.stack[-1] if self.stack else None, attributes))
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+
+
+def make_recording_tracer():
+    return RecordingTracer()
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class TracingTestCase(WebhookClientMixin, TestCase):
+    @override_settings(PAYMENT_GATEWAY_TRACER='payment_gateway.tests.make_recording_tracer')
+    def test_span_nesting(self):
+        invoice = make_invoice()
+        self.assertEqual(self.pay_dummy(invoice, invoice.total).status_code, 200)
+        spans = get_tracer().spans
+        self.assertEqual(spans[0], ('payment_gateway.DummyPaymentProvider.pay', None, {'invoice_id': invoice.pk}))
+        parents = {name: parent for name, parent, attributes in spans}
+        self.assertEqual(parents['payment_gateway.BasicTransactionHandler.create'],
+                         'payment_gateway.DummyPaymentProvider.pay')
+        self.assertEqual(parents['payment_gateway.lock_invoice'], 'payment_gateway.DummyPaymentProvider.pay')
+        self.assertEqual(parents['payment_gateway.BasicCallbackProvider.success'],
+                         'payment_gateway.BasicPaymentHandler.try_process_payment')
+        attributes = {name: attributes for name, parent, attributes in spans}
+        self.assertEqual(attributes['payment_gateway.lock_invoice'], {'invoice_id': invoice.pk})
+        self.assertEqual(attributes['payment_gateway.BasicCallbackProvider.success']['invoice_id'], invoice.pk)
+        self.assertEqual(get_tracer().stack, [])
+
+    def test_noop(self):
+        self.assertIsNone(get_tracer())
+        self.assertIs(span('lock_invoice', invoice_id=1), NOOP_SPAN)
+        with span('lock_invoice', invoice_id=1) as current:
+            current.set_attribute('invoice_id', 2)
+        invoice = make_invoice()
+        self.assertEqual(self.pay_dummy(invoice, invoice.total).status_code, 200)
+
+
+class FaultInjectionTestCase(TestCase):
+    faults = {
+        'latency': {'distribution': 'uniform', 'high': 0.002},
+        'errors': {'InsufficientMoneyAmount': 0.2, 'InvoiceExpired': 0.1},
+        'duplicate_ratio': 0.2,
+        'reorder_ratio': 0.2,
+        'redelivery_delay': {'distribution': 'exponential', 'mean': 0.5},
+    }
+
+    def run_payments(self, faults, count=30):
+        with override_settings(PAYMENT_GATEWAY_DUMMY_FAULTS=faults):
+            provider = get_dummy_provider()
+        self.assertIsInstance(provider, FaultInjectingDummyPaymentProvider)
+        outcomes = []
+        for _ in range(count):
+            invoice = make_invoice()
+            data = provider.transaction_handler.TransactionDTO(TransactionType.DUMMY, invoice.pk, invoice.total)
+            with self.captureOnCommitCallbacks() as callbacks:
+                try:
+                    invoice, transaction = provider.pay(invoice.pk, data)
+                    outcome = InvoiceStatus(invoice.status).name
+                except PaymentError as e:
+                    outcome = type(e).__name__
+            outcomes.append((outcome, len(callbacks)))
+        return outcomes, [provider.latency() for _ in range(5)], [provider.redelivery_delay() for _ in range(5)]
+
+    def test_seeded_faults_repeat(self):
+        outcomes, latencies, delays = self.run_payments(dict(self.faults, seed=42))
+        self.assertEqual(self.run_payments(dict(self.faults, seed=42)), (outcomes, latencies, delays))
+        self.assertNotEqual(self.run_payments(dict(self.faults, seed=43))[0], outcomes)
+        self.assertEqual({outcome for outcome, redeliveries in outcomes},
+                         {'PAID', 'PENDING', 'InsufficientMoneyAmount', 'InvoiceExpired'})
+        self.assertEqual({redeliveries for outcome, redeliveries in outcomes if outcome == 'PENDING'}, {1})
+        self.assertIn(1, {redeliveries for outcome, redeliveries in outcomes if outcome != 'PENDING'})
+        self.assertTrue(all(0 <= latency <= 0.002 for latency in latencies))
+
+    def test_invalid_faults(self):
+        for faults in ({'latency': {'distribution': 'pareto'}}, {'errors': {'ValueError': 0.1}}):
+            with self.assertRaises(ImproperlyConfigured), override_settings(PAYMENT_GATEWAY_DUMMY_FAULTS=faults):
+                get_dummy_provider()
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class SlowRequestProfilerTestCase(WebhookClientMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def read_reports(self):
+        names = sorted(os.listdir(self.directory))
+        reports = [name for name in names if name.endswith('.json')]
+        self.assertEqual(names, sorted(reports + [name[:-len('.json')] + '.prof' for name in reports]))
+        result = []
+        for name in reports:
+            with open(os.path.join(self.directory, name)) as f:
+                result.append(json.load(f))
+        return result
+
+    def test_threshold(self):
+        invoice = make_invoice()
+        with override_settings(PAYMENT_GATEWAY_SLOW_REQUEST_PROFILER={'directory': self.directory, 'threshold': 60}):
+            self.check_cloudpayments(make_cloudpayments_payload(invoice.pk, invoice.total))
+        self.assertEqual(self.read_reports(), [])
+        payload = make_cloudpayments_payload(invoice.pk, invoice.total)
+        with override_settings(PAYMENT_GATEWAY_SLOW_REQUEST_PROFILER={'directory': self.directory, 'threshold': 0}):
+            self.check_cloudpayments(payload)
+        report, = self.read_reports()
+        self.assertEqual((report['method'], report['path'], report['status']), ('POST', '/cloudpayments/check/', 200))
+        self.assertEqual((report['invoice_id'], report['transaction_id']),
+                         (str(invoice.pk), str(payload['TransactionId'])))
+        self.assertTrue(any('payment_gateway_invoice' in query['sql'] for query in report['queries']))
+        self.assertEqual(set(report['queries'][0]), {'alias', 'sql', 'many', 'duration'})
+
+    def test_rotation(self):
+        config = {'directory': self.directory, 'threshold': 0, 'max_files': 2}
+        with override_settings(PAYMENT_GATEWAY_SLOW_REQUEST_PROFILER=config):
+            invoices = [make_invoice() for _ in range(3)]
+            for invoice in invoices:
+                self.pay_dummy(invoice, invoice.total)
+                time.sleep(0.01)
+        self.assertEqual([report['invoice_id'] for report in self.read_reports()],
+                         [str(invoice.pk) for invoice in invoices[1:]])
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.transitions = []
+        circuit_breaker_state_changed.connect(self.record_transition)
+        self.addCleanup(circuit_breaker_state_changed.disconnect, self.record_transition)
+
+    def record_transition(self, sender, name, old_state, new_state, **kwargs):
+        self.transitions.append((name, old_state, new_state))
+
+    def raise_database_error(self):
+        raise DatabaseError()
+
+    def test_trip_probe_close(self):
+        breaker = CircuitBreaker('test', window=4, min_calls=4, error_rate=0.5, cooldown=60, probes=2)
+        call, fail = breaker.guard(lambda: 'ok'), breaker.guard(self.raise_database_error)
+        self.assertEqual([call(), call(), call()], ['ok'] * 3)
+        with self.assertRaises(DatabaseError):
+            fail()
+        self.assertEqual(breaker.state, CircuitState.CLOSED)
+        with self.assertRaises(DatabaseError):
+            fail()
+        self.assertEqual(breaker.state, CircuitState.OPEN)
+        with self.assertRaises(CircuitOpen):
+            call()
+
+        breaker._opened_at -= 60
+        self.assertEqual([breaker.allow(), breaker.allow(), breaker.allow()], [True, True, False])
+        self.assertEqual(breaker.state, CircuitState.HALF_OPEN)
+        breaker.record(0, failed=False)
+        self.assertEqual(breaker.state, CircuitState.HALF_OPEN)
+        breaker.record(0, failed=False)
+        self.assertEqual(breaker.state, CircuitState.CLOSED)
+
+        for _ in range(4):
+            breaker.record(breaker.slow_call_duration, failed=False)
+        self.assertEqual(breaker.state, CircuitState.OPEN)
+        breaker._opened_at -= 60
+        with self.assertRaises(DatabaseError):
+            fail()
+        self.assertEqual(breaker.state, CircuitState.OPEN)
+        self.assertEqual([new_state for name, old_state, new_state in self.transitions], [
+            CircuitState.OPEN, CircuitState.HALF_OPEN, CircuitState.CLOSED, CircuitState.OPEN, CircuitState.HALF_OPEN,
+            CircuitState.OPEN])
+        self.assertEqual(breaker.metrics(), {
+            'state': 'open', 'rejected': 2, 'transitions': {'closed': 1, 'open': 3, 'half_open': 2}})
+
+    def test_setting_change_rebuilds_breaker(self):
+        self.assertIsNone(get_database_circuit_breaker())
+        with override_settings(PAYMENT_GATEWAY_DATABASE_CIRCUIT_BREAKER={}):
+            breaker = get_database_circuit_breaker()
+            self.assertIs(get_database_circuit_breaker(), breaker)
+        with override_settings(PAYMENT_GATEWAY_DATABASE_CIRCUIT_BREAKER={'cooldown': 1}):
+            self.assertEqual(get_database_circuit_breaker().cooldown, 1)
+            self.assertIsNot(get_database_circuit_breaker(), breaker)
+        self.assertIsNone(get_database_circuit_breaker())
+
+
+@override_settings(ROOT_URLCONF=__name__, PAYMENT_GATEWAY_DATABASE_CIRCUIT_BREAKER={'min_calls': 1, 'window': 1})
+class OpenCircuitResponseTestCase(WebhookClientMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        reset_database_circuit_breaker()
+        get_database_circuit_breaker().record(0, failed=True)
+        self.addCleanup(reset_database_circuit_breaker)
+
+    def test_cloudpayments(self):
+        invoice = make_invoice()
+        for request in (self.check_cloudpayments, self.pay_cloudpayments):
+            response = request(make_cloudpayments_payload(invoice.pk, invoice.total))
+            self.assertEqual(response.status_code, 503)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_walletone(self):
+        invoice = make_invoice()
+        response = self.confirm_walletone(make_walletone_payload(invoice.pk, invoice.total))
+        self.assertEqual((response.status_code, response.data), (400, 'WMI_RESULT=RETRY'))
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).status, InvoiceStatus.PENDING)
+
+    def test_dummy(self):
+        self.assertEqual(self.pay_dummy(make_invoice(), Decimal('100.00')).status_code, 503)
+
+
+def without(payload, *keys):
+    return {key: value for key, value in payload.items() if key not in keys}
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class CompiledSchemaTestCase(WebhookClientMixin, TestCase):
+    def parse(self, serializer_class, payload, fast):
+        data = QueryDict(urlencode(payload, doseq=True)) if isinstance(payload, dict) else payload
+        try:
+            if fast:
+                validated_data = CompiledSchema(serializer_class).validate(data)
+            else:
+                serializer = serializer_class(data=data)
+                serializer.is_valid(raise_exception=True)
+                validated_data = serializer.validated_data
+        except ValidationError as e:
+            return 'invalid', e.detail, e.get_codes()
+        except WalletOneException as e:
+            return 'rejected', e.error_msg
+        return 'valid', dict(validated_data)
+
+    def assertSameResults(self, serializer_class, payloads):
+        for name, payload in payloads.items():
+            with self.subTest(serializer=serializer_class.__name__, payload=name):
+                expected = self.parse(serializer_class, payload, fast=False)
+                self.assertEqual(self.parse(serializer_class, payload, fast=True), expected)
+                yield name, expected
+
+    def test_cloudpayments(self):
+        valid = make_cloudpayments_payload(1, Decimal('100.00'))
+        payloads = {
+            'valid': valid,
+            'optional': dict(valid, Email='payer@example.com', IpAddress='10.0.0.1', IpCountry='RU', Data='{"a": 1}'),
+            'padded': dict(valid, Currency='  RUB ', TransactionId=' 7 '),
+            'missing': without(valid, 'TransactionId', 'Currency'),
+            'blank': dict(valid, Currency='', InvoiceId='  '),
+            'not_integer': dict(valid, TransactionId='7a'),
+            'integer_too_long': dict(valid, TransactionId='9' * 1001),
+            'not_decimal': dict(valid, Amount='ten'),
+            'decimal_places': dict(valid, Amount='1.001'),
+            'min_length': dict(valid, CardFirstSix='41111'),
+            'max_length': dict(valid, CardLastFour='11111', IpCountry='RUS'),
+            'datetime': dict(valid, DateTime='yesterday'),
+            'boolean': dict(valid, TestMode='maybe'),
+            'email': dict(valid, Email='payer'),
+            'ip_address': dict(valid, IpAddress='10.0.0'),
+            'json': dict(valid, Data='{'),
+            'not_mapping': ['TransactionId'],
+        }
+        results = dict(self.assertSameResults(CloudPaymentsCheckSerializer, payloads))
+        self.assertEqual(results['padded'][1]['TransactionId'], 7)
+        self.assertEqual(results['missing'][2], {'TransactionId': ['required'], 'Currency': ['required']})
+        self.assertEqual(results['not_mapping'][2], {'non_field_errors': ['invalid']})
+        payloads = {name: dict(payload, TotalFee='0.00') for name, payload in payloads.items() if name != 'not_mapping'}
+        payloads['total_fee'] = dict(valid, TotalFee='')
+        results = dict(self.assertSameResults(CloudPaymentsPaySerializer, payloads))
+        self.assertEqual(results['optional'][1]['TotalFee'], Decimal('0.00'))
+        self.assertEqual(results['total_fee'][2], {'TotalFee': ['invalid']})
+
+    def test_walletone(self):
+        invoice = make_invoice()
+
+        def signed(**changes):
+            payload = dict(make_walletone_payload(invoice.pk, invoice.total, order_id='1'), **changes)
+            payload['WMI_SIGNATURE'] = walletone_encoder._get_signature(without(payload, 'WMI_SIGNATURE')).decode()
+            return payload
+
+        valid = signed()
+        payloads = {
+            'valid': valid,
+            'optional': signed(WMI_NOTIFY_COUNT='2', WMI_DESCRIPTION='Order', WMI_TEST_MODE_INVOICE='1'),
+            'missing': without(valid, 'WMI_ORDER_STATE'),
+            'not_integer': signed(WMI_CURRENCY_ID='rub'),
+            'not_decimal': signed(WMI_PAYMENT_AMOUNT='-'),
+            'datetime': signed(WMI_EXPIRED_DATE='2030-13-01 00:00:00'),
+            'url': signed(WMI_SUCCESS_URL='example'),
+            'max_length': signed(WMI_TEST_MODE_INVOICE='10'),
+            'unknown_invoice': signed(WMI_PAYMENT_NO='0'),
+            'signature': dict(valid, WMI_SIGNATURE=valid['WMI_SIGNATURE'][::-1]),
+            'merchant': signed(WMI_MERCHANT_ID='2'),
+        }
+        results = dict(self.assertSameResults(WalletOneConfirmSerializer, payloads))
+        self.assertEqual(results['valid'][0], 'valid')
+        self.assertEqual(results['unknown_invoice'][2], {'WMI_PAYMENT_NO': ['invalid_invoice']})
+        self.assertEqual(results['signature'], ('rejected', 'WMI_RESULT=RETRY&WMI_DESCRIPTION=WMI_SIGNATURE error'))
+
+    def test_views(self):
+        invoice = make_invoice()
+        for extra in ({'TransactionId': 'x', 'Amount': '1.001'}, {}):
+            responses = []
+            for fast in (False, True):
+                with override_settings(PAYMENT_GATEWAY_FAST_PAYLOAD_PARSER=fast):
+                    response = self.check_cloudpayments(make_cloudpayments_payload(invoice.pk, invoice.total, **extra))
+                responses.append((response.status_code, response.data))
+            self.assertEqual(responses[0], responses[1])
+        self.assertEqual(responses[1], (200, {'code': CloudPaymentsResultCode.OK}))
+        with override_settings(PAYMENT_GATEWAY_FAST_PAYLOAD_PARSER=True):
+            payload = make_cloudpayments_payload(invoice.pk, invoice.total)
+            self.check_cloudpayments(payload)
+            self.assertEqual(self.pay_cloudpayments(payload).data, {'code': CloudPaymentsResultCode.OK})
+            response = self.confirm_walletone(make_walletone_payload(make_invoice().pk, invoice.total))
+            self.assertEqual(response.data, 'WMI_RESULT=OK')
+        self.assertEqual(Invoice.objects.filter(status=InvoiceStatus.PAID).count(), 2)
+
+
+class SlottedDataclassTestCase(SimpleTestCase):
+    def test_slots(self):
+        data = make_cloudpayments_payload(1, Decimal('1.00'), TotalFee=Decimal('0.00'))
+        dto = CloudPaymentsTransactionHandler.TransactionDTO(TransactionType.CLOUDPAYMENTS, 1, Decimal('1.00'), **data)
+        self.assertFalse(hasattr(dto, '__dict__'))
+        self.assertIsNone(dto.Email)
+        kwargs = to_model_kwargs(dto, CloudPaymentsTransaction)
+        self.assertEqual(kwargs['TransactionId'], data['TransactionId'])
+        self.assertEqual(kwargs['TotalFee'], Decimal('0.00'))
+        self.assertNotIn('InvoiceId', kwargs)
+
+    def test_shadowed_field(self):
+        with self.assertRaisesMessage(TypeError, 'type'):
+            @slotted_dataclass
+            class TransactionDTO(TransactionDTOBase):
+                type = TransactionType.DUMMY
+
+
+class IdentityMapTestCase(TestCase):
+    def setUp(self):
+        # Like the test client, keep the request signals from closing the test transaction's connection.
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        request_started.send(sender=self.__class__)
+        self.addCleanup(request_finished.send, sender=self.__class__)
+
+    @contextmanager
+    def assertSelects(self, count):
+        with CaptureQueriesContext(connection) as context:
+            yield
+        self.assertEqual(sum(1 for query in context.captured_queries if query['sql'].startswith('SELECT')), count)
+
+    def test_same_instance_within_request(self):
+        invoice = make_invoice()
+        with self.assertSelects(2):
+            loaded = get_invoice(invoice.pk)
+            self.assertIs(get_invoice(str(invoice.pk)), loaded)
+            self.assertFalse(invoice_exists(0))
+            with self.assertRaises(Invoice.DoesNotExist):
+                get_invoice(0)
+        with self.assertSelects(1), lock_block():
+            locked = get_invoice_for_update(invoice.pk)
+        self.assertIsNot(locked, loaded)
+        with self.assertSelects(0):
+            self.assertIs(get_invoice(invoice.pk), locked)
+
+    def test_lock_once_per_block(self):
+        invoice = make_invoice()
+        with lock_block():
+            with self.assertSelects(1):
+                locked = get_invoice_for_update(invoice.pk)
+                self.assertIs(get_invoice_for_update(invoice.pk), locked)
+            with self.assertSelects(0), lock_block():
+                self.assertIs(get_invoice_for_update(invoice.pk), locked)
+        with self.assertSelects(1), lock_block():
+            self.assertIsNot(get_invoice_for_update(invoice.pk), locked)
+        with self.assertSelects(2):
+            get_invoice_for_update(invoice.pk)
+            get_invoice_for_update(invoice.pk)
+
+    def test_relock_after_rollback(self):
+        invoice, other = make_invoice(), make_invoice()
+        with lock_block():
+            get_invoice_for_update(invoice.pk)
+            with self.assertRaises(InvoiceAlreadyPaid), lock_block():
+                with self.assertSelects(1):
+                    get_invoice_for_update(invoice.pk)
+                    locked = get_invoice_for_update(other.pk)
+                raise InvoiceAlreadyPaid()
+            with self.assertSelects(1):
+                get_invoice_for_update(invoice.pk)
+                self.assertIsNot(get_invoice_for_update(other.pk), locked)
+
+    def test_cleared_on_request_finished(self):
+        invoice = make_invoice()
+        get_invoice(invoice.pk)
+        request_finished.send(sender=self.__class__)
+        with self.assertSelects(2):
+            self.assertIsNot(get_invoice(invoice.pk), get_invoice(invoice.pk))
+        with invoice_scope():
+            with self.assertSelects(1):
+                self.assertIs(get_invoice(invoice.pk), get_invoice(invoice.pk))
+        with self.assertSelects(2):
+            get_invoice(invoice.pk)
+            get_invoice(invoice.pk)
+
+
+@contextmanager
+def external_references(*providers):
+    for provider in providers:
+        provider.external_reference = True
+    try:
+        yield
+    finally:
+        for provider in providers:
+            provider.external_reference = False
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class ExternalReferenceTestCase(WebhookClientMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.invoice = create_invoice(Decimal('100.00'), SUCCESS_CALLBACK, external_reference='order-1')
+
+    def test_resolve_invoice_id(self):
+        self.assertEqual(resolve_invoice_id(str(self.invoice.pk)), self.invoice.pk)
+        self.assertEqual(resolve_invoice_id('order-1', external_reference=True), self.invoice.pk)
+        self.assertIsNone(resolve_invoice_id('order-2', external_reference=True))
+        with invoice_scope():
+            with self.assertNumQueries(2):
+                self.assertEqual(resolve_invoice_id('order-1', external_reference=True), self.invoice.pk)
+                self.assertIsNone(resolve_invoice_id('order-2', external_reference=True))
+            with self.assertNumQueries(0):
+                self.assertEqual(resolve_invoice_id('order-1', external_reference=True), self.invoice.pk)
+                self.assertIsNone(resolve_invoice_id('order-2', external_reference=True))
+                self.assertEqual(get_invoice(self.invoice.pk), self.invoice)
+
+    def test_get_invoice_by_external_reference(self):
+        self.assertEqual(get_invoice_by_external_reference('order-1'), self.invoice)
+        with self.assertRaises(Invoice.DoesNotExist):
+            get_invoice_by_external_reference(str(self.invoice.pk))
+
+    def test_cloudpayments(self):
+        with external_references(CloudPaymentsSerializerBase.provider):
+            payload = make_cloudpayments_payload('order-1', self.invoice.total)
+            self.assertEqual(self.check_cloudpayments(payload).data['code'], CloudPaymentsResultCode.OK)
+            self.assertEqual(self.pay_cloudpayments(payload).data['code'], CloudPaymentsResultCode.OK)
+            payload = make_cloudpayments_payload(self.invoice.pk, self.invoice.total)
+            self.assertEqual(self.check_cloudpayments(payload).data['code'],
+                             CloudPaymentsResultCode.INVALID_INVOICE_ID)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.status, InvoiceStatus.PAID)
+        self.assertEqual(CloudPaymentsTransaction.objects.get().invoice_id, self.invoice.pk)
+
+    def test_walletone(self):
+        with external_references(WalletOneConfirmSerializer.provider):
+            self.assertEqual(self.confirm_walletone(make_walletone_payload(self.invoice.pk, '100.00')).status_code,
+                             400)
+            self.assertEqual(self.confirm_walletone(make_walletone_payload('order-1', '100.00')).status_code, 200)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.status, InvoiceStatus.PAID)
+
+    def test_walletone_batch_sign(self):
+        expires_at = timezone.now() + timedelta(days=1)
+        referenced = create_invoice(Decimal('100.00'), SUCCESS_CALLBACK, expires_at=expires_at, details={},
+                                    external_reference='order-2')
+        unreferenced = create_invoice(Decimal('100.00'), SUCCESS_CALLBACK, expires_at=expires_at, details={})
+        with external_references(WalletOneBatchSignSerializer.provider):
+            response = self.client.post('/walletone/batch-sign/', {'invoices': [referenced.pk, unreferenced.pk]},
+                                        format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(response.data[0]['data'])['WMI_PAYMENT_NO'], 'order-2')
+        self.assertEqual(response.data[1]['error']['code'], 'no_reference')
+
+
+class InvoiceDetailsTestCase(TestCase):
+    def assertFiltersDetails(self):
+        first = make_invoice(details={'order': 'A1', 'number': 7, 'tags': ['paid', 'gift']})
+        make_invoice(details={'order': 'A2', 'number': 8, 'tags': ['gift']})
+        make_invoice(details=None)
+        self.assertEqual(list(filter_invoices_by_detail('order', 'A1')), [first])
+        self.assertEqual(list(filter_invoices_by_detail('number', 7)), [first])
+        self.assertEqual(list(filter_invoices_by_detail('order', 'A3')), [])
+        queryset = Invoice.objects.filter(status=InvoiceStatus.PAID)
+        self.assertEqual(list(filter_invoices_by_detail('order', 'A1', queryset)), [])
+
+    def test_filter_invoices_by_detail(self):
+        self.assertFiltersDetails()
+
+    def test_filter_invoices_by_detail_without_key_lookups(self):
+        if connection.vendor == 'postgresql':
+            self.skipTest('PostgreSQL filters with key transforms.')
+        # The details field as it is on Django < 3.1.
+        field = Invoice._meta.get_field('details')
+        field_class = field.__class__
+        field.__class__ = TextJSONField
+        try:
+            self.assertIsNone(field.get_transform('order'))
+            self.assertFiltersDetails()
+        finally:
+            field.__class__ = field_class
+
+    @tag('postgres')
+    @override_settings(PAYMENT_GATEWAY_INVOICE_DETAILS_INDEXES={'order': 'btree', 'tags': 'gin'})
+    def test_filter_invoices_by_indexed_detail(self):
+        first = make_invoice(details={'order': 'A1', 'tags': ['paid', 'gift']})
+        second = make_invoice(details={'order': 'A2', 'tags': ['gift']})
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(list(filter_invoices_by_detail('order', 'A1')), [first])
+        self.assertIn('->>', context.captured_queries[0]['sql'])
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(list(filter_invoices_by_detail('tags', ['paid']).order_by('pk')), [first])
+            self.assertEqual(list(filter_invoices_by_detail('tags', ['gift']).order_by('pk')), [first, second])
+        self.assertIn('@>', context.captured_queries[0]['sql'])
+
+    def test_sync_indexes_requires_postgresql(self):
+        if connection.vendor == 'postgresql':
+            self.skipTest('Invoice details indexes are supported on PostgreSQL.')
+        with self.assertRaises(CommandError):
+            call_command('sync_invoice_details_indexes', stdout=StringIO())
+
+
+@tag('postgres')
+class InvoiceDetailsIndexesTestCase(TransactionTestCase):
+    def get_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s AND indexname LIKE %s',
+                           [Invoice._meta.db_table, 'payment_gateway_invoice_details_%'])
+            return sorted(name for name, in cursor.fetchall())
+
+    def sync(self, *args):
+        stdout = StringIO()
+        call_command('sync_invoice_details_indexes', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_sync(self):
+        with override_settings(PAYMENT_GATEWAY_INVOICE_DETAILS_INDEXES={'order': 'btree', 'tags': 'gin'}):
+            output = self.sync('--dry-run')
+            self.assertEqual(output.count('CREATE INDEX CONCURRENTLY'), 2)
+            self.assertEqual(self.get_indexes(), [])
+            self.sync()
+            self.assertEqual(self.get_indexes(), ['payment_gateway_invoice_details_order_btree',
+                                                  'payment_gateway_invoice_details_tags_gin'])
+            self.assertIn('up to date', self.sync())
+        with override_settings(PAYMENT_GATEWAY_INVOICE_DETAILS_INDEXES={'order': 'btree'}):
+            self.assertIn('DROP INDEX CONCURRENTLY', self.sync())
+            self.assertEqual(self.get_indexes(), ['payment_gateway_invoice_details_order_btree'])
+        with override_settings(PAYMENT_GATEWAY_INVOICE_DETAILS_INDEXES={'order-id': 'btree'}):
+            with self.assertRaises(CommandError):
+                self.sync()
+        self.sync()
+        self.assertEqual(self.get_indexes(), [])
+
+
+delivered_batches = []
+batch_callback_result = None
+
+
+def record_batch_callback(invoice_ids):
+    delivered_batches.append(invoice_ids)
+    return batch_callback_result
+
+
+def raise_batch_callback(invoice_ids):
+    raise RuntimeError('unavailable')
+
+
+def break_transaction_batch_callback(invoice_ids):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT missing_column FROM payment_gateway_invoice')
+
+
+class RecordingBatcher(CallbackBatcher):
+    def __init__(self, window, max_batch_size):
+        super().__init__(window, max_batch_size)
+        self.flushes = []
+        self.flushed = threading.Event()
+
+    def flush(self):
+        self.flushes.append(self._waiting)
+        self.flushed.set()
+
+
+class BatchedCallbackTestCase(TestCase):
+    def setUp(self):
+        global batch_callback_result
+        batch_callback_result = None
+        delivered_batches.clear()
+
+    def queue(self, invoice, callback='payment_gateway.tests.record_batch_callback'):
+        return PendingCallback.objects.create(invoice=invoice, callback=callback)
+
+    @override_settings(PAYMENT_GATEWAY_BATCHED_CALLBACKS=True)
+    def test_queued_in_payment_transaction(self):
+        provider = get_dummy_provider()
+        self.assertIsInstance(provider.payment_handler.callback_provider, BatchedCallbackProvider)
+        invoice = make_invoice()
+        data = provider.transaction_handler.TransactionDTO(TransactionType.DUMMY, invoice.pk, invoice.total)
+        with self.assertRaises(DatabaseError), db_transaction.atomic():
+            provider.pay(invoice.pk, data)
+            self.assertEqual(PendingCallback.objects.get().invoice_id, invoice.pk)
+            raise DatabaseError('payment rolled back')
+        self.assertFalse(PendingCallback.objects.exists())
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.status, InvoiceStatus.PENDING)
+        with self.captureOnCommitCallbacks() as callbacks:
+            provider.pay(invoice.pk, provider.transaction_handler.TransactionDTO(TransactionType.DUMMY, invoice.pk,
+                                                                                 invoice.total))
+        pending = PendingCallback.objects.get()
+        self.assertEqual((pending.invoice_id, pending.callback), (invoice.pk, SUCCESS_CALLBACK))
+        self.assertIn(provider.payment_handler.callback_provider.batcher.notify, callbacks)
+
+    def test_flush(self):
+        global batch_callback_result
+        invoices = [make_invoice() for _ in range(3)]
+        for invoice in invoices + invoices[:1]:
+            self.queue(invoice)
+        other = self.queue(invoices[2], SUCCESS_CALLBACK)
+        batch_callback_result = {invoices[1].pk: 'declined'}
+        self.assertEqual(flush_pending_callbacks(), (4, 1))
+        self.assertEqual(delivered_batches, [[invoice.pk for invoice in invoices]])
+        self.assertFalse(PendingCallback.objects.filter(pk=other.pk).exists())
+        retry = PendingCallback.objects.get()
+        self.assertEqual((retry.invoice_id, retry.attempts, retry.last_error), (invoices[1].pk, 1, 'declined'))
+        self.assertGreater(retry.available_at, timezone.now())
+        self.assertEqual(flush_pending_callbacks(), (0, 0))
+        PendingCallback.objects.update(available_at=timezone.now())
+        batch_callback_result = [invoices[1].pk]
+        self.assertEqual(flush_pending_callbacks(), (0, 1))
+        self.assertEqual(PendingCallback.objects.get().attempts, 2)
+        batch_callback_result = []
+        PendingCallback.objects.update(available_at=timezone.now())
+        self.assertEqual(flush_pending_callbacks(), (1, 0))
+        self.assertFalse(PendingCallback.objects.exists())
+
+    def test_failed_callable_keeps_rows(self):
+        global batch_callback_result
+        invoices = [make_invoice() for _ in range(2)]
+        results = [('raise', None), ('garbage', 42), ('unknown ids', [0]), ('string', 'ok'), ('mapping', {0: 'x'})]
+        for name, result in results:
+            with self.subTest(name):
+                PendingCallback.objects.all().delete()
+                if name == 'raise':
+                    entries = [self.queue(invoice, 'payment_gateway.tests.raise_batch_callback')
+                               for invoice in invoices]
+                else:
+                    entries = [self.queue(invoice) for invoice in invoices]
+                batch_callback_result = result
+                self.assertEqual(flush_pending_callbacks(), (0, 2))
+                self.assertEqual(sorted(PendingCallback.objects.values_list('pk', 'attempts')),
+                                 [(entry.pk, 1) for entry in entries])
+
+    def test_database_error_in_callable(self):
+        invoices = [make_invoice() for _ in range(2)]
+        broken = self.queue(invoices[0], 'payment_gateway.tests.break_transaction_batch_callback')
+        self.queue(invoices[1])
+        with self.assertLogs('payment_gateway.callbacks', 'WARNING'):
+            self.assertEqual(flush_pending_callbacks(), (1, 1))
+        self.assertEqual(delivered_batches, [[invoices[1].pk]])
+        retry = PendingCallback.objects.get()
+        self.assertEqual((retry.pk, retry.attempts), (broken.pk, 1))
+        self.assertIn('missing_column', retry.last_error)
+
+    def test_batcher_flushes_at_size(self):
+        batcher = RecordingBatcher(60, 3)
+        batcher.notify()
+        batcher.notify()
+        self.assertFalse(batcher.flushed.wait(0.05))
+        batcher.notify()
+        self.assertTrue(batcher.flushed.wait(1))
+        self.assertEqual(batcher.flushes, [3])
+        batcher._timer.cancel()
+
+    def test_batcher_flushes_after_window(self):
+        batcher = RecordingBatcher(0.1, 100)
+        started = time.monotonic()
+        batcher.notify()
+        batcher.notify()
+        self.assertFalse(batcher.flushed.is_set())
+        self.assertTrue(batcher.flushed.wait(1))
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(batcher.flushes, [2])
+
+
+def make_cloudpayments_dto(**extra):
+    payload = make_cloudpayments_payload(1, Decimal('100.00'), TotalFee=Decimal('0.00'), **extra)
+    return CloudPaymentsTransactionHandler.TransactionDTO(TransactionType.CLOUDPAYMENTS, 1, Decimal('100.00'),
+                                                          **payload)
+
+
+class SlidingWindowCounterTestCase(SimpleTestCase):
+    def test_limit(self):
+        counter = SlidingWindowCounter(limit=3, window=3600, max_keys=10)
+        self.assertEqual([counter.hit('card') for _ in range(4)], [True, True, True, False])
+        self.assertTrue(counter.hit('other'))
+
+    def test_previous_window(self):
+        counter = SlidingWindowCounter(limit=10, window=3600, max_keys=10)
+        self.assertEqual(counter.estimate(previous=10, current=2, elapsed=900), 9.5)
+        index = divmod(time.time(), counter.window)[0]
+        counter._windows['recent'] = [index - 1, 3, 5]
+        counter._windows['stale'] = [index - 2, 3, 5]
+        counter.hit('recent')
+        counter.hit('stale')
+        self.assertEqual(counter._windows['recent'], [index, 5, 1])
+        self.assertEqual(counter._windows['stale'], [index, 0, 1])
+        counter._windows['full'] = [index - 1, 0, 10 ** 9]
+        self.assertFalse(counter.hit('full'))
+
+    def test_max_keys(self):
+        counter = SlidingWindowCounter(limit=1, window=3600, max_keys=2)
+        counter.hit('first')
+        counter.hit('second')
+        counter.hit('first')
+        counter.hit('third')
+        self.assertEqual(list(counter._windows), ['first', 'third'])
+        self.assertTrue(counter.hit('second'))
+
+    def test_cache(self):
+        counter = CacheSlidingWindowCounter(limit=2, window=3600, cache_alias='default')
+        counter.cache.clear()
+        self.assertEqual([counter.hit('card') for _ in range(3)], [True, True, False])
+        self.assertTrue(counter.hit('other'))
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class VelocityTestCase(WebhookClientMixin, TestCase):
+    rules = [{'key': 'card', 'limit': 2, 'window': 3600}, {'key': 'ip', 'limit': 2, 'window': 3600}]
+
+    def test_checker(self):
+        with override_settings(PAYMENT_GATEWAY_CLOUDPAYMENTS_VELOCITY_RULES=self.rules):
+            checker = get_velocity_checker()
+            self.assertEqual([rule.name for rule in checker.rules], ['card:2:3600', 'ip:2:3600'])
+            self.assertTrue(checker.check(make_cloudpayments_dto(IpAddress='10.0.0.1')))
+            self.assertTrue(checker.check(make_cloudpayments_dto(IpAddress='10.0.0.1')))
+            self.assertFalse(checker.check(make_cloudpayments_dto(IpAddress='10.0.0.2'), raise_exc=False))
+            with self.assertRaises(VelocityLimitExceeded):
+                checker.check(make_cloudpayments_dto(CardLastFour='2222', IpAddress='10.0.0.1'))
+            self.assertTrue(checker.check(make_cloudpayments_dto(CardLastFour='3333')))
+        self.assertIsNone(get_velocity_checker())
+
+    def test_check_rejected(self):
+        invoice = make_invoice()
+        with override_settings(PAYMENT_GATEWAY_CLOUDPAYMENTS_VELOCITY_RULES=self.rules[:1]):
+            codes = [self.check_cloudpayments(make_cloudpayments_payload(invoice.pk, invoice.total)).data['code']
+                     for _ in range(3)]
+            other = make_cloudpayments_payload(invoice.pk, invoice.total, CardLastFour='2222')
+            codes.append(self.check_cloudpayments(other).data['code'])
+        self.assertEqual(codes, [CloudPaymentsResultCode.OK, CloudPaymentsResultCode.OK,
+                                 CloudPaymentsResultCode.UNPROCESSABLE, CloudPaymentsResultCode.OK])
+        self.assertEqual(list(CloudPaymentsTransaction.objects.order_by('pk').values_list('status', flat=True)), [
+            TransactionStatus.PENDING, TransactionStatus.PENDING, TransactionStatus.DECLINED,
+            TransactionStatus.PENDING])
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.status, InvoiceStatus.PENDING)
+
+
+class OptimisticPaymentTestCase(TestCase):
+    def test_claimed_by_same_transaction(self):
+        transaction_handler = DummyTransactionHandler()
+        payment_handler = BasicPaymentHandler(BasicCallbackProvider(), transaction_handler)
+        invoice = make_invoice()
+        stale = Invoice.objects.get(pk=invoice.pk)
+        data = transaction_handler.TransactionDTO(TransactionType.DUMMY, invoice.pk, invoice.total)
+        transaction, other = transaction_handler.create(data), transaction_handler.create(data)
+        with db_transaction.atomic():
+            payment_handler.try_process_payment_optimistic(invoice, transaction)
+        with db_transaction.atomic():
+            self.assertEqual(payment_handler.try_process_payment_optimistic(stale, transaction).status,
+                             InvoiceStatus.PAID)
+        with self.assertRaises(InvoiceAlreadyPaid), db_transaction.atomic():
+            payment_handler.try_process_payment_optimistic(Invoice.objects.get(pk=invoice.pk), other)
+        transaction.refresh_from_db()
+        self.assertEqual(transaction.status, TransactionStatus.SUCCESS)
+
+
+@tag('postgres')
+class ConcurrentPaymentTestCase(TransactionTestCase):
+    """
+    Row locks and conditional updates only serialize payments on PostgreSQL.
+    """
+    workers = 8
+
+    def pay_concurrently(self, concurrency_mode):
+        transaction_handler = DummyTransactionHandler()
+        payment_handler = BasicPaymentHandler(BasicCallbackProvider(), transaction_handler)
+        provider = DummyPaymentProvider(payment_handler, transaction_handler, concurrency_mode)
+        invoice = create_invoice(Decimal('100.00'), SUCCESS_CALLBACK)
+
+        def pay(_):
+            data = transaction_handler.TransactionDTO(TransactionType.DUMMY, invoice.pk, invoice.total)
+            try:
+                provider.pay(invoice.pk, data)
+            except PaymentError:
+                pass
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            list(executor.map(pay, range(self.workers)))
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.status, InvoiceStatus.PAID)
+        self.assertEqual(invoice.attempts_count, self.workers)
+        self.assertEqual(invoice.failed_attempts_count, self.workers - 1)
+        self.assertEqual(Transaction.objects.filter(success_invoice=invoice).count(), 1)
+        self.assertEqual(Invoice.objects.filter(status=InvoiceStatus.PAID).count(), 1)
+
+    def test_lock(self):
+        self.pay_concurrently(ConcurrencyMode.LOCK)
+
+    def test_optimistic(self):
+        self.pay_concurrently(ConcurrencyMode.OPTIMISTIC)
+
+    def test_optimistic_retried_notification(self):
+        # WalletOne delivers the same WMI_ORDER_ID again after a failed attempt, so every notification shares the
+        # transaction and all but the claiming one must report the payment as already made.
+        provider = WalletOneConfirmSerializer.provider
+        self.addCleanup(setattr, provider, 'concurrency_mode', provider.concurrency_mode)
+        provider.concurrency_mode = ConcurrencyMode.OPTIMISTIC
+        invoice = create_invoice(Decimal('100.00'), SUCCESS_CALLBACK)
+        payload = make_walletone_payload(invoice.pk, invoice.total)
+        short_payload = make_walletone_payload(invoice.pk, Decimal('1.00'), order_id=payload['WMI_ORDER_ID'])
+
+        def confirm(payload):
+            serializer = WalletOneConfirmSerializer(data=payload)
+            try:
+                serializer.is_valid(raise_exception=True)
+                serializer.save()
+                return True
+            except WalletOneException:
+                return False
+            finally:
+                connection.close()
+
+        self.assertFalse(confirm(short_payload))
+        with ThreadPoolExecutor(self.workers) as executor:
+            confirmed = list(executor.map(confirm, [payload] * self.workers))
+        invoice.refresh_from_db()
+        self.assertEqual(confirmed, [True] * self.workers)
+        self.assertEqual(invoice.status, InvoiceStatus.PAID)
+        self.assertEqual(invoice.success_transaction.status, TransactionStatus.SUCCESS)
+        self.assertEqual(Transaction.objects.filter(invoice=invoice).count(), 1)
+
+    def test_overlapping_settlements(self):
+        transaction_handler = DummyTransactionHandler()
+        payment_handler = BasicPaymentHandler(BasicCallbackProvider(), transaction_handler)
+        provider = DummyPaymentProvider(payment_handler, transaction_handler)
+        window = 3
+
+        def settle(invoices, index):
+            # Every settlement overlaps its neighbours and lists its invoices in a different order.
+            chosen = [invoices[(index + offset) % len(invoices)] for offset in range(window)]
+            chosen = chosen[::-1] if index % 2 else chosen
+            data = transaction_handler.TransactionDTO(TransactionType.DUMMY, chosen[0].pk, Decimal('10.00') * window)
+            try:
+                provider.settle([invoice.pk for invoice in chosen], transaction_handler.create(data))
+                return True
+            except PaymentError:
+                return False
+            finally:
+                connection.close()
+
+        for _ in range(5):
+            invoices = [create_invoice(Decimal('10.00'), SUCCESS_CALLBACK) for _ in range(self.workers)]
+            with ThreadPoolExecutor(self.workers) as executor:
+                settled = sum(executor.map(lambda index: settle(invoices, index), range(self.workers)))
+            paid = Invoice.objects.filter(pk__in=[invoice.pk for invoice in invoices], status=InvoiceStatus.PAID)
+            self.assertGreaterEqual(settled, 1)
+            self.assertEqual(paid.count(), settled * window)
+            self.assertEqual(paid.values('success_transaction').distinct().count(), settled)
+            self.assertEqual(InvoiceStatusChange.objects.filter(invoice__in=paid).count(), settled * window)
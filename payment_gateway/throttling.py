@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from rest_framework.throttling import BaseThrottle
+
+from payment_gateway.settings import api_settings
+
+
+class TokenBucketLimiter(object):
+    def __init__(self, rate: float, burst: int, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                self._buckets.move_to_end(key)
+            return self._take(key, tokens, now)
+
+    def _take(self, key: str, tokens: float, now: float) -> float:
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            return 0
+        self._buckets[key] = (tokens, now)
+        return (1 - tokens) / self.rate
+
+
+class CacheTokenBucketLimiter(TokenBucketLimiter):
+    key_prefix = 'payment_gateway:throttle:'
+
+    def __init__(self, rate: float, burst: int, cache_alias: str):
+        super().__init__(rate, burst, max_keys=0)
+        self.cache = caches[cache_alias]
+        self.timeout = int(burst / rate) + 1
+
+    def consume(self, key: str) -> float:
+        # Buckets are read and written without a cross-worker lock, concurrent requests may be let through
+        # slightly above the budget.
+        now = time.time()
+        cache_key = self.key_prefix + key
+        bucket = self.cache.get(cache_key)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens >= 1:
+            self.cache.set(cache_key, (tokens - 1, now), self.timeout)
+            return 0
+        self.cache.set(cache_key, (tokens, now), self.timeout)
+        return (1 - tokens) / self.rate
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(scope: str) -> TokenBucketLimiter:
+    if scope not in api_settings.WEBHOOK_THROTTLE_RATES:
+        return None
+    limiter = _limiters.get(scope)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(scope)
+            if limiter is None:
+                limiter = _limiters[scope] = make_limiter(api_settings.WEBHOOK_THROTTLE_RATES[scope])
+    return limiter
+
+
+def make_limiter(config: dict) -> TokenBucketLimiter:
+    if api_settings.WEBHOOK_THROTTLE_CACHE is not None:
+        return CacheTokenBucketLimiter(config['rate'], config['burst'], api_settings.WEBHOOK_THROTTLE_CACHE)
+    return TokenBucketLimiter(config['rate'], config['burst'], api_settings.WEBHOOK_THROTTLE_MAX_KEYS)
+
+
+def reset_limiters(*args, **kwargs):
+    if kwargs.get('setting', 'PAYMENT_GATEWAY').startswith('PAYMENT_GATEWAY'):
+        _limiters.clear()
+
+
+setting_changed.connect(reset_limiters)
+
+
+class WebhookRateThrottle(BaseThrottle):
+    """
+    Token bucket per source IP and provider. Budgets are declared per view throttle_scope in
+    PAYMENT_GATEWAY_WEBHOOK_THROTTLE_RATES, e.g. {'cloudpayments': {'rate': 5, 'burst': 50}}; set
+    PAYMENT_GATEWAY_WEBHOOK_THROTTLE_CACHE to a cache alias to share buckets between workers.
+    """
+    wait_time = 0
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        limiter = get_limiter(scope)
+        if limiter is None:
+            return True
+        self.wait_time = limiter.consume('%s:%s' % (scope, self.get_ident(request)))
+        return self.wait_time == 0
+
+    def wait(self):
+        return self.wait_time
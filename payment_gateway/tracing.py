@@ -0,0 +1,92 @@
+import functools
+
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from payment_gateway.models import Invoice, Transaction
+from payment_gateway.settings import api_settings
+
+SPAN_PREFIX = 'payment_gateway.'
+
+
+class NoopSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+_UNRESOLVED = object()
+_tracer = _UNRESOLVED
+
+
+def resolve_tracer(path: str):
+    """
+    PAYMENT_GATEWAY_TRACER is either 'opentelemetry' or the dotted path of an object, or of a factory returning
+    one, that provides OpenTelemetry's start_as_current_span(name, attributes=...).
+    """
+    if path is None:
+        return None
+    if path == 'opentelemetry':
+        from opentelemetry import trace
+        return trace.get_tracer('payment_gateway')
+    tracer = import_string(path)
+    if not hasattr(tracer, 'start_as_current_span'):
+        tracer = tracer()
+    return tracer
+
+
+def get_tracer():
+    global _tracer
+    if _tracer is _UNRESOLVED:
+        _tracer = resolve_tracer(api_settings.TRACER)
+    return _tracer
+
+
+def reset_tracer(*args, **kwargs):
+    global _tracer
+    if kwargs.get('setting', 'PAYMENT_GATEWAY').startswith('PAYMENT_GATEWAY'):
+        _tracer = _UNRESOLVED
+
+
+setting_changed.connect(reset_tracer)
+
+
+def span(name: str, **attributes):
+    tracer = _tracer if _tracer is not _UNRESOLVED else get_tracer()
+    if tracer is None:
+        return NOOP_SPAN
+    return tracer.start_as_current_span(SPAN_PREFIX + name,
+                                        attributes={k: v for k, v in attributes.items() if v is not None})
+
+
+def get_span_attributes(values) -> dict:
+    attributes = {}
+    for value in values:
+        if isinstance(value, Invoice):
+            attributes['invoice_id'] = value.pk
+        elif isinstance(value, Transaction):
+            attributes['transaction_id'] = value.pk
+            attributes.setdefault('invoice_id', value.invoice_id)
+        elif getattr(value, 'invoice_id', None) is not None:
+            attributes.setdefault('invoice_id', value.invoice_id)
+    return attributes
+
+
+def traced(func):
+    name = SPAN_PREFIX + func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        tracer = _tracer if _tracer is not _UNRESOLVED else get_tracer()
+        if tracer is None:
+            return func(*args, **kwargs)
+        attributes = get_span_attributes(args[1:] + tuple(kwargs.values()))
+        with tracer.start_as_current_span(name, attributes=attributes):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from payment_gateway.errors import VelocityLimitExceeded
+from payment_gateway.settings import api_settings
+
+
+class SlidingWindowCounter(object):
+    """
+    Approximates the number of hits in the last `window` seconds from the counts of the current and the
+    previous fixed window, weighting the previous one by its overlap. Keeps at most `max_keys` keys.
+    """
+
+    def __init__(self, limit: int, window: float, max_keys: int):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key: str) -> bool:
+        now = time.time()
+        index, elapsed = divmod(now, self.window)
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is None:
+                if len(self._windows) >= self.max_keys:
+                    self._windows.popitem(last=False)
+                entry = [index, 0, 0]
+            else:
+                self._windows.move_to_end(key)
+                if entry[0] != index:
+                    entry = [index, entry[2] if entry[0] == index - 1 else 0, 0]
+            entry[2] += 1
+            self._windows[key] = entry
+            previous, current = entry[1], entry[2]
+        return self.estimate(previous, current, elapsed) <= self.limit
+
+    def estimate(self, previous: int, current: int, elapsed: float) -> float:
+        return previous * (1 - elapsed / self.window) + current
+
+
+class CacheSlidingWindowCounter(SlidingWindowCounter):
+    key_prefix = 'payment_gateway:velocity:'
+
+    def __init__(self, limit: int, window: float, cache_alias: str):
+        super().__init__(limit, window, max_keys=0)
+        self.cache = caches[cache_alias]
+        self.timeout = int(window * 2) + 1
+
+    def hit(self, key: str) -> bool:
+        index, elapsed = divmod(time.time(), self.window)
+        current_key = '%s%s:%d' % (self.key_prefix, key, index)
+        previous_key = '%s%s:%d' % (self.key_prefix, key, index - 1)
+        self.cache.add(current_key, 0, self.timeout)
+        current = self.cache.incr(current_key)
+        previous = self.cache.get(previous_key, 0)
+        return self.estimate(previous, current, elapsed) <= self.limit
+
+
+def card_key(transaction) -> str:
+    if not transaction.CardFirstSix or not transaction.CardLastFour:
+        return None
+    return '%s*%s' % (transaction.CardFirstSix, transaction.CardLastFour)
+
+
+def ip_key(transaction) -> str:
+    return transaction.IpAddress or None
+
+
+VELOCITY_KEYS = {
+    'card': card_key,
+    'ip': ip_key,
+}
+
+
+class VelocityRule(object):
+    def __init__(self, name: str, key_func, counter: SlidingWindowCounter):
+        self.name = name
+        self.key_func = key_func
+        self.counter = counter
+
+    def hit(self, transaction) -> bool:
+        key = self.key_func(transaction)
+        return key is None or self.counter.hit('%s:%s' % (self.name, key))
+
+
+class VelocityChecker(object):
+    """
+    Counts every checked transaction against all rules and rejects it when any of them is over its limit.
+    """
+
+    def __init__(self, rules: list):
+        self.rules = rules
+
+    def check(self, transaction, raise_exc: bool = True) -> bool:
+        exceeded = [rule.name for rule in self.rules if not rule.hit(transaction)]
+        if exceeded and raise_exc:
+            raise VelocityLimitExceeded()
+        return not exceeded
+
+
+def make_rule(config: dict) -> VelocityRule:
+    key = config['key']
+    key_func = VELOCITY_KEYS[key] if key in VELOCITY_KEYS else import_string(key)
+    name = config.get('name', '%s:%s:%s' % (key, config['limit'], config['window']))
+    if api_settings.CLOUDPAYMENTS_VELOCITY_CACHE is not None:
+        counter = CacheSlidingWindowCounter(config['limit'], config['window'],
+                                            api_settings.CLOUDPAYMENTS_VELOCITY_CACHE)
+    else:
+        counter = SlidingWindowCounter(config['limit'], config['window'], api_settings.CLOUDPAYMENTS_VELOCITY_MAX_KEYS)
+    return VelocityRule(name, key_func, counter)
+
+
+_UNRESOLVED = object()
+_checker = _UNRESOLVED
+_checker_lock = threading.Lock()
+
+
+def get_velocity_checker() -> VelocityChecker:
+    """
+    PAYMENT_GATEWAY_CLOUDPAYMENTS_VELOCITY_RULES is a list of {'key': 'card' | 'ip' | dotted path of a
+    function(transaction) -> str, 'limit': hits, 'window': seconds}. Without rules there is no checker.
+    """
+    global _checker
+    if _checker is _UNRESOLVED:
+        with _checker_lock:
+            if _checker is _UNRESOLVED:
+                rules = [make_rule(config) for config in api_settings.CLOUDPAYMENTS_VELOCITY_RULES]
+                _checker = VelocityChecker(rules) if rules else None
+    return _checker
+
+
+def reset_velocity_checker(*args, **kwargs):
+    global _checker
+    if kwargs.get('setting', 'PAYMENT_GATEWAY').startswith('PAYMENT_GATEWAY'):
+        _checker = _UNRESOLVED
+
+
+setting_changed.connect(reset_velocity_checker)
@@ -1,14 +1,11 @@
-from dataclasses import dataclass
 from datetime import datetime
 from decimal import Decimal
 
-from payment_gateway.dto import Transaction
-from payment_gateway.models import TransactionType
+from payment_gateway.dto import Transaction, slotted_dataclass
 
 
-@dataclass
+@slotted_dataclass
 class WalletOneTransaction(Transaction):
-    type = TransactionType.WALLETONE
     WMI_ORDER_ID: str
     WMI_MERCHANT_ID: str
     WMI_PAYMENT_AMOUNT: Decimal
@@ -1,16 +1,24 @@
 import hashlib
 import logging
+import threading
 from base64 import b64encode
 from collections import defaultdict
 from datetime import datetime
 
+from django.core.signals import setting_changed
 from django.db import transaction as db_transaction, IntegrityError
 from django.utils.translation import ugettext_lazy as _
-from payment_gateway.base import AbstractPaymentProvider, BasicTransactionHandler, BasicCallbackProvider, \
-    BasicPaymentHandler
+from rest_framework.exceptions import ValidationError
+from payment_gateway.base import AbstractPaymentProvider, BasicTransactionHandler, \
+    BasicPaymentHandler, get_concurrency_mode, uses_external_reference
+from payment_gateway.callbacks import get_callback_provider
+from payment_gateway.circuitbreaker import guard_database
+from payment_gateway.dto import to_model_kwargs
 from payment_gateway.errors import InvalidMoneyAmount, InvoiceExpired, PaymentError
+from payment_gateway.identity import lock_block
 from payment_gateway.models import WalletOneTransaction, Invoice, Transaction, InvoiceStatus, TransactionStatus
 from payment_gateway.settings import api_settings
+from payment_gateway.tracing import traced
 
 from .dto import WalletOneTransaction as WalletOneTransactionDTO
 
@@ -19,9 +27,10 @@ logger = logging.getLogger(__name__)
 
 def get_walletone_provider():
     transaction_handler = WalletOneTransactionHandler()
-    callback_provider = BasicCallbackProvider()
+    callback_provider = get_callback_provider()
     payment_handler = BasicPaymentHandler(callback_provider, transaction_handler)
-    return WalletOnePaymentProvider(payment_handler, transaction_handler)
+    return WalletOnePaymentProvider(payment_handler, transaction_handler, get_concurrency_mode('walletone'),
+                                    uses_external_reference('walletone'))
 
 
 class WalletOneSignEncoder(object):
@@ -55,20 +64,124 @@ class WalletOneSignEncoder(object):
         return signature
 
 
+class WalletOneSigner(WalletOneSignEncoder):
+    def __init__(self, secret_key: str):
+        self.SECRET_KEY = secret_key
+
+
+class WalletOneMerchant(object):
+    def __init__(self, merchant_id: str, secret_key: str, currency_id: int, success_url: str, fail_url: str):
+        self.merchant_id = merchant_id
+        self.currency_id = currency_id
+        self.success_url = success_url
+        self.fail_url = fail_url
+        self.signer = WalletOneSigner(secret_key)
+
+
+_merchants = {}
+_merchants_lock = threading.Lock()
+
+
+def get_merchants() -> dict:
+    """
+    Merchant accounts by WMI_MERCHANT_ID: the account of the WALLETONE_* settings plus the ones of
+    PAYMENT_GATEWAY_WALLETONE_MERCHANTS, {merchant_id: {'SECRET_KEY', optional 'CURRENCY_ID', 'SUCCESS_URL',
+    'FAIL_URL'}}. Omitted values fall back to the WALLETONE_* settings.
+    """
+    if not _merchants:
+        with _merchants_lock:
+            if not _merchants:
+                _merchants.update(make_merchants())
+    return _merchants
+
+
+def make_merchants() -> dict:
+    default = WalletOneMerchant(str(api_settings.WALLETONE_MERCHANT_ID), api_settings.WALLETONE_SECRET_KEY,
+                                api_settings.WALLETONE_CURRENCY_ID, api_settings.WALLETONE_SUCCESS_URL,
+                                api_settings.WALLETONE_FAIL_URL)
+    merchants = {default.merchant_id: default}
+    for merchant_id, config in api_settings.WALLETONE_MERCHANTS.items():
+        merchants[str(merchant_id)] = WalletOneMerchant(str(merchant_id), config['SECRET_KEY'],
+                                                        config.get('CURRENCY_ID', default.currency_id),
+                                                        config.get('SUCCESS_URL', default.success_url),
+                                                        config.get('FAIL_URL', default.fail_url))
+    return merchants
+
+
+def get_merchant(merchant_id=None) -> WalletOneMerchant:
+    """
+    Returns the merchant account with the given id, the default account without one, None for unknown ids.
+    """
+    if merchant_id is None:
+        merchant_id = api_settings.WALLETONE_MERCHANT_ID
+    return get_merchants().get(str(merchant_id))
+
+
+def reset_merchants(*args, **kwargs):
+    if kwargs.get('setting', 'PAYMENT_GATEWAY').startswith('PAYMENT_GATEWAY'):
+        _merchants.clear()
+
+
+setting_changed.connect(reset_merchants)
+
+
 class WalletOneException(Exception):
-    def __init__(self, error_msg):
+    """
+    `error_msg` is the response to WalletOne, `code` names the error for logs and replay reports.
+    """
+
+    def __init__(self, error_msg, code: str = 'retry'):
         self.error_msg = error_msg
+        self.code = code
 
 
 class WalletOnePaymentProvider(WalletOneSignEncoder, AbstractPaymentProvider):
 
+    @traced
     def validate_signature(self, attrs):
+        merchant = get_merchant(attrs.get('WMI_MERCHANT_ID', ''))
+        if merchant is None:
+            raise WalletOneException('WMI_RESULT=RETRY&WMI_DESCRIPTION=WMI_MERCHANT_ID error', 'unknown_merchant')
         signature = attrs.get('WMI_SIGNATURE', '')
-        value = self._get_signature(attrs).decode()
+        value = merchant.signer._get_signature(attrs).decode()
         if signature != value:
-            raise WalletOneException('WMI_RESULT=RETRY&WMI_DESCRIPTION=WMI_SIGNATURE error')
+            raise WalletOneException('WMI_RESULT=RETRY&WMI_DESCRIPTION=WMI_SIGNATURE error', 'bad_signature')
         return attrs
 
+    def get_invoice_merchant(self, invoice: Invoice) -> WalletOneMerchant:
+        """
+        Invoices select a merchant account with WMI_MERCHANT_ID in their WALLET_ONE_OVERRIDE details. Raises
+        WalletOneException when the account is no longer configured.
+        """
+        merchant_id = (invoice.details or {}).get('WALLET_ONE_OVERRIDE', {}).get('WMI_MERCHANT_ID')
+        merchant = get_merchant(merchant_id)
+        if merchant is None:
+            logger.warning('Unknown WalletOne merchant of invoice.',
+                           extra={'invoice_id': invoice.pk, 'WMI_MERCHANT_ID': merchant_id})
+            raise WalletOneException('WMI_RESULT=RETRY&WMI_DESCRIPTION=WMI_MERCHANT_ID error', 'unknown_merchant')
+        return merchant
+
+    def validate_merchant(self, invoice: Invoice, merchant_id) -> bool:
+        if self.get_invoice_merchant(invoice).merchant_id != str(merchant_id):
+            raise WalletOneException('WMI_RESULT=RETRY&WMI_DESCRIPTION=WMI_MERCHANT_ID error', 'merchant_mismatch')
+        return True
+
+    def validate_signable(self, invoice: Invoice) -> bool:
+        """
+        Raises ValidationError for invoices make_signed_invoice can not sign.
+        """
+        if not isinstance(invoice.details, dict):
+            raise ValidationError(_('Invoice has no details.'), code='invalid_details')
+        if invoice.expires_at is None:
+            raise ValidationError(_('Invoice has no expiration date.'), code='no_expiration')
+        if self.external_reference and not invoice.external_reference:
+            raise ValidationError(_('Invoice has no external reference.'), code='no_reference')
+        merchant_id = invoice.details.get('WALLET_ONE_OVERRIDE', {}).get('WMI_MERCHANT_ID')
+        if get_merchant(merchant_id) is None:
+            raise ValidationError(_('Unknown WalletOne merchant %(merchant_id)s.') % {'merchant_id': merchant_id},
+                                  code='unknown_merchant')
+        return True
+
     def get_encoded_description(self, invoice: Invoice) -> str:
         desc = invoice.details.get(api_settings.WALLETONE_DETAIL_FIELD, _('Purchase payment'))
         if len(desc) > 255:
@@ -77,19 +190,21 @@ class WalletOnePaymentProvider(WalletOneSignEncoder, AbstractPaymentProvider):
 
     def make_signed_invoice(self, invoice: Invoice) -> list:
         overridden_data = invoice.details.get('WALLET_ONE_OVERRIDE', {})
-        data = [('WMI_MERCHANT_ID', api_settings.WALLETONE_MERCHANT_ID),
-                ('WMI_CURRENCY_ID', api_settings.WALLETONE_CURRENCY_ID),
+        merchant = self.get_invoice_merchant(invoice)
+        data = [('WMI_MERCHANT_ID', merchant.merchant_id),
+                ('WMI_CURRENCY_ID', merchant.currency_id),
                 ('WMI_DESCRIPTION', self.get_encoded_description(invoice)),
-                ('WMI_SUCCESS_URL', overridden_data.get('WMI_SUCCESS_URL', api_settings.WALLETONE_SUCCESS_URL)),
-                ('WMI_FAIL_URL', overridden_data.get('WMI_FAIL_URL', api_settings.WALLETONE_FAIL_URL)),
+                ('WMI_SUCCESS_URL', overridden_data.get('WMI_SUCCESS_URL', merchant.success_url)),
+                ('WMI_FAIL_URL', overridden_data.get('WMI_FAIL_URL', merchant.fail_url)),
                 ('WMI_PAYMENT_AMOUNT', str(invoice.total)),
-                ('WMI_PAYMENT_NO', str(invoice.id)),
+                ('WMI_PAYMENT_NO', self.get_invoice_reference(invoice)),
                 ('WMI_EXPIRED_DATE', invoice.expires_at.replace(microsecond=0).replace(tzinfo=None).isoformat())]
-        data.append(('WMI_SIGNATURE', self._get_signature(data).decode()))
+        data.append(('WMI_SIGNATURE', merchant.signer._get_signature(data).decode()))
         return data
 
+    @traced
+    @guard_database
     def pay(self, invoice_id: int, transaction_data: WalletOneTransactionDTO) -> (Invoice, Transaction):
-        invoice_id = transaction_data.WMI_PAYMENT_NO
         logger.info('Processing WalletOne payment.',
                     extra={'invoice_id': invoice_id, 'WMI_ORDER_ID': transaction_data.WMI_ORDER_ID})
         transaction_data.money_amount = transaction_data.WMI_PAYMENT_AMOUNT
@@ -108,14 +223,14 @@ class WalletOnePaymentProvider(WalletOneSignEncoder, AbstractPaymentProvider):
         error_message = 'WMI_RESULT=RETRY&WMI_DESCRIPTION=WMI_PAYMENT_NO error'
         try:
             validation_error = None
-            with db_transaction.atomic():
+            with lock_block():
                 try:
-                    invoice = Invoice.objects.select_for_update().get(id=invoice_id)
+                    invoice = self.get_invoice_for_payment(invoice_id)
                     if invoice.status == InvoiceStatus.PAID and transaction.id == invoice.success_transaction_id:
                         logger.info('WalletOne payment was already made returning old result.',
                                     extra={'invoice_id': invoice_id, 'WMI_ORDER_ID': transaction_data.WMI_ORDER_ID})
                         return invoice, transaction
-                    invoice = self.payment_handler.try_process_payment(invoice, transaction)
+                    invoice = self.process_payment(invoice, transaction)
                     logger.info('WalletOne payment success.',
                                 extra={'invoice_id': invoice_id, 'transaction_id': transaction.id,
                                        'WMI_ORDER_ID': transaction_data.WMI_ORDER_ID})
@@ -135,33 +250,10 @@ class WalletOnePaymentProvider(WalletOneSignEncoder, AbstractPaymentProvider):
 
 
 class WalletOneTransactionHandler(BasicTransactionHandler):
+    @traced
     def create(self, transaction: WalletOneTransactionDTO):
         with db_transaction.atomic():
-            # t = super().create(transaction)
-            wt = WalletOneTransaction.objects.create(
-                invoice_id=transaction.invoice_id,
-                money_amount=transaction.money_amount,
-                type=transaction.type,
-                status=TransactionStatus.PENDING,
-                WMI_ORDER_ID=transaction.WMI_ORDER_ID,
-                WMI_MERCHANT_ID=transaction.WMI_MERCHANT_ID,
-                WMI_PAYMENT_AMOUNT=transaction.WMI_PAYMENT_AMOUNT,
-                WMI_COMMISSION_AMOUNT=transaction.WMI_COMMISSION_AMOUNT,
-                WMI_CURRENCY_ID=transaction.WMI_CURRENCY_ID,
-                WMI_TO_USER_ID=transaction.WMI_TO_USER_ID,
-                WMI_PAYMENT_NO=transaction.WMI_PAYMENT_NO,
-                WMI_DESCRIPTION=transaction.WMI_DESCRIPTION,
-                WMI_SUCCESS_URL=transaction.WMI_SUCCESS_URL,
-                WMI_FAIL_URL=transaction.WMI_FAIL_URL,
-                WMI_EXPIRED_DATE=transaction.WMI_EXPIRED_DATE,
-                WMI_CREATE_DATE=transaction.WMI_CREATE_DATE,
-                WMI_UPDATE_DATE=transaction.WMI_UPDATE_DATE,
-                WMI_ORDER_STATE=transaction.WMI_ORDER_STATE,
-                WMI_NOTIFY_COUNT=transaction.WMI_NOTIFY_COUNT,
-                WMI_EXTERNAL_ACCOUNT_ID=transaction.WMI_EXTERNAL_ACCOUNT_ID,
-                WMI_AUTO_ACCEPT=transaction.WMI_AUTO_ACCEPT,
-                WMI_LAST_NOTIFY_DATE=transaction.WMI_LAST_NOTIFY_DATE,
-                WMI_INVOICE_OPERATIONS=transaction.WMI_INVOICE_OPERATIONS,
-                WMI_PAYMENT_TYPE=transaction.WMI_PAYMENT_TYPE
-            )
+            wt = WalletOneTransaction.objects.create(status=TransactionStatus.PENDING,
+                                                     **to_model_kwargs(transaction, WalletOneTransaction))
+            self.track_attempt(wt)
         return wt
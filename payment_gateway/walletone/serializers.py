@@ -1,6 +1,9 @@
 from rest_framework import serializers
 
+from payment_gateway.errors import PaymentError
+from payment_gateway.identity import get_invoice, invoice_exists
 from payment_gateway.models import WalletOneTransaction, Invoice, TransactionType
+from payment_gateway.settings import api_settings
 from payment_gateway.walletone.provider import get_walletone_provider
 from .dto import WalletOneTransaction as WalletOneTransactionDTO
 
@@ -22,12 +25,41 @@ class WalletOneSignSerializer(serializers.Serializer):
     def validate_invoice(self, invoice):
         self.provider.payment_handler.validate_status_for_pay(invoice, raise_exc=True)
         self.provider.payment_handler.validate_expiration(invoice, raise_exc=True)
+        self.provider.validate_signable(invoice)
         return invoice
 
     def create(self, validated_data):
         return self.provider.make_signed_invoice(validated_data['invoice'])
 
 
+class WalletOneBatchSignSerializer(serializers.Serializer):
+    provider = get_walletone_provider()
+
+    invoices = serializers.ListField(child=serializers.IntegerField(), allow_empty=False,
+                                     max_length=api_settings.WALLETONE_BATCH_SIGN_MAX_INVOICES)
+
+    def create(self, validated_data):
+        invoice_ids = validated_data['invoices']
+        invoices = Invoice.objects.in_bulk(invoice_ids)
+        return [self.sign(invoice_id, invoices.get(invoice_id)) for invoice_id in invoice_ids]
+
+    def sign(self, invoice_id: int, invoice: Invoice) -> dict:
+        if invoice is None:
+            message = serializers.PrimaryKeyRelatedField.default_error_messages['does_not_exist']
+            return {'invoice': invoice_id, 'error': {'detail': message.format(pk_value=invoice_id),
+                                                     'code': 'does_not_exist'}}
+        try:
+            self.provider.payment_handler.validate_status_for_pay(invoice, raise_exc=True)
+            self.provider.payment_handler.validate_expiration(invoice, raise_exc=True)
+        except PaymentError as e:
+            return {'invoice': invoice_id, 'error': {'detail': e.detail, 'code': e.detail.code}}
+        try:
+            self.provider.validate_signable(invoice)
+        except serializers.ValidationError as e:
+            return {'invoice': invoice_id, 'error': {'detail': e.detail[0], 'code': e.detail[0].code}}
+        return {'invoice': invoice_id, 'data': self.provider.make_signed_invoice(invoice)}
+
+
 class WalletOneConfirmSerializer(serializers.ModelSerializer):
     provider = get_walletone_provider()
 
@@ -63,18 +95,22 @@ class WalletOneConfirmSerializer(serializers.ModelSerializer):
         extra_kwargs = {'WMI_ORDER_ID': {'validators': []}}
 
     def validate_WMI_PAYMENT_NO(self, WMI_PAYMENT_NO):
-        if not Invoice.objects.filter(id=WMI_PAYMENT_NO).exists():
+        invoice_id = self.provider.resolve_invoice_id(WMI_PAYMENT_NO)
+        if invoice_id is None or not invoice_exists(invoice_id):
             raise serializers.ValidationError('', code='invalid_invoice')
         return WMI_PAYMENT_NO
 
     def validate(self, attrs):
         self.provider.validate_signature(attrs)
+        invoice = get_invoice(self.provider.resolve_invoice_id(attrs['WMI_PAYMENT_NO']))
+        self.provider.validate_merchant(invoice, attrs['WMI_MERCHANT_ID'])
         del attrs['WMI_SIGNATURE']
         if 'WMI_TEST_MODE_INVOICE' in attrs:
             del attrs['WMI_TEST_MODE_INVOICE']
         return attrs
 
     def create(self, validated_data):
-        data = WalletOneTransactionDTO(type=TransactionType.WALLETONE, invoice_id=validated_data['WMI_PAYMENT_NO'],
+        invoice_id = self.provider.resolve_invoice_id(validated_data['WMI_PAYMENT_NO'])
+        data = WalletOneTransactionDTO(type=TransactionType.WALLETONE, invoice_id=invoice_id,
                                        money_amount=validated_data['WMI_PAYMENT_AMOUNT'], **validated_data)
         return self.provider.pay(data.invoice_id, data)
@@ -1,11 +1,15 @@
 import logging
 
+from payment_gateway.profiling import profile_slow_requests
+from payment_gateway.schema import CompiledSchema, CompiledSchemaMixin
+from payment_gateway.throttling import WebhookRateThrottle
 from payment_gateway.walletone.provider import WalletOneException
 from rest_framework import status
+from rest_framework.exceptions import Throttled
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
 
-from .serializers import WalletOneConfirmSerializer, WalletOneSignSerializer
+from .serializers import WalletOneBatchSignSerializer, WalletOneConfirmSerializer, WalletOneSignSerializer
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +17,7 @@ logger = logging.getLogger(__name__)
 class WalletOneSignAPIView(GenericAPIView):
     serializer_class = WalletOneSignSerializer
 
+    @profile_slow_requests
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -20,14 +25,34 @@ class WalletOneSignAPIView(GenericAPIView):
         return Response(data=data, status=status.HTTP_200_OK)
 
 
-class WalletOneConfirmAPIView(GenericAPIView):
-    serializer_class = WalletOneConfirmSerializer
+class WalletOneBatchSignAPIView(GenericAPIView):
+    serializer_class = WalletOneBatchSignSerializer
 
+    @profile_slow_requests
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.save()
+        return Response(data=data, status=status.HTTP_200_OK)
+
+
+class WalletOneConfirmAPIView(CompiledSchemaMixin, GenericAPIView):
+    serializer_class = WalletOneConfirmSerializer
+    payload_schema = CompiledSchema(WalletOneConfirmSerializer)
+    throttle_classes = (WebhookRateThrottle,)
+    throttle_scope = 'walletone'
+
+    def handle_exception(self, exc):
+        if isinstance(exc, Throttled):
+            headers = {'Retry-After': '%d' % exc.wait} if exc.wait is not None else {}
+            return Response('WMI_RESULT=RETRY&WMI_DESCRIPTION=Too many requests',
+                            status=status.HTTP_429_TOO_MANY_REQUESTS, headers=headers)
+        return super().handle_exception(exc)
+
+    @profile_slow_requests
+    def post(self, request, *args, **kwargs):
         try:
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
+            self.validate_and_save(request)
         except WalletOneException as e:
             logger.info('Error processing W1 payment.', exc_info=True, extra=request.data)
             return Response(e.error_msg, status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+
+import django
+from django.conf import settings
+from django.test.utils import get_runner
+
+
+def get_database(postgres: bool) -> dict:
+    if not postgres:
+        return {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+    return {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'payment_gateway'),
+        'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', ''),
+        'PORT': os.environ.get('POSTGRES_PORT', ''),
+    }
+
+
+def configure(postgres: bool):
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='payment-gateway-tests',
+        USE_TZ=True,
+        DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+        DATABASES={'default': get_database(postgres)},
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'rest_framework',
+            'payment_gateway',
+        ],
+        LOGGING={
+            'version': 1,
+            'disable_existing_loggers': False,
+            'handlers': {'null': {'class': 'logging.NullHandler'}},
+            'loggers': {'payment_gateway': {'handlers': ['null'], 'propagate': False}},
+        },
+        PAYMENT_GATEWAY_CLOUDPAYMENTS_API_SECRET='cloudpayments-secret',
+        PAYMENT_GATEWAY_CLOUDPAYMENTS_VALID_CURRENCIES=['RUB'],
+        PAYMENT_GATEWAY_WALLETONE_SECRET_KEY='walletone-secret',
+        PAYMENT_GATEWAY_WALLETONE_MERCHANT_ID='1',
+        PAYMENT_GATEWAY_WALLETONE_CURRENCY_ID=643,
+        PAYMENT_GATEWAY_WALLETONE_SUCCESS_URL='https://example.com/success',
+        PAYMENT_GATEWAY_WALLETONE_FAIL_URL='https://example.com/fail',
+        PAYMENT_GATEWAY_WALLETONE_DETAIL_FIELD='description',
+    )
+    django.setup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the payment_gateway test suite.')
+    parser.add_argument('labels', nargs='*', default=['payment_gateway'])
+    parser.add_argument('--postgres', action='store_true',
+                        help='Run against PostgreSQL (POSTGRES_* environment variables), including tests tagged '
+                             '"postgres". By default the suite runs on in-memory SQLite without them.')
+    parser.add_argument('-v', '--verbosity', type=int, default=1)
+    args = parser.parse_args()
+    configure(args.postgres)
+    runner = get_runner(settings)(verbosity=args.verbosity, exclude_tags=None if args.postgres else ['postgres'])
+    sys.exit(bool(runner.run_tests(args.labels)))
+
+
+if __name__ == '__main__':
+    main()